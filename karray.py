@@ -0,0 +1,120 @@
+import array
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Storage of ArrayObjects.  Arrays of a numeric type live in a contiguous typed buffer
+# (array.array), every other element type in a list.  Element-wise operations between two
+# numeric arrays of the same type run over the whole buffers at once: with NumPy when it
+# is installed, on views sharing the buffers' memory, and with map() otherwise.  Integer
+# results wrap around to the width of the element type like they would in C.  float32
+# elements are stored as doubles: scalars of every float type are Python floats, and an
+# element has to read back as the value stored into it.
+
+TYPECODES = {
+    'int8': 'b',
+    'uint8': 'B',
+    'int16': 'h',
+    'uint16': 'H',
+    'int32': 'i',
+    'uint32': 'I',
+    'int64': 'q',
+    'uint64': 'Q',
+    'float32': 'd',
+    'float64': 'd'
+    }
+
+# Unsigned typecode of the same width, used to wrap integer results around
+_UNSIGNED = {'b': 'B', 'h': 'H', 'i': 'I', 'q': 'Q', 'B': 'B', 'H': 'H', 'I': 'I', 'Q': 'Q'}
+
+ARITHMETIC = {
+    '+': (operator.add, 'add'),
+    '-': (operator.sub, 'subtract'),
+    '*': (operator.mul, 'multiply'),
+    '%': (operator.mod, 'remainder')
+    }
+
+COMPARISONS = {
+    '==': (operator.eq, 'equal'),
+    '!=': (operator.ne, 'not_equal'),
+    '<': (operator.lt, 'less'),
+    '>': (operator.gt, 'greater'),
+    '<=': (operator.le, 'less_equal'),
+    '>=': (operator.ge, 'greater_equal')
+    }
+
+def is_numeric(basetype):
+    return basetype in TYPECODES
+
+def is_integer(data):
+    return data.typecode in _UNSIGNED
+
+def make_storage(basetype, data):
+    if basetype in TYPECODES:
+        return _typed(TYPECODES[basetype], data)
+    return list(data)
+
+def filled(basetype, value, n):
+    if basetype in TYPECODES:
+        return _typed(TYPECODES[basetype], [value]) * n
+    return [value] * n
+
+def _typed(code, values):
+    try:
+        return array.array(code, values)
+    except OverflowError:
+        return _wrapped(code, values)
+
+def _wrapped(code, values):
+    unsigned = _UNSIGNED[code]
+    mask = (1 << (8 * array.array(code).itemsize)) - 1
+    result = array.array(code)
+    result.frombytes(array.array(unsigned, [int(i) & mask for i in values]).tobytes())
+    return result
+
+def _view(data):
+    return numpy.frombuffer(data, dtype = data.typecode)
+
+def _from_numpy(code, values):
+    result = array.array(code)
+    result.frombytes(values.astype(code, copy = False).tobytes())
+    return result
+
+def elementwise(op, a, b):
+    # a and b are buffers of the same typecode and length
+    code = a.typecode
+
+    if op == '/':
+        if is_integer(a):
+            function, name = operator.floordiv, 'floor_divide'
+        else:
+            function, name = operator.truediv, 'true_divide'
+    else:
+        function, name = ARITHMETIC[op]
+
+    if numpy is None:
+        return _typed(code, list(map(function, a, b)))
+
+    x = _view(a)
+    y = _view(b)
+    if (op == '/' or op == '%') and not y.all():
+        raise ZeroDivisionError('division by zero')
+
+    with numpy.errstate(all = 'ignore'):
+        return _from_numpy(code, getattr(numpy, name)(x, y))
+
+def compare(op, a, b):
+    function, name = COMPARISONS[op]
+
+    if numpy is None or type(a) == list:
+        return list(map(function, a, b))
+    return getattr(numpy, name)(_view(a), _view(b)).tolist()
+
+def fill(data, value):
+    if type(data) == list:
+        data[:] = [value] * len(data)
+    else:
+        data[:] = _typed(data.typecode, [value]) * len(data)
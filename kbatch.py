@@ -0,0 +1,201 @@
+from klang import KyazukenError
+from kparse import load_ast, elaborate_ast, check_document
+import klib
+
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import shlex
+import signal
+import sys
+import time
+
+# Batch runner.  A manifest lists jobs, one per line: a script and its arguments, split
+# like a shell would (blank lines and lines starting with # are skipped).  Each script is
+# parsed, elaborated and checked once in the parent, then the jobs run on a pool of
+# worker processes.  Forked workers inherit the elaborated documents; where processes
+# are spawned each worker elaborates the scripts again from the AST cache when it starts.
+#
+# Every job gets its stdout and stderr captured and at most --timeout seconds to run.  A
+# summary of the throughput and latency percentiles goes to stderr, and with --out the
+# result of every job is written as one JSON object per line.
+#
+# python kbatch.py [--jobs=N] [--timeout=SECONDS] [--out=FILE] manifest
+
+# script: (document, environment), or the errors preventing it from running
+documents = {}
+
+class JobTimeout(Exception):
+    pass
+
+def read_manifest(path):
+    jobs = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            jobs.append(shlex.split(line))
+    return jobs
+
+def prepare(script):
+    # The output of the compiler is only shown when it fails
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        if not os.path.isfile(script):
+            return "Error: no such file " + script
+
+        ast = load_ast(script)
+        if ast is None:
+            return out.getvalue()
+
+        document, docs, errors = elaborate_ast(ast, script, jobs = 1)
+        if errors == 0:
+            env = document.make_default_env()
+            errors = check_document(document, env)
+
+    if errors != 0:
+        return out.getvalue()
+    return document, env
+
+def prepare_all(scripts):
+    for i in scripts:
+        if not i in documents:
+            documents[i] = prepare(i)
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+def run_job(job):
+    n, argv, timeout, engine = job
+    prepared = documents[argv[0]]
+
+    result = {'job': n, 'argv': argv}
+    if type(prepared) == str:
+        result.update(status = 'error', seconds = 0.0, stdout = '', stderr = prepared)
+        return result
+
+    document, env = prepared
+    out = io.StringIO()
+    err = io.StringIO()
+    status = 'ok'
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        if timeout != None:
+            signal.signal(signal.SIGALRM, _alarm)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            document.execute(env, argv, engine)
+        except JobTimeout:
+            status = 'timeout'
+            err.write('Error: timed out after ' + str(timeout) + ' s\n')
+        except KyazukenError as e:
+            status = 'error'
+            err.write('Error: ' + str(e) + '\n')
+        except Exception as e:
+            status = 'error'
+            err.write('Error: ' + type(e).__name__ + ': ' + str(e) + '\n')
+        finally:
+            if timeout != None:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            klib.stdout.flush()
+
+    result.update(status = status, seconds = time.perf_counter() - start, stdout = out.getvalue(), stderr = err.getvalue())
+    return result
+
+def percentile(values, p):
+    # Nearest rank
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def summary(results, elapsed, workers):
+    latencies = [i['seconds'] for i in results]
+    counts = {}
+    for i in results:
+        counts[i['status']] = counts.get(i['status'], 0) + 1
+
+    lines = [
+        str(len(results)) + ' jobs on ' + str(workers) + ' workers in ' + f'{elapsed:.2f} s, ' + f'{len(results) / elapsed if elapsed > 0 else 0.0:.1f} jobs/s',
+        ', '.join(str(j) + ' ' + i for i, j in sorted(counts.items())),
+        'latency ' + '  '.join(f'p{p} {percentile(latencies, p) * 1000:.1f} ms' for p in [50, 90, 99]) + f'  max {max(latencies, default = 0.0) * 1000:.1f} ms'
+        ]
+    return '\n'.join(lines) + '\n'
+
+def _init_worker(scripts):
+    prepare_all(scripts)
+
+def run_batch(jobs, workers = None, timeout = None, engine = 'tree', out = None):
+    workers = workers or os.cpu_count() or 1
+    scripts = list(dict.fromkeys(i[0] for i in jobs))
+
+    start = time.perf_counter()
+    prepare_all(scripts)
+
+    # Whatever is pending would be written again by every worker
+    klib.stdout.flush()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        initializer = None
+        initargs = ()
+    else:
+        context = multiprocessing.get_context('spawn')
+        initializer = _init_worker
+        initargs = (scripts,)
+
+    results = []
+    with context.Pool(workers, initializer, initargs) as pool:
+        for result in pool.imap_unordered(run_job, [(n, argv, timeout, engine) for n, argv in enumerate(jobs)]):
+            results.append(result)
+            if out != None:
+                out.write(json.dumps(result) + '\n')
+
+    elapsed = time.perf_counter() - start
+    return sorted(results, key = lambda i: i['job']), elapsed, workers
+
+def main(argv):
+    workers = None
+    timeout = None
+    out_path = None
+    manifest = None
+    engine = os.environ.get('KYAZUKEN_ENGINE', 'tree')
+
+    for i in argv[1:]:
+        if i.startswith('--jobs='):
+            workers = int(i.split('=', 1)[1])
+        elif i.startswith('--timeout='):
+            timeout = float(i.split('=', 1)[1])
+        elif i.startswith('--out='):
+            out_path = i.split('=', 1)[1]
+        elif not i.startswith('--') and manifest is None:
+            manifest = i
+        else:
+            manifest = None
+            break
+
+    if manifest is None:
+        sys.stderr.write('usage: kbatch.py [--jobs=N] [--timeout=SECONDS] [--out=FILE] manifest\n')
+        return 2
+
+    jobs = read_manifest(manifest)
+
+    out = open(out_path, 'w') if out_path != None else None
+    try:
+        results, elapsed, workers = run_batch(jobs, workers, timeout, engine, out)
+    finally:
+        if out != None:
+            out.close()
+
+    sys.stderr.write(summary(results, elapsed, workers))
+    return 0 if all(i['status'] == 'ok' for i in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,233 @@
+from klang import KyazukenError
+from kparse import parse_ast, elaborate_ast, check_document
+import kcache
+
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Benchmarks.  Every program of the corpus in bench/ is parsed, elaborated and executed
+# again for each repetition, and the three phases are timed separately.  The parse cache
+# is disabled so parse_ast always does the work; elaborate_ast includes the parsing of the
+# files a program imports.  Warm-up runs are not counted.  Once the timed repetitions are
+# done one more run is made under tracemalloc to get the peak memory of each phase.
+#
+# python kbench.py [--engine=tree,vm] [--repeat=N] [--warmup=N] [--json=FILE]
+#                  [--compare=FILE] [benchmark ...]
+#
+# The JSON output keeps the commit it was measured on, --compare prints the ratio of every
+# median to the one in an earlier output.
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench')
+
+PHASES = ['parse_ast', 'elaborate_ast', 'execute']
+
+def lexer_input():
+    # The kyac sources repeated into one large file
+    sources = ''
+    for name in ['main.k', 'parser.k', 'lexer.k']:
+        with open(os.path.join(os.path.dirname(BENCH_DIR), 'kyac', name)) as f:
+            sources += f.read()
+
+    fd, path = tempfile.mkstemp(suffix = '.k')
+    with os.fdopen(fd, 'w') as f:
+        f.write(sources * 20)
+    return path
+
+# name: (program, function making its argv)
+BENCHMARKS = {
+    'fib': ('fib.k', None),
+    'loops': ('loops.k', None),
+    'strings': ('strings.k', None),
+    'arrays': ('arrays.k', None),
+    'objects': ('objects.k', None),
+    'lexer': ('lexer.k', lexer_input)
+    }
+
+class BenchmarkError(Exception):
+    pass
+
+def errors_in(output):
+    return '\n'.join(i for i in output.split('\n') if not i.startswith('Parsing '))
+
+def run_once(filename, argv, engine, timings):
+    # Runs every phase of filename, adding the time of each to timings.  Output of the
+    # compiler and of the program is discarded.
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        start = time.perf_counter()
+        ast = parse_ast(filename)
+        timings['parse_ast'] = time.perf_counter() - start
+        if ast is None:
+            raise BenchmarkError(errors_in(out.getvalue()))
+
+        start = time.perf_counter()
+        document, documents, errors = elaborate_ast(ast, filename)
+        timings['elaborate_ast'] = time.perf_counter() - start
+
+        if errors == 0:
+            env = document.make_default_env()
+            errors = check_document(document, env)
+        if errors != 0:
+            raise BenchmarkError(errors_in(out.getvalue()))
+
+        start = time.perf_counter()
+        try:
+            document.execute(env, argv, engine)
+        except KyazukenError as e:
+            raise BenchmarkError(str(e))
+        timings['execute'] = time.perf_counter() - start
+
+class MemoryTracker:
+    # Peak of the memory traced during each phase
+    def __init__(self):
+        self.peaks = {}
+
+    def __setitem__(self, phase, elapsed):
+        self.peaks[phase] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+
+def summary(samples):
+    return {
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.mean(samples),
+        'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        'samples': samples
+        }
+
+def run_benchmark(name, engine, repeat, warmup):
+    program, make_argv = BENCHMARKS[name]
+    filename = os.path.relpath(os.path.join(BENCH_DIR, program))
+    argv = [program]
+    if make_argv != None:
+        argv.append(make_argv())
+
+    result = {'engine': engine}
+    samples = {i: [] for i in PHASES}
+
+    try:
+        for n in range(warmup + repeat):
+            timings = {}
+            run_once(filename, argv, engine, timings)
+            if n >= warmup:
+                for i in PHASES:
+                    samples[i].append(timings[i])
+
+        tracemalloc.start()
+        memory = MemoryTracker()
+        try:
+            run_once(filename, argv, engine, memory)
+        finally:
+            tracemalloc.stop()
+    except BenchmarkError as e:
+        result['error'] = str(e).strip()
+        # Phases that did complete are still worth reporting
+        samples = {i: j for i, j in samples.items() if len(j) > 0}
+        if len(timings) > 0 and len(samples) == 0:
+            samples = {i: [j] for i, j in timings.items()}
+        memory = None
+    finally:
+        if make_argv != None:
+            os.unlink(argv[1])
+
+    result['phases'] = {i: summary(j) for i, j in samples.items()}
+    if memory != None:
+        for i in PHASES:
+            result['phases'][i]['peak_bytes'] = memory.peaks[i]
+    return result
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, cwd = os.path.dirname(BENCH_DIR)).stdout.strip() or None
+    except OSError:
+        return None
+
+def report(results, baseline = None):
+    lines = ['benchmark'.ljust(22) + ''.join(i.rjust(16) for i in PHASES) + 'peak(KiB)'.rjust(12)]
+
+    for key, result in results.items():
+        row = key.ljust(22)
+        for phase in PHASES:
+            if not phase in result['phases']:
+                row += '-'.rjust(16)
+                continue
+
+            cell = f"{result['phases'][phase]['median'] * 1000:.1f}ms"
+            old = baseline.get(key, {}).get('phases', {}).get(phase) if baseline != None else None
+            if old != None:
+                cell += f" x{result['phases'][phase]['median'] / old['median']:.2f}"
+            row += cell.rjust(16)
+
+        peaks = [i.get('peak_bytes', 0) for i in result['phases'].values()]
+        row += (str(max(peaks) // 1024) if max(peaks, default = 0) > 0 else '-').rjust(12)
+        lines.append(row)
+
+        if 'error' in result:
+            lines.append('    failed: ' + result['error'].split('\n')[0])
+
+    return '\n'.join(lines) + '\n'
+
+def main(argv):
+    engines = [os.environ.get('KYAZUKEN_ENGINE', 'tree')]
+    repeat = 5
+    warmup = 1
+    json_out = None
+    baseline = None
+    names = []
+
+    for i in argv[1:]:
+        if i.startswith('--engine='):
+            engines = i.split('=', 1)[1].split(',')
+        elif i.startswith('--repeat='):
+            repeat = int(i.split('=', 1)[1])
+        elif i.startswith('--warmup='):
+            warmup = int(i.split('=', 1)[1])
+        elif i.startswith('--json='):
+            json_out = i.split('=', 1)[1]
+        elif i.startswith('--compare='):
+            with open(i.split('=', 1)[1]) as f:
+                baseline = json.load(f)['results']
+        elif i in BENCHMARKS:
+            names.append(i)
+        else:
+            print('Unknown benchmark or option ' + i + ', benchmarks are ' + ', '.join(BENCHMARKS))
+            return 1
+
+    kcache.enabled = False
+
+    results = {}
+    for engine in engines:
+        for name in names or list(BENCHMARKS):
+            results[name + '/' + engine] = run_benchmark(name, engine, repeat, warmup)
+            sys.stderr.write('.')
+            sys.stderr.flush()
+    sys.stderr.write('\n')
+
+    sys.stdout.write(report(results, baseline))
+
+    if json_out != None:
+        with open(json_out, 'w') as f:
+            json.dump({
+                'commit': commit(),
+                'python': platform.python_version(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'repeat': repeat,
+                'warmup': warmup,
+                'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'results': results
+                }, f, indent = 2)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
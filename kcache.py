@@ -0,0 +1,129 @@
+from klang import KYAZUKEN_VERSION
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+# Parsed ASTs are kept next to their sources, much like __pycache__.  Each cache file holds
+# a small header (source path, mtime, size, content hash) followed by the pickled AST, so
+# a stale entry can be rejected without unpickling the tree.
+
+CACHE_DIR = '__kycache__'
+
+# Bump whenever the attributes of the AST classes in klang change, pickled trees of an
+# older layout would miss them.
+AST_FORMAT = 7
+
+enabled = not os.environ.get('KYAZUKEN_NO_CACHE')
+
+# Long-lived processes (the compile server) also keep the pickled trees in memory,
+# {absolute path: (mtime, size, pickled AST)}.  None when they are only on disk.
+memory = None
+
+def cache_path(filename):
+    directory, base = os.path.split(filename)
+    return os.path.join(directory, CACHE_DIR, base + '.' + KYAZUKEN_VERSION + '.kyc')
+
+def _hash_file(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _make_header(filename, st, digest):
+    return {
+        'version': KYAZUKEN_VERSION,
+        'format': AST_FORMAT,
+        'path': os.path.abspath(filename),
+        'mtime': st.st_mtime_ns,
+        'size': st.st_size,
+        'hash': digest
+        }
+
+def load_ast(filename):
+    if not enabled:
+        return None
+
+    if memory != None:
+        ast = _load_memory(filename)
+        if ast is not None:
+            return ast
+
+    ast = _load_disk(filename)
+    if ast is not None:
+        _remember(filename, ast)
+    return ast
+
+def _load_memory(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+
+    entry = memory.get(os.path.abspath(filename))
+    if entry is None or entry[0] != st.st_mtime_ns or entry[1] != st.st_size:
+        return None
+
+    # Every load gets its own copy, elaboration modifies the tree
+    return pickle.loads(entry[2])
+
+def _remember(filename, ast):
+    if memory is None:
+        return
+
+    try:
+        st = os.stat(filename)
+        memory[os.path.abspath(filename)] = (st.st_mtime_ns, st.st_size, pickle.dumps(ast, pickle.HIGHEST_PROTOCOL))
+    except (OSError, pickle.PicklingError):
+        pass
+
+def _load_disk(filename):
+    try:
+        st = os.stat(filename)
+        with open(cache_path(filename), 'rb') as f:
+            header = pickle.load(f)
+
+            if header['version'] != KYAZUKEN_VERSION or header.get('format') != AST_FORMAT:
+                return None
+            if header['path'] != os.path.abspath(filename):
+                return None
+
+            if header['mtime'] == st.st_mtime_ns and header['size'] == st.st_size:
+                return pickle.load(f)
+
+            # The file was touched; it is still usable if the contents did not change
+            digest = _hash_file(filename)
+            if header['hash'] != digest:
+                return None
+            ast = pickle.load(f)
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+    _write(filename, _make_header(filename, st, digest), ast)
+    return ast
+
+def store_ast(filename, ast):
+    if not enabled:
+        return
+
+    try:
+        st = os.stat(filename)
+        digest = _hash_file(filename)
+    except OSError:
+        return
+
+    _remember(filename, ast)
+    _write(filename, _make_header(filename, st, digest), ast)
+
+def _write(filename, header, ast):
+    path = cache_path(filename)
+    directory = os.path.dirname(path)
+
+    try:
+        os.makedirs(directory, exist_ok = True)
+        with tempfile.NamedTemporaryFile(dir = directory, delete = False) as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(ast, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, path)
+    except (OSError, pickle.PicklingError):
+        # The cache is only an optimization, never fail a run because of it
+        pass
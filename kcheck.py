@@ -0,0 +1,342 @@
+from klang import *
+
+# Static checker, run once the environment is complete.  It infers the type of every
+# expression and records it as static_type, or None where the type is only known at run
+# time (members of builtin objects, ...).  Calls of plain functions whose argument types
+# are all known are bound to their target Function or PyFunctionWrapper, fields of class
+# instances to their slot, operators get the function computing them from bare values,
+# and type errors are reported before the program starts.  Functions where every type is
+# known are marked typed and then run on bare values instead of (type, value) pairs.
+# Method calls on instances of a known class get the vtable slot of their method, calls
+# on builtin types the NativeMethod of their type's table.  Indexing a String gives the
+# code of a character, as an int32.
+#
+# This is also the link step: binding a call needs the static types of its arguments,
+# which is what checking computes, so one walk over the tree does both.  A separate
+# linker would infer the same types a second time, with its own rules that could drift
+# from the checker's.
+
+class Checker:
+    def __init__(self, environment):
+        self.environment = environment
+        self.errors = []
+        self.current = None
+        self.typed = True
+        self.slot_types = {}
+
+    def error(self, msg):
+        if isinstance(self.current, ClassDefinition):
+            msg += ' (in the fields of ' + self.current.name + ')'
+        elif self.current.name != None or isinstance(self.current, OperatorOverload):
+            msg += ' (in ' + label(self.current) + ')'
+        self.errors.append(msg)
+        self.typed = False
+
+    def function(self, f):
+        self.current = f
+        self.typed = True
+        self.slot_types = {}
+
+        for i in f.params:
+            self.declare(i)
+
+        for i in f.statements:
+            self.statement(i)
+
+        if isinstance(f, Function):
+            f.typed = self.typed
+
+    def fields(self, _class):
+        self.current = _class
+        for i in _class.vars.values():
+            if type(i) == VariableDefinition:
+                et = self.expression(i.expr)
+                if not self.assignable(i.type, et):
+                    self.error('Attempted to assign a ' + str(et) + ' to new variable of type ' + str(i.type))
+
+    def declare(self, node):
+        # A slot redeclared with another type does not have a single static type
+        if self.slot_types.setdefault(node.slot, node.type) != node.type:
+            self.typed = False
+
+    def statement(self, node):
+        t = type(node)
+
+        if t == VariableDeclaration:
+            self.declare(node)
+        elif t == VariableDefinition:
+            et = self.expression(node.expr)
+            if not self.assignable(node.type, et):
+                self.error('Attempted to assign a ' + str(et) + ' to new variable of type ' + str(node.type))
+            self.declare(node)
+        elif t == StatementList:
+            for i in node.statements:
+                self.statement(i)
+        elif t == IfBlock or t == WhileBlock:
+            self.condition(node, node.condition)
+            self.statement(node.statement)
+        elif t == IfElseBlock:
+            self.condition(node, node.condition)
+            self.statement(node.statement)
+            self.statement(node.else_statement)
+        elif t == CForBlock:
+            self.statement(node.loop_init)
+            self.condition(node, node.loop_condition)
+            self.statement(node.loop_code)
+            self.expression(node.loop_end)
+        elif t == IterForBlock:
+            self.expression(node.iterable)
+            self.declare(node.vardec)
+            self.statement(node.statement)
+
+            # Iteration only exists on the tree-walker's representation
+            self.typed = False
+        elif t == Return:
+            if node.val != None:
+                self.returned(self.expression(node.val))
+        elif t == SuperConstructor:
+            self.super_constructor(node)
+        elif isinstance(node, Expression):
+            self.expression(node)
+
+    def condition(self, node, expr):
+        et = self.expression(expr)
+        if et != None and et != 'bool':
+            self.error(CONDITION_ERRORS[type(node)])
+
+    def returned(self, et):
+        f = self.current
+        if isinstance(f, Function) and not self.assignable(f.rettype, et):
+            self.error('Function ' + str(f.name) + ' returns ' + str(et) + ' but is declared to return ' + str(f.rettype))
+
+    def expression(self, node):
+        # Records and returns the static type of node, None if unknown
+        node.static_type = self.infer(node)
+        if node.static_type is None:
+            self.typed = False
+        return node.static_type
+
+    def infer(self, node):
+        t = type(node)
+
+        if t == Literal:
+            return node.type
+        elif t == Variable:
+            if node.slot is None:
+                self.error('Variable \'' + node.name + '\' does not exist.')
+                return None
+            return node.static_type
+        elif t == FunctionCall:
+            return self.call(node)
+        elif t == BinOp:
+            return self.binop(node)
+        elif t == Store:
+            target = self.expression(node.obj)
+            et = self.expression(node.expr)
+            self.assignment(node.obj, target, et)
+            return et
+        elif t == UniOp:
+            return self.expression(node.left)
+        elif t == PreIncDec or t == PostIncDec:
+            return self.expression(node.obj)
+        elif t == Subscript:
+            return self.subscript(node)
+        elif t == Member:
+            return self.member(node)
+        elif t == NewObject:
+            return self.new_object(node)
+        elif t == ArrayInitializer:
+            return self.array(node)
+        elif t == NewArray:
+            st = self.expression(node.size)
+            if st != None and not (type(st) == str and st.startswith(('int', 'uint'))):
+                self.error("Array size must be an integer, not " + str(st))
+                return None
+            return ArrayType(node.basetype)
+
+        return None
+
+    def binop(self, node):
+        ta = self.expression(node.left)
+        tb = self.expression(node.right)
+        if ta is None or tb is None:
+            return None
+
+        try:
+            et, node.operation = static_operation(ASSIGNMENT_OPERATORS.get(node.op, node.op), ta, tb)
+        except KyazukenError as e:
+            self.error(str(e))
+            return None
+
+        if node.op in ASSIGNMENT_OPERATORS:
+            self.assignment(node.left, ta, et)
+        return et
+
+    def assignable(self, vartype, et):
+        # Unknown types are checked when executed
+        if vartype is None or et is None or vartype == et:
+            return True
+
+        _class = self.get_class(et)
+        return _class != None and vartype in _class.ancestors
+
+    def assignment(self, target, vartype, et):
+        if type(target) == Subscript and target.src.static_type == 'String':
+            self.error('Cannot assign to a character of a String, Strings cannot be modified')
+            return
+
+        if self.assignable(vartype, et):
+            return
+
+        if type(target) == Subscript:
+            self.error('Cannot assign ' + str(et) + ' to ' + str(ArrayType(vartype)))
+        else:
+            self.error(f'Attempted to assign value of type {et} to variable of type {vartype}')
+
+    def subscript(self, node):
+        st = self.expression(node.src)
+        it = self.expression(node.idx)
+
+        if it != None and not (type(it) == str and it.startswith('int')):
+            self.error("Failed: attempted subscript of " + str(node.src) + ' using type ' + str(it))
+            return None
+
+        if type(st) == ArrayType:
+            return st.basetype
+        elif st == 'String':
+            return 'int32'
+        return None
+
+    def array(self, node):
+        items = [self.expression(i) for i in node.items]
+
+        if len(items) == 0:
+            self.error("Cannot infer the type of an empty array")
+            return None
+        if None in items:
+            return None
+
+        for i in items:
+            if i != items[0]:
+                self.error("Array elements must all be of type " + str(items[0]) + ", found " + str(i))
+                return None
+
+        return ArrayType(items[0])
+
+    def get_class(self, name):
+        # The user class named by a static type, None for any other type
+        if type(name) == str:
+            return self.environment.classes.get(name)
+        return None
+
+    def member(self, node):
+        _class = self.get_class(self.expression(node.src))
+        if _class is None:
+            return None
+
+        if not node.sub in _class.offsets:
+            self.error(_class.name + " has no member " + node.sub)
+            return None
+
+        i = _class.offsets[node.sub]
+        node.descriptor = _class.descriptors[i]
+        node.field_type = _class.field_types[i]
+        return node.field_type
+
+    def new_object(self, node):
+        node.argtypes = [self.expression(i) for i in node.args]
+
+        _class = self.get_class(node.name)
+        if _class is None and type(node.name) == str:
+            _class = native_classes.get(node.name)
+        if _class is None:
+            self.error("Class '" + str(node.name) + "' does not exist")
+            return None
+
+        if not None in node.argtypes:
+            try:
+                _class.get_constructor(node.argtypes)
+            except KyazukenError as e:
+                self.error(str(e).strip())
+        return node.name
+
+    def native_type(self, name):
+        # Method table of the builtin type named by a static type, unless a user class has
+        # the same name
+        if type(name) == ArrayType:
+            return array_methods(name.basetype)
+        elif type(name) == str and not name in self.environment.classes:
+            return native_types.get(name)
+        return None
+
+    def native_call(self, node, methods, argtypes):
+        if None in argtypes:
+            return None
+
+        sig = name_and_argtypes_to_signature(node.func.sub, argtypes)
+        if not sig in methods:
+            self.error(str(node.func.src.static_type) + ' has no member ' + node.func.sub + ' with arguments ' + str(argtypes))
+            return None
+
+        node.method = methods[sig]
+        return node.method.rettype
+
+    def method_call(self, node, argtypes):
+        st = self.expression(node.func.src)
+        methods = self.native_type(st)
+        if methods != None:
+            return self.native_call(node, methods, argtypes)
+
+        _class = self.get_class(st)
+        if _class is None or None in argtypes:
+            return None
+
+        try:
+            node.vslot = _class.method_index(node.func.sub, argtypes)
+        except KyazukenError as e:
+            self.error(str(e))
+            return None
+
+        node.vguard = _class.instance_type
+        node.argtypes = argtypes
+        return _class.vtable[node.vslot].rettype
+
+    def super_constructor(self, node):
+        node.argtypes = [self.expression(i) for i in node.args]
+
+        if node.parent is None:
+            self.error('Parent constructor called outside of a subclass constructor')
+        elif not None in node.argtypes:
+            try:
+                node.parent.get_constructor(node.argtypes)
+            except KyazukenError as e:
+                self.error(str(e).strip())
+
+    def call(self, node):
+        argtypes = [self.expression(i) for i in node.args]
+
+        if type(node.func) == Member:
+            return self.method_call(node, argtypes)
+        elif type(node.func) != Variable:
+            self.expression(node.func)
+            return None
+
+        node.target = None
+        if None in argtypes:
+            return None
+
+        try:
+            node.target = self.environment.get_function(node.func.name, argtypes)
+        except KyazukenError as e:
+            self.error(str(e))
+            return None
+
+        return node.target.rettype
+
+def check(environment, functions):
+    checker = Checker(environment)
+    for i in environment.classes.values():
+        checker.fields(i)
+    for f in functions:
+        checker.function(f)
+    return checker.errors
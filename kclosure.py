@@ -0,0 +1,421 @@
+from klang import *
+
+# Closure engine.  Every AST node is turned once into a Python closure specialized for
+# that node (its operator, the kind of its operands, ...), and functions run by calling
+# the closures instead of going through eval/execute.  Expression closures return a
+# (type, value) pair, statement closures return None or the value of a Return.  Nodes
+# without a specialization fall back to their own bound eval/execute method.
+
+def expression(node):
+    t = type(node)
+
+    if t == Literal:
+        tv = (node.type, node.value)
+        return lambda c: tv
+    elif t == Variable:
+        return variable(node)
+    elif t == BinOp:
+        return binop(node)
+    elif t == Store:
+        return store(node)
+    elif t == FunctionCall:
+        return function_call(node)
+    elif t == UniOp:
+        return uniop(node)
+    elif t == PreIncDec or t == PostIncDec:
+        return incdec(node)
+    elif t == Subscript:
+        return subscript(node)
+    elif t == ArrayInitializer:
+        items = [expression(i) for i in node.items]
+        return lambda c: make_array([i(c) for i in items])
+    elif t == NewArray:
+        return new_array_expression(node)
+
+    return node.eval
+
+def variable(node):
+    slot = node.slot
+    if slot is None:
+        return node.eval
+
+    msg = 'Variable \'' + node.name + '\' does not exist.'
+
+    def f(c):
+        v = c.slots[slot]
+        if v is None:
+            raise KyazukenError(msg)
+        return v
+
+    return f
+
+def binop(node):
+    op = node.op
+
+    if op in ASSIGNMENT_OPERATORS:
+        return compound_assignment(node)
+
+    if type(node.left) == Literal and type(node.right) == Literal:
+        # Fold constants, unless they fail and should fail when executed
+        try:
+            tv = binary_operation(op, node.left.type, node.left.value, node.right.type, node.right.value)
+            return lambda c: tv
+        except (KyazukenError, ArithmeticError, TypeError):
+            pass
+
+    left = expression(node.left)
+    right = expression(node.right)
+
+    if op == '+':
+        def f(c):
+            ta, a = left(c)
+            tb, b = right(c)
+            if ta == 'String' or tb == 'String':
+                return 'String', str(a) + str(b)
+            return ta, a + b
+    elif op == '-':
+        def f(c):
+            ta, a = left(c)
+            return ta, a - right(c)[1]
+    elif op == '*':
+        def f(c):
+            ta, a = left(c)
+            return ta, a * right(c)[1]
+    elif op == '%':
+        def f(c):
+            ta, a = left(c)
+            return ta, a % right(c)[1]
+    elif op == '<':
+        f = lambda c: ('bool', left(c)[1] < right(c)[1])
+    elif op == '>':
+        f = lambda c: ('bool', left(c)[1] > right(c)[1])
+    elif op == '<=':
+        f = lambda c: ('bool', left(c)[1] <= right(c)[1])
+    elif op == '>=':
+        f = lambda c: ('bool', left(c)[1] >= right(c)[1])
+    elif op == '==':
+        f = lambda c: ('bool', left(c)[1] == right(c)[1])
+    elif op == '!=':
+        f = lambda c: ('bool', left(c)[1] != right(c)[1])
+    elif op == '&&':
+        f = lambda c: ('bool', left(c)[1] and right(c)[1])
+    elif op == '||':
+        f = lambda c: ('bool', left(c)[1] or right(c)[1])
+    else:
+        operation = BINARY_OPERATIONS.get(op)
+        if operation is None:
+            def f(c):
+                ta, a = left(c)
+                tb, b = right(c)
+                return binary_operation(op, ta, a, tb, b)
+        else:
+            def f(c):
+                ta, a = left(c)
+                tb, b = right(c)
+                return operation(ta, a, tb, b)
+
+    return f
+
+def compound_assignment(node):
+    left = expression(node.left)
+    right = expression(node.right)
+    assign = assigner(node.left)
+    op = ASSIGNMENT_OPERATORS[node.op]
+
+    def f(c):
+        ta, a = left(c)
+        tb, b = right(c)
+        t, v = binary_operation(op, ta, a, tb, b)
+        assign(c, t, v)
+        return t, v
+
+    return f
+
+def store(node):
+    value = expression(node.expr)
+    assign = assigner(node.obj)
+
+    def f(c):
+        t, v = value(c)
+        assign(c, t, v)
+        return t, v
+
+    return f
+
+def assigner(node):
+    t = type(node)
+
+    if t == Variable:
+        slot = node.slot
+        name = node.name
+        return lambda c, _type, val: c.setvar(slot, name, _type, val)
+    elif t == Subscript:
+        src = expression(node.src)
+        idx = expression(node.idx)
+        msg = "Failed: attempted subscript of " + str(node.src) + ' using type '
+
+        def f(c, _type, val):
+            st, sv = src(c)
+            it, iv = idx(c)
+            if not it.startswith('int'):
+                raise KyazukenError(msg + str(it))
+            sv.setitem(iv, _type, val)
+
+        return f
+
+    return node.assign
+
+def function_call(node):
+    args = [expression(i) for i in node.args]
+
+    if node.method != None:
+        method = node.method
+        src = expression(node.func.src)
+
+        def f(c):
+            receiver = src(c)[1]
+            return method.call(c.env, [receiver] + [i(c)[1] for i in args])
+    elif node.target != None:
+        target = node.target
+
+        def f(c):
+            return target.call(c.env, [i(c)[1] for i in args])
+    elif type(node.func) == Variable:
+        name = node.func.name
+
+        def f(c):
+            values = [i(c) for i in args]
+            fn = c.get_function(name, [i[0] for i in values])
+            return fn.call(c.env, [i[1] for i in values])
+    elif type(node.func) == Member:
+        src = expression(node.func.src)
+        name = node.func.sub
+
+        if node.vslot != None:
+            def f(c):
+                values = [i(c)[1] for i in args]
+                et, ev = src(c)
+                return call_virtual(c.env, node, ev, values)
+        else:
+            def f(c):
+                values = [i(c) for i in args]
+                et, ev = src(c)
+                return call_method(c.env, ev, name, [i[0] for i in values], [i[1] for i in values])
+    else:
+        callee = node.func
+
+        def f(c):
+            values = [i(c) for i in args]
+            fn = callee.get_function(c, [i[0] for i in values])
+            return fn.call(c.env, [i[1] for i in values])
+
+    return f
+
+def uniop(node):
+    left = expression(node.left)
+
+    if node.op == '!':
+        def f(c):
+            et, ev = left(c)
+            return et, not ev
+    else:
+        def f(c):
+            et, ev = left(c)
+            return et, -ev
+
+    return f
+
+def incdec(node):
+    value = expression(node.obj)
+    assign = assigner(node.obj)
+    delta = 1 if node.op == '++' else -1
+
+    if type(node) == PreIncDec:
+        def f(c):
+            et, ev = value(c)
+            ev = ev + delta
+            assign(c, et, ev)
+            return et, ev
+    else:
+        def f(c):
+            et, ev = value(c)
+            assign(c, et, ev + delta)
+            return et, ev
+
+    return f
+
+def subscript(node):
+    src = expression(node.src)
+    idx = expression(node.idx)
+    msg = "Failed: attempted subscript of " + str(node.src) + ' using type '
+
+    def f(c):
+        st, sv = src(c)
+        it, iv = idx(c)
+        if not it.startswith('int'):
+            raise KyazukenError(msg + str(it))
+        return get_item(sv, iv)
+
+    return f
+
+def new_array_expression(node):
+    size = expression(node.size)
+    basetype = node.basetype
+    arraytype = ArrayType(basetype)
+    msg = "Array size must be an integer, not "
+
+    def f(c):
+        st, sv = size(c)
+        if type(st) != str or not st.startswith(('int', 'uint')):
+            raise KyazukenError(msg + str(st))
+        return arraytype, new_array(basetype, sv)
+
+    return f
+
+def statement(node):
+    t = type(node)
+
+    if isinstance(node, Expression):
+        value = expression(node)
+
+        def f(c):
+            value(c)
+
+        return f
+    elif t == VariableDefinition:
+        return variable_definition(node)
+    elif t == StatementList:
+        return block([statement(i) for i in node.statements])
+    elif t == IfBlock:
+        return if_block(node)
+    elif t == IfElseBlock:
+        return if_else_block(node)
+    elif t == WhileBlock:
+        return while_block(node)
+    elif t == CForBlock:
+        return for_block(node)
+    elif t == Return:
+        if node.val == None:
+            return lambda c: ('void', None)
+        return expression(node.val)
+    elif t == NoOperation:
+        return lambda c: None
+
+    return node.execute
+
+def block(statements):
+    if len(statements) == 1:
+        return statements[0]
+
+    def f(c):
+        for i in statements:
+            v = i(c)
+            if v != None:
+                return v
+
+    return f
+
+def condition(node, expr):
+    cond = expression(expr)
+    msg = CONDITION_ERRORS[type(node)]
+
+    def f(c):
+        et, ev = cond(c)
+        if et != 'bool':
+            raise KyazukenError(msg)
+        return ev
+
+    return f
+
+def variable_definition(node):
+    value = expression(node.expr)
+    slot = node.slot
+    _type = node.type
+
+    def f(c):
+        tv = value(c)
+        if tv[0] != _type:
+            if not is_subclass_instance(_type, tv[1]):
+                raise KyazukenError('Attempted to assign a ' + str(tv[0]) + ' to new variable of type ' + str(_type))
+            tv = (_type, tv[1])
+        c.slots[slot] = tv
+
+    return f
+
+def if_block(node):
+    cond = condition(node, node.condition)
+    body = statement(node.statement)
+
+    def f(c):
+        if cond(c):
+            return body(c)
+
+    return f
+
+def if_else_block(node):
+    cond = condition(node, node.condition)
+    body = statement(node.statement)
+    else_body = statement(node.else_statement)
+
+    def f(c):
+        if cond(c):
+            return body(c)
+        else:
+            return else_body(c)
+
+    return f
+
+def while_block(node):
+    cond = condition(node, node.condition)
+    body = statement(node.statement)
+
+    def f(c):
+        while cond(c):
+            v = body(c)
+            if v != None:
+                return v
+
+    return f
+
+def for_block(node):
+    init = statement(node.loop_init)
+    cond = condition(node, node.loop_condition)
+    end = expression(node.loop_end)
+    body = statement(node.loop_code)
+
+    def f(c):
+        v = init(c)
+        if v != None:
+            return v
+
+        while cond(c):
+            v = body(c)
+            if v != None:
+                return v
+
+            end(c)
+
+    return f
+
+def compile_function(f):
+    body = block([statement(i) for i in f.statements])
+    argtypes = [i.type for i in f.params]
+    nslots = f.nslots
+
+    def call(environment, arguments):
+        context = Context(environment, nslots)
+        context.slots[:len(argtypes)] = zip(argtypes, arguments)
+
+        v = body(context)
+        if v != None:
+            return v
+
+        return 'void', None
+
+    return call
+
+def install(functions):
+    for f in functions:
+        if not hasattr(f, 'closure'):
+            f.closure = compile_function(f)
+            f.call = f.closure
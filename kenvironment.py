@@ -1,5 +1,32 @@
 from klang import *
 import klib
+import kcheck
+import kmetrics
+import kopt
+import kvm
+import kclosure
+import kstack
+import ktranspile
+
+# Execution engines other than the tree-walker.  Each one takes the functions of a program
+# and replaces Function.call on those it is able to handle.
+ENGINES = {
+    'tree': None,
+    'vm': kvm.install,
+    'stack': kstack.install,
+    'closure': kclosure.install,
+    'transpile': ktranspile.install
+    }
+
+# What the engines store on the functions they install themselves on
+ENGINE_ATTRIBUTES = ['call', 'code', 'stack_code', 'closure', 'tree_call']
+
+def reset_engines(functions):
+    # Puts functions back on the tree-walker, so they get compiled again against the
+    # targets the next check binds
+    for f in functions:
+        for i in ENGINE_ATTRIBUTES:
+            f.__dict__.pop(i, None)
 
 class KyazukenEnvironment:
     def __init__(self, functions, classes):
@@ -18,7 +45,18 @@ class KyazukenEnvironment:
         return f
 
     def get_class(self, name):
-        return self.classes[name]
+        if name in self.classes:
+            return self.classes[name]
+        elif name in native_classes:
+            return native_classes[name]
+        raise KyazukenError("Class '" + name + "' does not exist")
+
+    def code_objects(self):
+        # Every function, method and constructor with a Kyazuken body
+        code = [i for i in self.functions.values() if not isinstance(i, PyFunctionWrapper)]
+        for i in self.classes.values():
+            code += list(i.con.values()) + list(i.func.values())
+        return code
 
 VarDec = VariableDeclaration
 
@@ -28,32 +66,67 @@ class KyazukenDocument:
         self.classes = {}
         self.entry = None
         self.imports = []
-    def execute(self, environment, argv = []):
-        if len(self.entry.args) == 1:
-            self.entry.call(environment, [ArrayObject('String', argv)])
-        else:
-            self.entry.call(environment, [])
+    def execute(self, environment, argv = [], engine = 'tree', profiler = None):
+        if ENGINES[engine] != None:
+            ENGINES[engine](self.code_objects(environment))
+
+        # Metrics and the profiler go over whatever the engine installed
+        kmetrics.install(self.code_objects(environment))
+        if profiler != None:
+            profiler.install(self.code_objects(environment))
+            profiler.start()
+
+        try:
+            with kmetrics.phase('execute'):
+                if len(self.entry.args) == 1:
+                    self.entry.call(environment, [ArrayObject('String', argv)])
+                else:
+                    self.entry.call(environment, [])
+        finally:
+            # Asynchronous operations end with the program
+            klib.event_loop.stop()
+
+            # Output of the program comes before any error reported about it
+            klib.stdout.flush()
+
+            if profiler != None:
+                profiler.stop()
+                profiler.uninstall()
+
+    def code_objects(self, environment):
+        # The code of the environment and main, if the document has one
+        code = environment.code_objects()
+        if self.entry != None:
+            code.append(self.entry)
+        return code
+
+    def optimize(self, environment, passes = None):
+        kopt.optimize(self.code_objects(environment), passes)
+
+    def check(self, environment):
+        # Type-check and bind call sites to their targets; returns the errors found
+        return kcheck.check(environment, self.code_objects(environment))
 
     def update_dicts(self, funcs, classes):
         funcs.update(self.functions)
         classes.update(self.classes)
 
     def make_default_env(self):
+        with kmetrics.phase('make_default_env'):
+            # Set up base environment
+            functions = {}
+            classes = {}
+            klib.add_functions(functions)
 
-        # Set up base environment
-        functions = {}
-        classes = {}
-        klib.add_functions(functions)
-
-        # Add functions and classes from imported files
-        for i in self.imports:
-            i.update_dicts(functions, classes)
+            # Add functions and classes from imported files
+            for i in self.imports:
+                i.update_dicts(functions, classes)
 
-        # Add functions and classes from this document
-        self.update_dicts(functions, classes)
+            # Add functions and classes from this document
+            self.update_dicts(functions, classes)
 
-        # Create the environment
-        return KyazukenEnvironment(functions, classes)
+            # Create the environment
+            return KyazukenEnvironment(functions, classes)
 
     def add_imported_document(self, imported):
         self.imports.append(imported)
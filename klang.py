@@ -1,3 +1,10 @@
+KYAZUKEN_VERSION = '0.1'
+
+import operator
+
+import karray
+
+from functools import partial
 
 op_to_opname = {
     '+' : 'ps',
@@ -97,6 +104,121 @@ class KyazukenError(Exception):
     def __str__(self):
         return self.message
 
+def default_value(_type):
+    if type(_type) == str:
+        if _type.startswith('int') or _type.startswith('uint'):
+            return 0
+        elif _type.startswith('float'):
+            return 0.0
+        elif _type == 'bool':
+            return False
+
+    return None
+
+def _is_int(t):
+    return type(t) == str and (t.startswith('int') or t.startswith('uint'))
+
+def _op_add(ta, a, tb, b):
+    if ta == 'String' or tb == 'String':
+        return 'String', str(a) + str(b)
+    return ta, a + b
+
+def _op_div(ta, a, tb, b):
+    if _is_int(ta) and _is_int(tb):
+        return ta, a // b
+    return ta, a / b
+
+def _int_only(f):
+    def op(ta, a, tb, b):
+        if _is_int(ta) and _is_int(tb):
+            return ta, f(a, b)
+        raise KyazukenError("Invalid operation: " + str(ta) + ' ' + op.symbol + ' ' + str(tb))
+    op.apply = f
+    op.integers = True
+    return op
+
+def _arith(f):
+    op = lambda ta, a, tb, b: (ta, f(a, b))
+    op.apply = f
+    return op
+
+def _compare(f):
+    op = lambda ta, a, tb, b: ('bool', f(a, b))
+    # Comparisons always produce a bool, engines may call the plain function directly
+    op.compare = f
+    return op
+
+# Implementation of every binary operator, shared by all execution engines.  Each one takes
+# the types and values of both operands and returns the (type, value) of the result.
+BINARY_OPERATIONS = {
+    '+' : _op_add,
+    '-' : _arith(lambda a, b: a - b),
+    '*' : _arith(lambda a, b: a * b),
+    '/' : _op_div,
+    '%' : _arith(lambda a, b: a % b),
+    '&' : _int_only(lambda a, b: a & b),
+    '|' : _int_only(lambda a, b: a | b),
+    '^' : _int_only(lambda a, b: a ^ b),
+    '<<' : _int_only(lambda a, b: a << b),
+    '>>' : _int_only(lambda a, b: a >> b),
+    '==' : _compare(lambda a, b: a == b),
+    '!=' : _compare(lambda a, b: a != b),
+    '<' : _compare(lambda a, b: a < b),
+    '>' : _compare(lambda a, b: a > b),
+    '<=' : _compare(lambda a, b: a <= b),
+    '>=' : _compare(lambda a, b: a >= b),
+    '&&' : _compare(lambda a, b: a and b),
+    '||' : _compare(lambda a, b: a or b),
+    '^^' : _compare(lambda a, b: bool(a) != bool(b))
+    }
+
+for _symbol, _operation in BINARY_OPERATIONS.items():
+    _operation.symbol = _symbol
+
+# Compound assignments and the operator they apply before storing the result
+ASSIGNMENT_OPERATORS = {
+    '+=' : '+',
+    '-=' : '-',
+    '*=' : '*',
+    '/=' : '/',
+    '<<=' : '<<',
+    '>>=' : '>>'
+    }
+
+# Operators whose right operand is only evaluated when the left one does not decide the
+# result.  Their entries in BINARY_OPERATIONS give the same result from both values.
+LOGICAL_OPERATORS = ('&&', '||')
+
+def binary_operation(op, ta, a, tb, b):
+    if not op in BINARY_OPERATIONS:
+        raise KyazukenError("Invalid operation: " + str(ta) + ' ' + op + ' ' + str(tb))
+    return BINARY_OPERATIONS[op](ta, a, tb, b)
+
+def _concat(a, b):
+    return str(a) + str(b)
+
+def static_operation(op, ta, tb):
+    # Counterpart of binary_operation for operands of known types: returns the type of the
+    # result and the function computing it from the bare values
+    if not op in BINARY_OPERATIONS:
+        raise KyazukenError("Invalid operation: " + str(ta) + ' ' + op + ' ' + str(tb))
+
+    operation = BINARY_OPERATIONS[op]
+    integers = _is_int(ta) and _is_int(tb)
+
+    if hasattr(operation, 'compare'):
+        return 'bool', operation.compare
+    elif op == '+':
+        if ta == 'String' or tb == 'String':
+            return 'String', _concat
+        return ta, operator.add
+    elif op == '/':
+        return ta, operator.floordiv if integers else operator.truediv
+    elif getattr(operation, 'integers', False) and not integers:
+        raise KyazukenError("Invalid operation: " + str(ta) + ' ' + op + ' ' + str(tb))
+
+    return ta, operation.apply
+
 class KyazukenClass:
     def __init__(self, name):
         self.name = name
@@ -105,64 +227,179 @@ class KyazukenEntryPoint:
     def __init__(self, lines):
         self.lines = lines
 
+# Method tables of the builtin types by type name, see method_table
+native_types = {}
+
+# Builtin types new can build by type name, see NativeClass
+native_classes = {}
+
 class KyazukenObject:
-    def __init__(self):
-        self.functions = {}
+    # Base of the builtin objects.  Their methods are NativeMethods in one table per type
+    # shared by all its objects, objects only carry their own state.
+    __slots__ = ()
+
+    methods = {}
 
     def get_function(self, context, name, arg_types):
         sig = name_and_argtypes_to_signature(name, arg_types)
 
-        if not sig in self.functions:
-            raise KyazukenError(str(self) + " has no member " + name + " with arguments " + arg_types)
+        f = self.methods.get(sig)
+        if f is None:
+            raise KyazukenError(str(self) + " has no member " + name + " with arguments " + str(arg_types))
+
+        return f
 
-        return self.functions[sig]
+class KyazukenInstance:
+    # Base of the types ClassDefinition.make_layout creates, one per class, with one
+    # __slots__ entry per field in layout order.  Instances carry no dict, only their fields.
+    __slots__ = ()
 
-    def add_function(self, f):
-        self.functions[f.signature()] = f
+    def sub(self, name):
+        _class = self._class
+        if not name in _class.offsets:
+            raise KyazukenError(_class.name + " has no member " + name)
+
+        i = _class.offsets[name]
+        return _class.field_types[i], _class.descriptors[i].__get__(self)
+
+    def assign_sub(self, context, name, _type, val):
+        _class = self._class
+        if not name in _class.offsets:
+            raise KyazukenError(_class.name + " has no member " + name)
+
+        i = _class.offsets[name]
+        if _class.field_types[i] != _type and not is_subclass_instance(_class.field_types[i], val):
+            raise KyazukenError(f'Attempted to assign value of type {_type} to field {name} of type {_class.field_types[i]}')
+        _class.descriptors[i].__set__(self, val)
+
+    def get_function(self, context, name, arg_types):
+        return self._class.get_method(name, arg_types)
+
+def is_subclass_instance(vartype, value):
+    # Instances of a class can be stored where one of its ancestors is expected
+    return isinstance(value, KyazukenInstance) and vartype in value._class.ancestors
+
+def get_method(environment, receiver, name, argtypes):
+    # Method of a Kyazuken instance or builtin object, taking the receiver as first
+    # argument.  Strings are Python strs.
+    if receiver is None:
+        raise KyazukenError('Attempted to call ' + name + ' on null')
+
+    if type(receiver) == str:
+        sig = name_and_argtypes_to_signature(name, argtypes)
+        if not sig in native_types['String']:
+            raise KyazukenError("String has no member " + name + " with arguments " + str(argtypes))
+        return native_types['String'][sig]
+
+    return receiver.get_function(environment, name, argtypes)
+
+def call_method(environment, receiver, name, argtypes, values):
+    f = get_method(environment, receiver, name, argtypes)
+    return f.call(environment, [receiver] + values)
+
+def construct(environment, _class, argtypes, values):
+    f = _class.get_constructor(argtypes)
+    obj = _class.instantiate(environment)
+
+    if f != None:
+        f.call(environment, [obj] + values)
+    return _class.name, obj
+
+def call_virtual(environment, node, receiver, values):
+    # Method call the checker bound to vtable slot node.vslot of the receiver's static
+    # class.  Instances of that class or of a subclass pass the guard and index their own
+    # vtable, anything else (null, ...) takes the generic path.
+    if isinstance(receiver, node.vguard):
+        return receiver._class.vtable[node.vslot].call(environment, [receiver] + values)
+    return call_method(environment, receiver, node.func.sub, node.argtypes, values)
+
+def char_code(s, i):
+    # Code of character i of a String.  Negative indices are out of range, not counted
+    # from the end.
+    if i < 0 or i >= len(s):
+        raise KyazukenError('Index ' + str(i) + ' out of range for a String of length ' + str(len(s)))
+    return ord(s[i])
+
+def get_item(value, i):
+    # Element i of an array, or the code of character i of a String
+    if type(value) == str:
+        return 'int32', char_code(value, i)
+    return value.getitem(i)
+
+def null_member(name):
+    return KyazukenError('Attempted to access member ' + name + ' of null')
+
+# Content of a slot of a typed frame before its variable is declared
+UNSET = object()
+
+class Expression:
+    # Type recorded by the checker, None if it is only known at run time
+    static_type = None
+
+    # Expressions used as statements are evaluated for their side effects only
+    def execute(self, context):
+        self.eval(context)
 
-        # Tell the function it belongs to a class
-        f.this = self
+    # Functions the checker marked typed run on bare values: expressions compute() their
+    # value without its type, statements run() instead of execute()
+    def run(self, context):
+        self.compute(context)
 
 class ImportStatement:
     def __init__(self, path, commonname):
         self.commonname = commonname
         self.path = path
 
-class Store:
+class Store(Expression):
     def __init__(self, obj, expr):
         self.obj = obj
         self.expr = expr
 
-    def execute(self, context):
+    def eval(self, context):
         t, v = self.expr.eval(context)
 
-        return self.obj.assign(context, t, v)
-    
+        self.obj.assign(context, t, v)
+        return t, v
+
+    def compute(self, context):
+        v = self.expr.compute(context)
+
+        self.obj.assign_value(context, v)
+        return v
 
 class Constructor:
     def __init__(self, name, args, statements):
         self.name = name
         self.args = args
         self.statements = statements
+
+        # Variables filled from the arguments of a call, 'this' first for class members
+        self.params = args
+
+        # Frame size, set by the resolver
+        self.nslots = None
     def signature(self):
         return class_and_argtypes_to_signature(self.name, [i.type for i in self.args])
 
     def call(self, environment, arguments):
 
-        argdict = {}
-        argtypes = {}
-        for i in self.args:
-            argdict[i.name] = arguments.pop(0)
-            argtypes[i.name] = i.type
+        context = Context(environment, self.nslots)
+        slots = context.slots
+        for i, arg in enumerate(self.params):
+            slots[i] = (arg.type, arguments[i])
 
-        context = Context(environment, argtypes, argdict)
         for i in self.statements:
-            i.execute(context)
+            v = i.execute(context)
+
+            if v != None:
+                return v
+
+        return 'void', None
 
     def head_str(self):
         return self.name + '(' + ', '.join([str(i) for i in self.args]) + ')'
 
-class Literal:
+class Literal(Expression):
     def __init__(self, _type: str, value):
         self.type = _type
         self.value = value
@@ -170,38 +407,84 @@ class Literal:
     def eval(self, env):
         return self.type, self.value
 
+    def compute(self, context):
+        return self.value
+
     def get_type(self):
         return self.type
 
-class FunctionCall:
+class FunctionCall(Expression):
     def __init__(self, func, args : tuple):
         self.func = func
         self.args = args
 
+        # Function bound at link time, if the call could be resolved statically
+        self.target = None
+
+        # Static argument types of a method call, set by the checker
+        self.argtypes = None
+
+        # Vtable slot of a method call and the instance type of the receiver's static
+        # class guarding it, set by the checker
+        self.vslot = None
+        self.vguard = None
+
+        # NativeMethod of a call on a builtin type, set by the checker.  The receiver is
+        # evaluated first and passed as first argument.
+        self.method = None
+
     def eval(self, context):
+        if self.method != None:
+            receiver = self.func.src.eval(context)[1]
+            return self.method.call(context.env, [receiver] + [i.eval(context)[1] for i in self.args])
+
         args = [i.eval(context) for i in self.args]
 
+        if self.target != None:
+            return self.target.call(context.env, [i[1] for i in args])
+
+        if type(self.func) == Member:
+            et, ev = self.func.src.eval(context)
+            if self.vslot != None:
+                return call_virtual(context.env, self, ev, [i[1] for i in args])
+            return call_method(context.env, ev, self.func.sub, [i[0] for i in args], [i[1] for i in args])
+
         f = self.func.get_function(context, [i[0] for i in args])
-        return f.call(context, [i[1] for i in args])
+        return f.call(context.env, [i[1] for i in args])
 
-    def execute(self, context):
-        self.eval(context)
+    def compute(self, context):
+        if self.method != None:
+            receiver = self.func.src.compute(context)
+            return self.method.call(context.env, [receiver] + [i.compute(context) for i in self.args])[1]
+
+        args = [i.compute(context) for i in self.args]
+
+        if self.target != None:
+            return self.target.call(context.env, args)[1]
 
-class NewObject:
+        receiver = self.func.src.compute(context)
+        if self.vslot != None:
+            return call_virtual(context.env, self, receiver, args)[1]
+        return call_method(context.env, receiver, self.func.sub, self.argtypes, args)[1]
+
+class NewObject(Expression):
     def __init__(self, name, args):
         self.name = name
         self.args = args
 
+        # Static argument types, set by the checker
+        self.argtypes = None
+
     def eval(self, context):
         _class = context.get_class(self.name)
 
         args = [i.eval(context) for i in self.args]
 
-        f = _class.get_constructor([i[0] for i in args])
-        return f.call(context, [i[1] for i in args])
+        return construct(context.env, _class, [i[0] for i in args], [i[1] for i in args])
 
-    def execute(self, context):
-        self.eval(context)
+    def compute(self, context):
+        _class = context.get_class(self.name)
+        return construct(context.env, _class, self.argtypes, [i.compute(context) for i in self.args])[1]
 
 class StatementList:
     def __init__(self, statements):
@@ -214,6 +497,13 @@ class StatementList:
             if v != None:
                 return v
 
+    def run(self, context):
+        for i in self.statements:
+            v = i.run(context)
+
+            if v != None:
+                return v
+
 class IfBlock:
     def __init__(self, condition, statement):
         self.condition = condition
@@ -225,6 +515,10 @@ class IfBlock:
         if ev:
             return self.statement.execute(context)
 
+    def run(self, context):
+        if self.condition.compute(context):
+            return self.statement.run(context)
+
 class IfElseBlock:
     def __init__(self, condition, statement, else_statement):
         self.condition = condition
@@ -240,13 +534,19 @@ class IfElseBlock:
         else:
             return self.else_statement.execute(context)
 
+    def run(self, context):
+        if self.condition.compute(context):
+            return self.statement.run(context)
+        else:
+            return self.else_statement.run(context)
+
 class WhileBlock:
     def __init__(self, condition, statement):
         self.condition = condition
         self.statement = statement
     def execute(self, context):
         while True:
-            et, ev = self.iterable.eval(context)
+            et, ev = self.condition.eval(context)
 
             if et != 'bool':
                 raise KyazukenError('Invalid expression for while block: must evaluate to a bool')
@@ -257,6 +557,12 @@ class WhileBlock:
             if v != None:
                 return v
 
+    def run(self, context):
+        while self.condition.compute(context):
+            v = self.statement.run(context)
+            if v != None:
+                return v
+
 class IterForBlock:
     def __init__(self, vardec, iterable, statement):
         self.vardec = vardec
@@ -269,9 +575,9 @@ class IterForBlock:
             if val == None:
                 return
 
-            mini_context = Context(context, {self.vardec.name: self.vardec.type}, {self.vardec.name: val})
+            context.mkvar(self.vardec.slot, self.vardec.type, val)
 
-            v = self.statement.execute(mini_context)
+            v = self.statement.execute(context)
             if v != None:
                 return v
 
@@ -282,26 +588,43 @@ class CForBlock:
         self.loop_end = loop_end
         self.loop_code = loop_code
     def execute(self, context):
-
-        loop_context = Context(context, {}, {})
-
-        v = self.loop_init(loop_context)
+        # The loop's own variables have their own slots in the function's frame
+        v = self.loop_init.execute(context)
         if v != None:
             return v
         
         while True:
-            et, ev = self.loop_condition.eval(loop_context)
+            et, ev = self.loop_condition.eval(context)
 
             if et != 'bool':
                 raise KyazukenError('Invalid expression for a for block: must evaluate to a bool')
             if not ev:
                 break
 
-            v = self.loop_code.execute(loop_context)
+            v = self.loop_code.execute(context)
+            if v != None:
+                return v
+
+            self.loop_end.eval(context)
+
+    def run(self, context):
+        v = self.loop_init.run(context)
+        if v != None:
+            return v
+
+        while self.loop_condition.compute(context):
+            v = self.loop_code.run(context)
             if v != None:
                 return v
 
-            self.loop_end.eval(loop_context)
+            self.loop_end.compute(context)
+
+CONDITION_ERRORS = {
+    IfBlock: 'Invalid expression for if block: must evaluate to a bool',
+    IfElseBlock: 'Invalid expression for if/else block: must evaluate to a bool',
+    WhileBlock: 'Invalid expression for while block: must evaluate to a bool',
+    CForBlock: 'Invalid expression for a for block: must evaluate to a bool'
+    }
 
 class ExitBlock:
     def __init__(self, code):
@@ -314,15 +637,23 @@ class ArrayType:
     def __str__(self):
         return str(self.basetype) + '[]'
 
+    def __eq__(self, other):
+        return type(other) == ArrayType and self.basetype == other.basetype
+
+    def __hash__(self):
+        return hash(self.basetype) + 1
+
 class ArrayObject(KyazukenObject):
-    def __init__(self, basetype, data):
-        super().__init__()
+    # Numeric elements are kept in a typed buffer, see karray
+    __slots__ = ('type', 'data')
 
+    def __init__(self, basetype, data):
         self.type = basetype
-        self.data = data
+        self.data = karray.make_storage(basetype, data)
 
-        # Add functions
-        self.add_function(PyFunctionWrapper('length', 'int', [], self.length))
+    @property
+    def methods(self):
+        return array_methods(self.type)
 
     def length(self):
         return len(self.data)
@@ -331,16 +662,145 @@ class ArrayObject(KyazukenObject):
         return self.type, self.data[i]
 
     def setitem(self, i, _type, value):
-        if _type == self.type:
-            self.data[i] = value
+        if _type == self.type or is_subclass_instance(self.type, value):
+            self.store(i, value)
         else:
             raise KyazukenError("Cannot assign " + str(_type) + " to " + str(ArrayType(self.type)))
-    
+
+    def store(self, i, value):
+        try:
+            self.data[i] = value
+        except OverflowError:
+            self.data[i] = karray.make_storage(self.type, [value])[0]
+
+    def fill(self, value):
+        karray.fill(self.data, value)
+
+    def copy(self):
+        return ArrayObject(self.type, self.data[:])
+
+    def copy_from(self, src):
+        if len(src.data) > len(self.data):
+            raise KyazukenError("Cannot copy " + str(len(src.data)) + " elements into an array of length " + str(len(self.data)))
+        self.data[:len(src.data)] = src.data
+
+    def slice(self, start, end):
+        return ArrayObject(self.type, self.data[start:end])
+
+    def _other(self, op, other):
+        # Operand of an element-wise operation, which needs an array of the same numeric
+        # type and length
+        if type(other) != ArrayObject or other.type != self.type or not karray.is_numeric(self.type):
+            raise KyazukenError("Invalid operation: " + str(ArrayType(self.type)) + ' ' + op + ' ' + str(getattr(other, 'type', other)))
+        if len(other.data) != len(self.data):
+            raise KyazukenError("Array lengths differ: " + str(len(self.data)) + " and " + str(len(other.data)))
+        return other.data
+
+    def elementwise(self, op, other):
+        result = ArrayObject(self.type, [])
+        result.data = karray.elementwise(op, self.data, self._other(op, other))
+        return result
+
+    def compare(self, op, other):
+        return ArrayObject('bool', karray.compare(op, self.data, self._other(op, other)))
+
+    def __add__(self, other):
+        return self.elementwise('+', other)
+
+    def __sub__(self, other):
+        return self.elementwise('-', other)
+
+    def __mul__(self, other):
+        return self.elementwise('*', other)
+
+    def __truediv__(self, other):
+        return self.elementwise('/', other)
+
+    __floordiv__ = __truediv__
+
+    def __mod__(self, other):
+        return self.elementwise('%', other)
+
+def _array_compare(op, array, other):
+    return array.compare(op, other)
+
+# Method tables of arrays by element type
+_array_methods = {}
+
+def array_methods(basetype):
+    # Made the first time an array of basetype needs one
+    table = _array_methods.get(basetype)
+    if table is None:
+        arraytype = ArrayType(basetype)
+        methods = [
+            NativeMethod('length', 'int32', [], ArrayObject.length),
+            NativeMethod('fill', 'void', [VariableDeclaration('value', basetype)], ArrayObject.fill),
+            NativeMethod('copy', arraytype, [], ArrayObject.copy),
+            NativeMethod('copyFrom', 'void', [VariableDeclaration('src', arraytype)], ArrayObject.copy_from),
+            NativeMethod('slice', arraytype, [VariableDeclaration('start', 'int32'), VariableDeclaration('end', 'int32')], ArrayObject.slice)
+            ]
+        for op, name in [('==', 'eq'), ('!=', 'ne'), ('<', 'lt'), ('>', 'gt'), ('<=', 'le'), ('>=', 'ge')]:
+            methods.append(NativeMethod(name, ArrayType('bool'), [VariableDeclaration('other', arraytype)], partial(_array_compare, op)))
+
+        table = _array_methods[basetype] = method_table(methods)
+    return table
+
+class NewArray(Expression):
+    def __init__(self, basetype, size):
+        self.basetype = basetype
+        self.size = size
+
+    def eval(self, context):
+        st, sv = self.size.eval(context)
+        if not _is_int(st):
+            raise KyazukenError("Array size must be an integer, not " + str(st))
+
+        return ArrayType(self.basetype), new_array(self.basetype, sv)
+
+    def compute(self, context):
+        return new_array(self.basetype, self.size.compute(context))
+
+def new_array(basetype, n):
+    # An array of n default values of its type
+    if n < 0:
+        raise KyazukenError("Negative array size: " + str(n))
+
+    array = ArrayObject(basetype, [])
+    array.data = karray.filled(basetype, default_value(basetype), n)
+    return array
+
+class ArrayInitializer(Expression):
+    def __init__(self, items):
+        self.items = items
+
+    def eval(self, context):
+        return make_array([i.eval(context) for i in self.items])
+
+    def compute(self, context):
+        return ArrayObject(self.static_type.basetype, [i.compute(context) for i in self.items])
+
+def make_array(items):
+    if len(items) == 0:
+        raise KyazukenError("Cannot infer the type of an empty array")
+
+    basetype = items[0][0]
+    for t, v in items:
+        if t != basetype:
+            raise KyazukenError("Array elements must all be of type " + str(basetype) + ", found " + str(t))
+
+    return ArrayType(basetype), ArrayObject(basetype, [v for t, v in items])
 
 class VariableDeclaration:
     def __init__(self, name, _type):
         self.name = name
         self.type = _type
+        self.slot = None
+
+    def execute(self, context):
+        context.mkvar(self.slot, self.type, default_value(self.type))
+
+    def run(self, context):
+        context.slots[self.slot] = default_value(self.type)
 
     def __str__(self):
         return str(self.type) + ' ' + self.name
@@ -350,15 +810,19 @@ class VariableDefinition:
         self.name = name
         self.type = _type
         self.expr = value_expr
+        self.slot = None
 
     def execute(self, context):
         t, v = self.expr.eval(context)
 
-        if t != self.type:
+        if t != self.type and not is_subclass_instance(self.type, v):
             raise KyazukenError('Attempted to assign a ' + str(t) + ' to new variable of type ' + str(self.type))
-        context.mkvar(self.name, t, v)
+        context.mkvar(self.slot, self.type, v)
+
+    def run(self, context):
+        context.slots[self.slot] = self.expr.compute(context)
 
-class Subscript:
+class Subscript(Expression):
     def __init__(self, src, idx):
         self.src = src
         self.idx = idx
@@ -370,7 +834,7 @@ class Subscript:
         if not it.startswith('int'):
             raise KyazukenError("Failed: attempted subscript of " + str(self.src) + ' using type ' + str(it))
 
-        return sv.getitem(iv)
+        return get_item(sv, iv)
 
     def assign(self, context, _type, val):
         st, sv = self.src.eval(context)
@@ -379,22 +843,43 @@ class Subscript:
         if not it.startswith('int'):
             raise KyazukenError("Failed: attempted subscript of " + str(self.src) + ' using type ' + str(it))
 
-        return sv.setitem(context, iv, _type, val)
+        return sv.setitem(iv, _type, val)
+
+    def compute(self, context):
+        src = self.src.compute(context)
+        if type(src) == str:
+            return char_code(src, self.idx.compute(context))
+        return src.data[self.idx.compute(context)]
 
-class Variable:
+    def assign_value(self, context, val):
+        self.src.compute(context).store(self.idx.compute(context), val)
+
+class Variable(Expression):
     def __init__(self, name):
         self.name = name
+        self.slot = None
 
     def eval(self, context):
-        return context.getvar(self.name)
+        return context.getvar(self.slot, self.name)
 
     def get_function(self, context, argtypes):
         return context.get_function(self.name, argtypes)
 
     def assign(self, context, _type, val):
-        return context.setvar(self.name, _type, val)
+        return context.setvar(self.slot, self.name, _type, val)
+
+    def compute(self, context):
+        v = context.slots[self.slot]
+        if v is UNSET:
+            raise KyazukenError('Variable \'' + self.name + '\' does not exist.')
+        return v
+
+    def assign_value(self, context, val):
+        if context.slots[self.slot] is UNSET:
+            raise KyazukenError('Variable \'' + self.name + '\' does not exist.')
+        context.slots[self.slot] = val
 
-class BinOp:
+class BinOp(Expression):
     def __init__(self, left, op, right):
         self.left = left
         self.op = op
@@ -402,34 +887,34 @@ class BinOp:
 
     def eval(self, context):
         ta, a = self.left.eval(context)
+        if self.op in LOGICAL_OPERATORS:
+            if bool(a) == (self.op == '||'):
+                return 'bool', a
+            return 'bool', self.right.eval(context)[1]
+
         tb, b = self.right.eval(context)
-        if tb.startswith('int') and tb.startswith('int'):
-            if self.op == '/':
-                return ta, a // b
-            elif self.op == '&':
-                return ta, a & b
-            elif self.op == '|':
-                return ta, a | b
-            elif self.op == '^':
-                return ta, a ^ b
-        if self.op == '+':
-            return ta, a + b
-        elif self.op == '-':
-            return ta, a - b
-        elif self.op == '*':
-            return ta, a * b
-        elif self.op == '/':
-            return ta, a / b
-        elif self.op == '%':
-            return ta, a % b
-        elif self.op == '==':
-            return 'bool', a == b
-        elif self.op == '!=':
-            return 'bool', a != b
-        else:
-            raise KyazukenError("Invalid operation: " + str(ta) + ' ' + self.op + ' ' + str(tb))
 
-class UniOp:
+        if self.op in ASSIGNMENT_OPERATORS:
+            t, v = binary_operation(ASSIGNMENT_OPERATORS[self.op], ta, a, tb, b)
+            self.left.assign(context, t, v)
+            return t, v
+
+        return binary_operation(self.op, ta, a, tb, b)
+
+    def compute(self, context):
+        if self.op == '&&':
+            return self.left.compute(context) and self.right.compute(context)
+        elif self.op == '||':
+            return self.left.compute(context) or self.right.compute(context)
+
+        # The checker stored the operation matching the types of both operands
+        v = self.operation(self.left.compute(context), self.right.compute(context))
+
+        if self.op in ASSIGNMENT_OPERATORS:
+            self.left.assign_value(context, v)
+        return v
+
+class UniOp(Expression):
     def __init__(self, left, op):
         self.left = left
         self.op = op
@@ -445,7 +930,12 @@ class UniOp:
 
         return et, ev
 
-class PreIncDec:
+    def compute(self, context):
+        if self.op == '!':
+            return not self.left.compute(context)
+        return -self.left.compute(context)
+
+class PreIncDec(Expression):
     def __init__(self, obj, op):
         self.obj = obj
         self.op = op
@@ -463,7 +953,12 @@ class PreIncDec:
 
         return et, ev
 
-class PostIncDec:
+    def compute(self, context):
+        v = self.obj.compute(context) + (1 if self.op == '++' else -1)
+        self.obj.assign_value(context, v)
+        return v
+
+class PostIncDec(Expression):
     def __init__(self, obj, op):
         self.obj = obj
         self.op = op
@@ -481,6 +976,11 @@ class PostIncDec:
 
         return et, ev
 
+    def compute(self, context):
+        v = self.obj.compute(context)
+        self.obj.assign_value(context, v + (1 if self.op == '++' else -1))
+        return v
+
 class Return:
     def __init__(self, val = None):
         self.val = val
@@ -488,24 +988,58 @@ class Return:
         if self.val != None:
             return self.val.eval(context)
         else:
-            return None, None
+            return 'void', None
+
+    def run(self, context):
+        if self.val != None:
+            return self.val.static_type, self.val.compute(context)
+        else:
+            return 'void', None
 
 class NoOperation:
     def execute(self, context):
-        return None, None
+        return None
+
+    def run(self, context):
+        return None
 
-class Member:
+class Member(Expression):
     def __init__(self, src, sub):
         self.src = src
         self.sub = sub
+
+        # Slot descriptor and type of the field when the class of src is known statically
+        self.descriptor = None
+        self.field_type = None
     def eval(self, context):
         et, ev = self.src.eval(context)
+        if ev is None:
+            raise null_member(self.sub)
 
+        if self.descriptor != None:
+            return self.field_type, self.descriptor.__get__(ev)
         return ev.sub(self.sub)
     def assign(self, context, _type, val):
         et, ev = self.src.eval(context)
+        if ev is None:
+            raise null_member(self.sub)
+
+        if self.descriptor != None and (_type == self.field_type or is_subclass_instance(self.field_type, val)):
+            self.descriptor.__set__(ev, val)
+        else:
+            ev.assign_sub(context, self.sub, _type, val)
+
+    def compute(self, context):
+        ev = self.src.compute(context)
+        if ev is None:
+            raise null_member(self.sub)
+        return self.descriptor.__get__(ev)
 
-        ev.assign_sub(context, self.sub, _type, val)
+    def assign_value(self, context, val):
+        ev = self.src.compute(context)
+        if ev is None:
+            raise null_member(self.sub)
+        self.descriptor.__set__(ev, val)
 
     def get_function(self, context, arg_types):
         et, ev = self.src.eval(context)
@@ -518,6 +1052,15 @@ class Function:
         self.args = args
         self.statements = statements
         self._class = None
+
+        # Variables filled from the arguments of a call, 'this' first for methods
+        self.params = args
+
+        # Frame size, set by the resolver
+        self.nslots = None
+
+        # Set by the checker when the type of every expression is known statically
+        self.typed = False
     def signature(self):
         argtypes = [i.type for i in self.args]
 
@@ -526,17 +1069,38 @@ class Function:
         else:
             return name_class_and_argtypes_to_signature(self._class.name, self.name, argtypes)
 
+    def method_key(self):
+        # Signature without the class, shared by a method and its overrides
+        return name_and_argtypes_to_signature(self.name, [i.type for i in self.args])
+
     def call(self, environment, arguments):
+        if self.typed:
+            return self.call_typed(environment, arguments)
+
+        context = Context(environment, self.nslots)
+        slots = context.slots
+        for i, arg in enumerate(self.params):
+            slots[i] = (arg.type, arguments[i])
+
+        for i in self.statements:
+            v = i.execute(context)
+
+            if v != None:
+                return v
 
-        argdict = {}
-        argtypes = {}
-        for i in self.args:
-            argdict[i.name] = arguments.pop(0)
-            argtypes[i.name] = i.type
+        return 'void', None
+
+    def call_typed(self, environment, arguments):
+        context = Context(environment, self.nslots, UNSET)
+        context.slots[:len(arguments)] = arguments
 
-        context = Context(environment, argtypes, argdict)
         for i in self.statements:
-            i.execute(context)
+            v = i.run(context)
+
+            if v != None:
+                return v
+
+        return 'void', None
 
 class OperatorOverload(Function):
     def __init__(self, op, rettype, statements, arg = None):
@@ -547,7 +1111,28 @@ class OperatorOverload(Function):
     def signature(self):
         return operator_and_argtype_to_signature(self._class.name, self.op, self.arg)
 
+    def method_key(self):
+        return operator_and_argtype_to_signature('', self.op, None if self.arg is None else self.arg.type)
+
+def label(f):
+    # Name of a function in reports and error messages
+    if isinstance(f, OperatorOverload):
+        name = 'operator' + f.op
+    else:
+        name = str(f.name)
+
+    if isinstance(f, Constructor):
+        name += '.<init>'
+    elif f._class != None:
+        name = f._class.name + '.' + name
+
+    return name + '(' + ','.join(str(i.type) for i in f.args) + ')'
+
 class ClassDefinition:
+    # Name of the parent class, and the parent ClassDefinition once linked
+    inherited = None
+    parent = None
+
     def __init__(self, name, items):
         self.name = name
         self._handle_items(items)
@@ -567,9 +1152,11 @@ class ClassDefinition:
 
                 # set class for constructor so it can find it later
                 i._class = self
+                i.params = [VariableDeclaration('this', name)] + i.args
 
             elif isinstance(i, Function):
                 i._class = self
+                i.params = [VariableDeclaration('this', name)] + i.args
                 func[i.signature()] = i
             else:
                 raise Exception("INTERNAL ERROR: " + str(i))
@@ -577,9 +1164,103 @@ class ClassDefinition:
         self.func = func
         self.vars = var
 
+    def make_layout(self):
+        # Fixed layout of the instances, computed once at elaboration: field i lives in
+        # the i-th __slots__ entry of instance_type and is accessed through descriptors[i].
+        # A subclass starts with the layout of its parent, which must be laid out first,
+        # and its instance type derives from the parent's so the parent's descriptors
+        # work on it too.
+        parent = self.parent
+        fields = list(self.vars.values())
+        slots = tuple('f_' + self.name + '_' + i.name for i in fields)
+
+        if parent is None:
+            base = KyazukenInstance
+            self.offsets = {}
+            self.field_types = []
+            self.descriptors = []
+            self.defaults = []
+            self.initializers = []
+            self.ancestors = {self.name}
+        else:
+            base = parent.instance_type
+            self.offsets = dict(parent.offsets)
+            self.field_types = list(parent.field_types)
+            self.descriptors = list(parent.descriptors)
+            self.defaults = list(parent.defaults)
+            self.initializers = list(parent.initializers)
+            self.ancestors = parent.ancestors | {self.name}
+
+        self.instance_type = type(self.name, (base,), {'__slots__': slots, '_class': self})
+
+        # Literal initial values are stored as they are, other initializers run for
+        # every new instance
+        for i, slot in zip(fields, slots):
+            n = len(self.descriptors)
+            self.offsets[i.name] = n
+            self.field_types.append(i.type)
+            self.descriptors.append(self.instance_type.__dict__[slot])
+
+            if not isinstance(i, VariableDefinition):
+                self.defaults.append(default_value(i.type))
+            elif type(i.expr) == Literal and i.expr.type == i.type:
+                self.defaults.append(i.expr.value)
+            else:
+                self.defaults.append(None)
+                self.initializers.append((n, i))
+
+        self.make_vtable()
+
+    def make_vtable(self):
+        # Every method signature of the hierarchy has a fixed index: a subclass keeps the
+        # indices of its parent, its overrides replace the parent's entries and its new
+        # methods are appended
+        if self.parent is None:
+            self.vtable = []
+            self.vtable_index = {}
+        else:
+            self.vtable = list(self.parent.vtable)
+            self.vtable_index = dict(self.parent.vtable_index)
+
+        for f in self.func.values():
+            key = f.method_key()
+            if key in self.vtable_index:
+                self.vtable[self.vtable_index[key]] = f
+            else:
+                self.vtable_index[key] = len(self.vtable)
+                self.vtable.append(f)
+
+    def method_index(self, name, argtypes):
+        s = name_and_argtypes_to_signature(name, argtypes)
+
+        if not s in self.vtable_index:
+            raise KyazukenError(self.name + " has no member " + name + " with arguments " + str(argtypes))
+
+        return self.vtable_index[s]
+
+    def instantiate(self, environment):
+        obj = self.instance_type()
+        for descriptor, value in zip(self.descriptors, self.defaults):
+            descriptor.__set__(obj, value)
+
+        for n, i in self.initializers:
+            t, v = i.expr.eval(Context(environment, 0))
+            if t != i.type and not is_subclass_instance(i.type, v):
+                raise KyazukenError('Attempted to assign a ' + str(t) + ' to new variable of type ' + str(i.type))
+            self.descriptors[n].__set__(obj, v)
+
+        return obj
+
+    def get_method(self, name, argtypes):
+        return self.vtable[self.method_index(name, argtypes)]
+
     def get_constructor(self, argtypes):
         s = class_and_argtypes_to_signature(self.name, argtypes)
 
+        # Classes without constructors are built from their field initializers alone
+        if len(self.con) == 0 and len(argtypes) == 0:
+            return None
+
         if not s in self.con.keys():
             msg = 'No constructor for class ' + self.name + ' matches argument types ' + str(argtypes) + '\n'
             if len(self.con.keys()) == 0:
@@ -608,6 +1289,7 @@ class ClassDefinition:
 class ClassInheriting(ClassDefinition):
     def __init__(self, name, items, inherited):
         self.name = name
+        self.inherited = inherited
         self._handle_items(items)
 
     def __str__(self):
@@ -623,6 +1305,31 @@ class ClassInheriting(ClassDefinition):
         return s + '}\n'
 
 
+class SuperConstructor:
+    # ':(args);' in a constructor, runs the constructor of the parent class on 'this'
+    def __init__(self, args):
+        self.args = args
+
+        # Parent class, set by the resolver
+        self.parent = None
+
+        # Static argument types, set by the checker
+        self.argtypes = None
+
+    def execute(self, context):
+        if self.parent is None:
+            raise KyazukenError('Parent constructor called outside of a subclass constructor')
+
+        args = [i.eval(context) for i in self.args]
+        f = self.parent.get_constructor([i[0] for i in args])
+        if f != None:
+            f.call(context.env, [context.slots[0][1]] + [i[1] for i in args])
+
+    def run(self, context):
+        f = self.parent.get_constructor(self.argtypes)
+        if f != None:
+            f.call(context.env, [context.slots[0]] + [i.compute(context) for i in self.args])
+
 class PyFunctionWrapper(Function):
     def __init__(self, name, rettype, args, f):
         super().__init__(name, rettype, args, None)
@@ -630,31 +1337,82 @@ class PyFunctionWrapper(Function):
     def call(self, env, args):
         return self.rettype, self.f(*args)
 
+class NativeMethod(PyFunctionWrapper):
+    # Method of a builtin type, one for all the objects of the type: the receiver is the
+    # first argument
+    def call(self, env, args):
+        if args[0] is None:
+            raise KyazukenError('Attempted to call ' + self.name + ' on null')
+        return self.rettype, self.f(*args)
+
+def method_table(methods):
+    return {i.signature(): i for i in methods}
+
+class NativeClass:
+    # Builtin type built with new like a class: instantiate makes an empty object, and the
+    # constructor matching the arguments, a NativeMethod, sets it up.  User classes of the
+    # same name come first.
+    def __init__(self, name, instance_type, constructors):
+        self.name = name
+        self.instance_type = instance_type
+        self.con = {class_and_argtypes_to_signature(name, [j.type for j in i.args]): i for i in constructors}
+
+    def get_constructor(self, argtypes):
+        s = class_and_argtypes_to_signature(self.name, argtypes)
+        if not s in self.con:
+            msg = 'No constructor for ' + self.name + ' matches argument types ' + str(argtypes) + '\n'
+            msg += 'Note: available constructors:\n'
+            for i in self.con.values():
+                msg += '  ' + self.name + '(' + ', '.join([str(j) for j in i.args]) + ')\n'
+            raise KyazukenError(msg)
+        return self.con[s]
+
+    def instantiate(self, environment):
+        return self.instance_type.__new__(self.instance_type)
+
+def _substring(s, start, end = None):
+    if end is None:
+        end = len(s)
+    if start < 0 or end > len(s) or start > end:
+        raise KyazukenError('Substring ' + str(start) + ' to ' + str(end) + ' out of range for a String of length ' + str(len(s)))
+    return s[start:end]
+
+# Strings are Python strs, indexing one gives the code of a character
+native_types['String'] = method_table([
+    NativeMethod('length', 'int32', [], len),
+    NativeMethod('isspace', 'bool', [], str.isspace),
+    NativeMethod('strip', 'String', [], str.strip),
+    NativeMethod('substring', 'String', [VariableDeclaration('start', 'int32')], _substring),
+    NativeMethod('substring', 'String', [VariableDeclaration('start', 'int32'), VariableDeclaration('end', 'int32')], _substring)
+    ])
+
 class Context:
-    def __init__(self, env, var_types, var):
-        self.vars = var
-        self.var_types = var_types
+    # A function's frame: one (type, value) pair per slot assigned by the resolver,
+    # None for variables that have not been declared yet.  Frames of typed functions hold
+    # bare values and UNSET instead.
+    def __init__(self, env, nslots, empty = None):
+        self.slots = [empty] * nslots
         self.env = env
 
-    def getvar(self, name):
-        if not name in self.vars.keys():
+    def getvar(self, slot, name):
+        if slot is None or self.slots[slot] is None:
             raise KyazukenError('Variable \'' + name + '\' does not exist.')
 
-        return self.var_types[name], self.vars[name]
+        return self.slots[slot]
 
-    def setvar(self, name, _type, val):
-        if not name in self.vars.keys():
+    def setvar(self, slot, name, _type, val):
+        if slot is None or self.slots[slot] is None:
             raise KyazukenError('Variable \'' + name + '\' does not exist.')
 
-        if self.var_types[name] != _type:
-            msg = f'Attempted to assign value of type {_type} to variable of type {self.var_types[name]}'
+        vartype = self.slots[slot][0]
+        if vartype != _type and not is_subclass_instance(vartype, val):
+            msg = f'Attempted to assign value of type {_type} to variable of type {vartype}'
             raise KyazukenError(msg)
 
-        self.vars[name] = val
+        self.slots[slot] = (vartype, val)
 
-    def mkvar(self, vartype, varname, value):
-        self.vars[varname] = value
-        self.var_types[name] = vartype
+    def mkvar(self, slot, vartype, value):
+        self.slots[slot] = (vartype, value)
 
     def get_function(self, name, argtypes):
         return self.env.get_function(name, argtypes)
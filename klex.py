@@ -0,0 +1,138 @@
+from rply.errors import LexingError
+from rply.token import SourcePosition, Token
+
+import re
+
+# Tokenizer.  Every rule is one alternative of a single master regex, tried in the order
+# of TOKENS like the rules of a rply lexer were, so the first rule matching at a position
+# wins.  Reserved words are not rules of their own: they are NAMEs found in KEYWORDS.
+# Tokens are rply Tokens with the same source positions rply gives them.
+
+KEYWORDS = {
+    'void': 'VOID',
+    'String': 'STRINGTYPE',
+    'bool': 'BOOL',
+    'if': 'IF',
+    'else': 'ELSE',
+    'while': 'WHILE',
+    'for': 'FOR',
+    'class': 'CLASS',
+    'operator': 'OPERATOR',
+    'mutable': 'MUTABLE',
+    'public': 'PUBLIC',
+    'private': 'PRIVATE',
+    'import': 'IMPORT',
+    'return': 'RETURN',
+    'extends': 'EXTENDS',
+    'new': 'NEW'
+    }
+
+for _width in ['', '8', '16', '32', '64']:
+    KEYWORDS['int' + _width] = 'INTTYPE'
+    KEYWORDS['uint' + _width] = 'INTTYPE'
+for _width in ['', '32', '64']:
+    KEYWORDS['float' + _width] = 'FLOATTYPE'
+
+# Rules whose name is None are skipped
+TOKENS = [
+    # Comments and spaces
+    (None, r'\/\*.*\*\/'),
+    (None, r'\/\/.*(\n|\r)'),
+    (None, r'\s+'),
+
+    # Name of function or variable
+    ('NAME', r'[a-zA-Z_$][a-zA-Z_$0-9]*'),
+    # Number
+    ('DOUBLE', r'\d+[.]\d+'),
+    ('INTEGER', r'\d+'),
+    # Parenthesis, Curly Braces, and Brackets
+    ('OPEN_PAREN', r'\('),
+    ('CLOSE_PAREN', r'\)'),
+    ('OPEN_CURLY', r'\{'),
+    ('CLOSE_CURLY', r'\}'),
+    ('OPEN_BRACKET', r'\['),
+    ('CLOSE_BRACKET', r'\]'),
+    # Syntax Helper Bytes
+    ('SEMICOLON', r'\;'),
+    ('COMMA', r'\,'),
+    ('CHAR', r"\'([^\\\n\r]|\\[rnft\'])\'"),
+    ('STRING', r'\"[^"]*\"'),
+    # Operators
+    ('!=', '!='),
+    ('==', '=='),
+    ('>=', '>='),
+    ('<=', '<='),
+    ('++', '[+][+]'),
+    ('--', '[-][-]'),
+    ('+=', '[+]='),
+    ('-=', '[-]='),
+    ('*=', '[*]='),
+    ('/=', '[/]='),
+    ('>', '[>]'),
+    ('<', '[<]'),
+    ('>>', '[>][>]'),
+    ('<<', '[<][<]'),
+    ('>>=', '>>='),
+    ('<<=', '<<='),
+    ('^^', r'\^\^'),
+    ('&&', r'\&\&'),
+    ('LOGIC_OR', r'\|\|'),
+    ('SUM', r'\+'),
+    ('SUB', r'\-'),
+    ('MUL', r'\*'),
+    ('DIV', r'\/'),
+    ('XOR', r'\^'),
+    ('AND', r'\&'),
+    ('OR', r'\|'),
+    ('EQ', r'\='),
+    ('MOD', r'\%'),
+    ('MEMBER', r'\.'),
+    ('NOT', r'\!'),
+    # the rest
+    ('COLON', r'\:')
+    ]
+
+class Scanner:
+    def __init__(self, rules = TOKENS, keywords = KEYWORDS):
+        # Group Ti of the master regex is rule i
+        self.names = {'T' + str(i): name for i, (name, pattern) in enumerate(rules)}
+        self.regex = re.compile('|'.join('(?P<T' + str(i) + '>' + pattern + ')' for i, (name, pattern) in enumerate(rules)))
+        self.keywords = keywords
+
+    def lex(self, text):
+        return iter(self.tokens(text))
+
+    def tokens(self, text):
+        names = self.names
+        keywords = self.keywords
+        match = self.regex.scanner(text).match
+        tokens = []
+
+        lineno = 1
+        line_start = 0
+        end = 0
+
+        m = match()
+        while m != None:
+            start, end = m.span()
+            name = names[m.lastgroup]
+
+            if name != None:
+                value = m.group()
+                if name == 'NAME':
+                    name = keywords.get(value, 'NAME')
+                tokens.append(Token(name, value, SourcePosition(start, lineno, start - line_start + 1)))
+
+            # Spaces, comments and strings may span lines
+            newlines = text.count('\n', start, end)
+            if newlines:
+                lineno += newlines
+                line_start = text.rfind('\n', start, end) + 1
+
+            m = match()
+
+        if end < len(text):
+            pos = SourcePosition(end, lineno, end - line_start + 1)
+            raise LexingError("Unexpected character '" + text[end] + "' on line " + str(lineno), pos)
+
+        return tokens
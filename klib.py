@@ -1,22 +1,510 @@
-
-from klang import KyazukenObject, PyFunctionWrapper
+from klang import KyazukenObject, PyFunctionWrapper, KyazukenError, ArrayType
+from klang import NativeMethod, NativeClass, method_table, native_types, native_classes
 from klang import VariableDeclaration as Arg
 
+import asyncio
+import atexit
+import codecs
+import concurrent.futures
+import contextlib
+import mmap
+import os
+import signal
+import sys
+import threading
+import time
+
+# File and console I/O.  Files are opened with a large buffer (KYAZUKEN_IO_BUFFER bytes
+# unless fopen is given a size) and can be read in bulk, by line, or iterated line by line
+# in a for loop.  fmap maps a file read-only: slices are decoded straight from the mapping
+# without an intermediate copy.  Console output goes through a batched writer that flushes
+# once KYAZUKEN_STDOUT_BUFFER bytes are pending, on a write coming KYAZUKEN_STDOUT_INTERVAL
+# seconds or more after the last flush, and at exit.  On a terminal every line is flushed.
+#
+# Asynchronous I/O: fopen_async and popen_async return handles whose *_async methods
+# start an operation and return a Pending right away; await (or Pending.wait) blocks
+# until it completes and gives its result, await_any until one of several does.  The
+# operations run on an asyncio event loop, on a thread of its own since the interpreter
+# itself never yields: the loop is started by the first asynchronous operation of a run
+# and stopped when the run ends, cancelling whatever nobody waited for.  File reads and
+# writes go through the loop's executor, pipes are asyncio subprocess streams.
+#
+# StringBuilder keeps appended strings as a list of chunks, joined only when the result
+# is asked for, so building a string piece by piece takes linear time.  A builder is made
+# with new StringBuilder(...) or by calling the StringBuilder(...) functions.
+#
+# The methods of each type are NativeMethods in one table shared by all its objects,
+# registered in native_types under the name of the type so the checker binds calls.
+
+BUFFER_SIZE = int(os.environ.get('KYAZUKEN_IO_BUFFER', 1 << 16))
+
+def _line(line):
+    # Lines produced by iteration come without their line break
+    if line.endswith('\n'):
+        return line[:-1]
+    return line
+
 class KyazukenFile(KyazukenObject):
+    __slots__ = ('base',)
+
+    def __init__(self, base):
+        self.base = base
+
+    def readline(self):
+        return self.base.readline()
+
+    def read(self, n):
+        return self.base.read(n)
+
+    def readall(self):
+        return self.base.read()
+
+    def write(self, s):
+        self.base.write(s)
+
+    def flush(self):
+        self.base.flush()
+
+    def close(self):
+        self.base.close()
+
+    def iter(self):
+        line = next(self.base, None)
+        if line is None:
+            return None
+        return _line(line)
+
+KyazukenFile.methods = method_table([
+    NativeMethod('readline', 'String', [], KyazukenFile.readline),
+    NativeMethod('read', 'String', [Arg('n', 'int32')], KyazukenFile.read),
+    NativeMethod('readall', 'String', [], KyazukenFile.readall),
+    NativeMethod('write', 'void', [Arg('s', 'String')], KyazukenFile.write),
+    NativeMethod('flush', 'void', [], KyazukenFile.flush),
+    NativeMethod('close', 'void', [], KyazukenFile.close)
+    ])
+native_types['File'] = KyazukenFile.methods
+
+class KyazukenMappedFile(KyazukenObject):
+    __slots__ = ('map', 'view', 'pos')
+
+    def __init__(self, name):
+        with open(name, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+
+            # Empty files cannot be mapped
+            self.map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) if size > 0 else b''
+
+        self.view = memoryview(self.map)
+        self.pos = 0
+
+    def length(self):
+        return len(self.view)
+
+    def decode(self, start, end):
+        # A range can start or end in the middle of a character
+        try:
+            return str(self.view[start:end], 'utf-8')
+        except UnicodeDecodeError as e:
+            raise KyazukenError('Bytes ' + str(start) + ' to ' + str(end) + ' of a MappedFile are not valid UTF-8: ' + e.reason)
+
+    def slice(self, start, end):
+        return self.decode(start, end)
+
+    def find(self, s, start):
+        return self.map.find(s.encode('utf-8'), start)
+
+    def seek(self, pos):
+        self.pos = min(max(pos, 0), len(self.view))
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n):
+        start = self.pos
+        self.pos = min(start + n, len(self.view))
+        return self.decode(start, self.pos)
+
+    def readall(self):
+        return self.read(len(self.view))
+
+    def readline(self):
+        end = self.map.find(b'\n', self.pos)
+        end = len(self.view) if end < 0 else end + 1
+        return self.read(end - self.pos)
+
+    def iter(self):
+        if self.pos >= len(self.view):
+            return None
+        return _line(self.readline())
+
+    def close(self):
+        self.view.release()
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+
+KyazukenMappedFile.methods = method_table([
+    NativeMethod('length', 'int32', [], KyazukenMappedFile.length),
+    NativeMethod('slice', 'String', [Arg('start', 'int32'), Arg('end', 'int32')], KyazukenMappedFile.slice),
+    NativeMethod('find', 'int32', [Arg('s', 'String'), Arg('start', 'int32')], KyazukenMappedFile.find),
+    NativeMethod('seek', 'void', [Arg('pos', 'int32')], KyazukenMappedFile.seek),
+    NativeMethod('tell', 'int32', [], KyazukenMappedFile.tell),
+    NativeMethod('read', 'String', [Arg('n', 'int32')], KyazukenMappedFile.read),
+    NativeMethod('readall', 'String', [], KyazukenMappedFile.readall),
+    NativeMethod('readline', 'String', [], KyazukenMappedFile.readline),
+    NativeMethod('close', 'void', [], KyazukenMappedFile.close)
+    ])
+native_types['MappedFile'] = KyazukenMappedFile.methods
+
+class BatchedWriter:
+    # stream None writes to whatever sys.stdout is when flushing.  The interval is only
+    # checked by write: output followed by a long computation stays pending until the
+    # next write, a flush() or exit.
+    def __init__(self, stream, size, interval):
+        self.stream = stream
+        self.size = size
+        self.interval = interval
+        self.pending = []
+        self.nbytes = 0
+        self.last = time.monotonic()
+
+    def write(self, s):
+        self.pending.append(s)
+        self.nbytes += len(s)
+
+        if self.nbytes >= self.size or time.monotonic() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        stream = sys.stdout if self.stream is None else self.stream
+        if self.pending:
+            stream.write(''.join(self.pending))
+            self.pending = []
+            self.nbytes = 0
+        stream.flush()
+        self.last = time.monotonic()
+
+STDOUT_BUFFER = int(os.environ.get('KYAZUKEN_STDOUT_BUFFER', 1 << 16))
+
+def stdout_buffer_size():
+    return 1 if sys.stdout.isatty() else STDOUT_BUFFER
+
+stdout = BatchedWriter(None, stdout_buffer_size(), float(os.environ.get('KYAZUKEN_STDOUT_INTERVAL', 0.5)))
+atexit.register(stdout.flush)
+
+class EventLoop:
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+
+    def get(self):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target = self.loop.run_forever, daemon = True)
+            self.thread.start()
+        return self.loop
+
+    def start(self, coroutine):
+        return Pending(asyncio.run_coroutine_threadsafe(coroutine, self.get()))
+
+    def call(self, coroutine):
+        # Runs coroutine on the loop and waits for it
+        return _result(asyncio.run_coroutine_threadsafe(coroutine, self.get()))
+
+    async def _shutdown(self):
+        tasks = [i for i in asyncio.all_tasks() if i is not asyncio.current_task()]
+        for i in tasks:
+            i.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+
+        # Commands run in a session of their own, so whatever they started goes too
+        for i in list(_processes):
+            if i.returncode is None:
+                with contextlib.suppress(ProcessLookupError):
+                    os.killpg(i.pid, signal.SIGKILL)
+                await i.wait()
+        _processes.clear()
+
+    def stop(self):
+        if self.loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+        self.thread = None
+
+event_loop = EventLoop()
+
+# Subprocesses started by popen_async, killed if still running when the loop stops
+_processes = set()
+
+def _result(future):
+    try:
+        return future.result()
+    except concurrent.futures.CancelledError:
+        raise KyazukenError('Waited for a cancelled operation')
+    except OSError as e:
+        raise KyazukenError('I/O error: ' + str(e))
+
+class Pending(KyazukenObject):
+    __slots__ = ('future',)
+
+    def __init__(self, future):
+        self.future = future
+
+    def done(self):
+        return self.future.done()
+
+    def wait(self):
+        return _result(self.future)
+
+    def cancel(self):
+        self.future.cancel()
+
+Pending.methods = method_table([
+    NativeMethod('done', 'bool', [], Pending.done),
+    NativeMethod('wait', 'String', [], Pending.wait),
+    NativeMethod('cancel', 'void', [], Pending.cancel)
+    ])
+native_types['Pending'] = Pending.methods
+
+class KyazukenAsyncFile(KyazukenObject):
+    # Operations on one file run in the order they were started
+    __slots__ = ('base', 'lock')
+
     def __init__(self, base):
-        super().__init__()
         self.base = base
-        self.add_function(PyFunctionWrapper('readline', 'String', [], base.readline))
-        self.add_function(PyFunctionWrapper('write', 'String', [], base.write))
+        self.lock = None
+
+    async def run(self, f, *args):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            return await asyncio.get_running_loop().run_in_executor(None, f, *args)
+
+    def read_async(self, n):
+        return event_loop.start(self.run(self.base.read, n))
+
+    def readline_async(self):
+        return event_loop.start(self.run(self.base.readline))
+
+    def readall_async(self):
+        return event_loop.start(self.run(self.base.read))
+
+    def write(self, s):
+        self.base.write(s)
+        return ''
+
+    def write_async(self, s):
+        return event_loop.start(self.run(self.write, s))
+
+    def close(self):
+        # Waits for the operations already started
+        event_loop.call(self.run(self.base.close))
+
+KyazukenAsyncFile.methods = method_table([
+    NativeMethod('read_async', 'Pending', [Arg('n', 'int32')], KyazukenAsyncFile.read_async),
+    NativeMethod('readline_async', 'Pending', [], KyazukenAsyncFile.readline_async),
+    NativeMethod('readall_async', 'Pending', [], KyazukenAsyncFile.readall_async),
+    NativeMethod('write_async', 'Pending', [Arg('s', 'String')], KyazukenAsyncFile.write_async),
+    NativeMethod('close', 'void', [], KyazukenAsyncFile.close)
+    ])
+native_types['AsyncFile'] = KyazukenAsyncFile.methods
+
+class KyazukenPipe(KyazukenObject):
+    # A shell command, its stdin and stdout being the pipe.  Reads are done in the order
+    # they were started, and so are writes, but a read waiting for output does not hold
+    # back a write.  Output is decoded incrementally: a read ending in the middle of a
+    # character leaves the rest of it for the next one.
+    __slots__ = ('process', 'reading', 'writing', 'decoder')
+
+    def __init__(self, command):
+        self.process = event_loop.call(self.spawn(command))
+        self.reading = None
+        self.writing = None
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+    async def spawn(self, command):
+        process = await asyncio.create_subprocess_shell(command, stdin = asyncio.subprocess.PIPE, stdout = asyncio.subprocess.PIPE, start_new_session = True)
+        _processes.add(process)
+        return process
+
+    # The locks are made on the loop's thread
+    async def read_locked(self, coroutine):
+        if self.reading is None:
+            self.reading = asyncio.Lock()
+        async with self.reading:
+            return await coroutine
+
+    async def write_locked(self, coroutine):
+        if self.writing is None:
+            self.writing = asyncio.Lock()
+        async with self.writing:
+            return await coroutine
+
+    def decode(self, data, final):
+        # The output is over once a read gives nothing, or once everything was read
+        try:
+            return self.decoder.decode(data, final = final or len(data) == 0)
+        except UnicodeDecodeError as e:
+            raise KyazukenError('Output of a Pipe is not valid UTF-8: ' + e.reason)
+
+    async def read(self, n):
+        return self.decode(await self.process.stdout.read(n), n < 0)
+
+    async def readline(self):
+        return self.decode(await self.process.stdout.readline(), False)
+
+    async def write(self, s):
+        self.process.stdin.write(s.encode('utf-8'))
+        await self.process.stdin.drain()
+        return ''
+
+    async def close_stdin(self):
+        self.process.stdin.close()
+        await self.process.stdin.wait_closed()
+
+    def read_async(self, n):
+        return event_loop.start(self.read_locked(self.read(n)))
+
+    def readline_async(self):
+        return event_loop.start(self.read_locked(self.readline()))
+
+    def readall_async(self):
+        return event_loop.start(self.read_locked(self.read(-1)))
+
+    def write_async(self, s):
+        return event_loop.start(self.write_locked(self.write(s)))
+
+    def close(self):
+        # Closes the command's stdin, so it sees the end of its input
+        event_loop.call(self.write_locked(self.close_stdin()))
+
+    def wait(self):
+        code = event_loop.call(self.process.wait())
+        _processes.discard(self.process)
+        return code
+
+KyazukenPipe.methods = method_table([
+    NativeMethod('read_async', 'Pending', [Arg('n', 'int32')], KyazukenPipe.read_async),
+    NativeMethod('readline_async', 'Pending', [], KyazukenPipe.readline_async),
+    NativeMethod('readall_async', 'Pending', [], KyazukenPipe.readall_async),
+    NativeMethod('write_async', 'Pending', [Arg('s', 'String')], KyazukenPipe.write_async),
+    NativeMethod('close', 'void', [], KyazukenPipe.close),
+    NativeMethod('wait', 'int32', [], KyazukenPipe.wait)
+    ])
+native_types['Pipe'] = KyazukenPipe.methods
+
+def _fopen_async(name, mode):
+    if 'b' in mode:
+        raise KyazukenError('Binary file mode ' + mode + ' is not supported')
+    return KyazukenAsyncFile(open(name, mode, buffering = BUFFER_SIZE))
+
+def _await(pending):
+    if pending is None:
+        raise KyazukenError('Attempted to await null')
+    return pending.wait()
+
+def _await_any(pending):
+    # Index of a completed operation, -1 if there are none to wait for
+    futures = {i.future: n for n, i in enumerate(pending.data) if i is not None}
+    if len(futures) == 0:
+        return -1
+    done, waiting = concurrent.futures.wait(futures, return_when = concurrent.futures.FIRST_COMPLETED)
+    return min(futures[i] for i in done)
+
+class KyazukenStringBuilder(KyazukenObject):
+    # Started from a null String, a builder stays null until it is modified.  It then
+    # holds "None", like a null String that is concatenated to.
+    __slots__ = ('chunks', 'null')
+
+    def __init__(self, initial = ''):
+        self.chunks = []
+        self.null = initial is None
+        if initial:
+            self.chunks.append(initial)
+
+    def modify(self):
+        if self.null:
+            self.null = False
+            self.chunks.append('None')
+
+    def append(self, s):
+        # Same conversion as concatenating to a String
+        self.modify()
+        self.chunks.append(str(s))
+        return self
+
+    def insert(self, index, s):
+        self.modify()
+        text = self.to_string()
+        if index < 0 or index > len(text):
+            raise KyazukenError('Index ' + str(index) + ' out of range for a StringBuilder of length ' + str(len(text)))
+        self.chunks = [text[:index], str(s), text[index:]]
+        return self
+
+    def length(self):
+        return len(self.to_string() or '')
+
+    def to_string(self):
+        if self.null:
+            return None
+        if len(self.chunks) != 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0]
+
+    def clear(self):
+        self.chunks = []
+        self.null = False
+
+KyazukenStringBuilder.methods = method_table([
+    NativeMethod('append', 'StringBuilder', [Arg('s', 'String')], KyazukenStringBuilder.append),
+    NativeMethod('append', 'StringBuilder', [Arg('n', 'int32')], KyazukenStringBuilder.append),
+    NativeMethod('insert', 'StringBuilder', [Arg('index', 'int32'), Arg('s', 'String')], KyazukenStringBuilder.insert),
+    NativeMethod('length', 'int32', [], KyazukenStringBuilder.length),
+    NativeMethod('toString', 'String', [], KyazukenStringBuilder.to_string),
+    NativeMethod('clear', 'void', [], KyazukenStringBuilder.clear)
+    ])
+native_types['StringBuilder'] = KyazukenStringBuilder.methods
+native_classes['StringBuilder'] = NativeClass('StringBuilder', KyazukenStringBuilder, [
+    NativeMethod('StringBuilder', 'void', [], KyazukenStringBuilder.__init__),
+    NativeMethod('StringBuilder', 'void', [Arg('s', 'String')], KyazukenStringBuilder.__init__)
+    ])
 
 def _fopen_base(name, mode):
-    return KyazukenFile(open(name, mode))
+    return _fopen_buffered(name, mode, BUFFER_SIZE)
+
+def _fopen_buffered(name, mode, size):
+    if 'b' in mode:
+        raise KyazukenError('Binary file mode ' + mode + ' is not supported')
+
+    # A size of 1 would mean line buffering to Python
+    return KyazukenFile(open(name, mode, buffering = size if size > 1 else -1))
+
+# A null String prints as None, like it concatenates
+def _print(s):
+    stdout.write(str(s))
+
+def _println(s):
+    stdout.write(str(s) + '\n')
 
 default_functions = [
     PyFunctionWrapper('fopen', 'File', [Arg('path', 'String'), Arg('mode', 'String')], _fopen_base),
-    PyFunctionWrapper('println', 'void', [Arg('s', 'String')], print)
+    PyFunctionWrapper('fopen', 'File', [Arg('path', 'String'), Arg('mode', 'String'), Arg('bufsize', 'int32')], _fopen_buffered),
+    PyFunctionWrapper('fmap', 'MappedFile', [Arg('path', 'String')], KyazukenMappedFile),
+    PyFunctionWrapper('fopen_async', 'AsyncFile', [Arg('path', 'String'), Arg('mode', 'String')], _fopen_async),
+    PyFunctionWrapper('popen_async', 'Pipe', [Arg('command', 'String')], KyazukenPipe),
+    PyFunctionWrapper('await', 'String', [Arg('pending', 'Pending')], _await),
+    PyFunctionWrapper('await_any', 'int32', [Arg('pending', ArrayType('Pending'))], _await_any),
+    PyFunctionWrapper('println', 'void', [Arg('s', 'String')], _println),
+    PyFunctionWrapper('print', 'void', [Arg('s', 'String')], _print),
+    PyFunctionWrapper('flush', 'void', [], stdout.flush),
+    PyFunctionWrapper('StringBuilder', 'StringBuilder', [], KyazukenStringBuilder),
+    PyFunctionWrapper('StringBuilder', 'StringBuilder', [Arg('s', 'String')], KyazukenStringBuilder)
     ]
-    
+
 
 def add_functions(func_dict : dict):
     for i in default_functions:
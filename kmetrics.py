@@ -0,0 +1,145 @@
+from klang import *
+
+import atexit
+import json
+import os
+import sys
+import time
+
+# Runtime metrics: time spent in each phase (parsing, elaboration, environment setup),
+# calls per function signature, builtin calls, allocations of instances and arrays, and
+# frames created.  Nothing is instrumented while the registry is disabled: enable()
+# patches the classes involved and install() wraps the calls of a program's functions,
+# which KyazukenDocument.execute does once the engine is installed.
+#
+# KYAZUKEN_METRICS enables the registry from the start and dumps it as JSON at exit, to
+# the file it names or to stderr for '-'.
+
+class Registry:
+    def __init__(self):
+        self.enabled = False
+        self.patched = []
+        self.reset()
+
+    def reset(self):
+        self.phases = {}
+        self.calls = {}
+        self.builtin_calls = {}
+        self.allocations = {}
+        self.contexts = 0
+
+    def snapshot(self):
+        return {
+            'phases': {i: dict(j) for i, j in self.phases.items()},
+            'calls': dict(self.calls),
+            'builtin_calls': dict(self.builtin_calls),
+            'allocations': dict(self.allocations),
+            'contexts': self.contexts
+            }
+
+    def dump(self, path = None):
+        # Writes the snapshot to path, or to stderr
+        text = json.dumps(self.snapshot(), indent = 2, sort_keys = True) + '\n'
+        if path is None or path == '-':
+            sys.stderr.write(text)
+        else:
+            with open(path, 'w') as f:
+                f.write(text)
+
+registry = Registry()
+
+def _count(table, key):
+    table[key] = table.get(key, 0) + 1
+
+class _Phase:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        entry = registry.phases.setdefault(self.name, {'count': 0, 'seconds': 0.0})
+        entry['count'] += 1
+        entry['seconds'] += time.perf_counter() - self.start
+
+class _NoPhase:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+_no_phase = _NoPhase()
+
+def phase(name):
+    # with phase('parse_ast'): ... times the block when the registry is enabled
+    if registry.enabled:
+        return _Phase(name)
+    return _no_phase
+
+def _patch(cls, name, make):
+    original = cls.__dict__[name]
+    registry.patched.append((cls, name, original))
+    setattr(cls, name, make(original))
+
+def _builtin_call(call):
+    def counted(self, env, args):
+        _count(registry.builtin_calls, label(self))
+        return call(self, env, args)
+    return counted
+
+def _instantiate(instantiate):
+    def counted(self, environment):
+        _count(registry.allocations, self.name)
+        return instantiate(self, environment)
+    return counted
+
+def _new_array(init):
+    def counted(self, basetype, data):
+        _count(registry.allocations, str(ArrayType(basetype)))
+        init(self, basetype, data)
+    return counted
+
+def _new_context(init):
+    def counted(self, env, nslots, empty = None):
+        registry.contexts += 1
+        init(self, env, nslots, empty)
+    return counted
+
+def enable():
+    if registry.enabled:
+        return
+    registry.enabled = True
+
+    _patch(PyFunctionWrapper, 'call', _builtin_call)
+    _patch(NativeMethod, 'call', _builtin_call)
+    _patch(ClassDefinition, 'instantiate', _instantiate)
+    _patch(ArrayObject, '__init__', _new_array)
+    _patch(Context, '__init__', _new_context)
+
+def disable():
+    registry.enabled = False
+    for cls, name, original in reversed(registry.patched):
+        setattr(cls, name, original)
+    registry.patched = []
+
+def install(functions):
+    # Counts the calls of functions, over whatever engine they run on
+    if not registry.enabled:
+        return
+
+    for f in functions:
+        if f is None or getattr(f.call, 'counted', False):
+            continue
+
+        def counted(environment, arguments, call = f.call, name = label(f)):
+            _count(registry.calls, name)
+            return call(environment, arguments)
+
+        counted.counted = True
+        f.call = counted
+
+if os.environ.get('KYAZUKEN_METRICS'):
+    enable()
+    atexit.register(registry.dump, os.environ['KYAZUKEN_METRICS'])
@@ -0,0 +1,623 @@
+from klang import *
+
+import os
+import sys
+
+# AST optimizer, run on the elaborated functions once they passed the checker, before they
+# are checked again and executed.  Functions are only optimized once: those of files a
+# --watch rebuild did not replace keep their optimized code.
+# Passes:
+#   fold         evaluate BinOps and UniOps whose operands are literals
+#   branches     replace ifs and whiles with a constant condition by the code they run
+#   noops        drop NoOperations from statement lists
+#   flatten      splice nested StatementLists into their parent (blocks open no scope)
+#   dead-stores  remove declarations and stores of locals that are never read
+#   appends      build local Strings only appended to in a loop with a StringBuilder
+# KYAZUKEN_OPT_DISABLE holds a comma separated list of passes to skip, or 'all'.
+
+PASSES = ['fold', 'branches', 'noops', 'flatten', 'dead-stores', 'appends']
+
+DISABLED = os.environ.get('KYAZUKEN_OPT_DISABLE', '').split(',')
+
+# Print every function to stderr before and after optimizing it
+DUMP = bool(os.environ.get('KYAZUKEN_DUMP_OPTIMIZED'))
+
+def enabled_passes():
+    if 'all' in DISABLED:
+        return []
+    return [i for i in PASSES if not i in DISABLED]
+
+class Optimizer:
+    def __init__(self, passes):
+        self.fold = 'fold' in passes
+        self.branches = 'branches' in passes
+        self.noops = 'noops' in passes
+        self.flatten = 'flatten' in passes
+
+    def function(self, f):
+        f.statements = self.statements(f.statements)
+
+    def statements(self, statements):
+        result = []
+        for i in statements:
+            i = self.statement(i)
+
+            if self.flatten and type(i) == StatementList:
+                result += i.statements
+            elif self.noops and type(i) == NoOperation:
+                pass
+            else:
+                result.append(i)
+        return result
+
+    def statement(self, node):
+        t = type(node)
+
+        if isinstance(node, Expression):
+            return self.expression(node)
+        elif t == VariableDefinition:
+            node.expr = self.expression(node.expr)
+        elif t == StatementList:
+            node.statements = self.statements(node.statements)
+        elif t == IfBlock:
+            node.condition = self.expression(node.condition)
+            node.statement = self.statement(node.statement)
+
+            cond = self.constant_condition(node.condition)
+            if cond == True:
+                return node.statement
+            elif cond == False:
+                return NoOperation()
+        elif t == IfElseBlock:
+            node.condition = self.expression(node.condition)
+            node.statement = self.statement(node.statement)
+            node.else_statement = self.statement(node.else_statement)
+
+            cond = self.constant_condition(node.condition)
+            if cond == True:
+                return node.statement
+            elif cond == False:
+                return node.else_statement
+        elif t == WhileBlock:
+            node.condition = self.expression(node.condition)
+            node.statement = self.statement(node.statement)
+
+            if self.constant_condition(node.condition) == False:
+                return NoOperation()
+        elif t == CForBlock:
+            node.loop_init = self.statement(node.loop_init)
+            node.loop_condition = self.expression(node.loop_condition)
+            node.loop_code = self.statement(node.loop_code)
+            node.loop_end = self.expression(node.loop_end)
+        elif t == IterForBlock:
+            node.iterable = self.expression(node.iterable)
+            node.statement = self.statement(node.statement)
+        elif t == Return:
+            if node.val != None:
+                node.val = self.expression(node.val)
+        elif t == SuperConstructor:
+            node.args = [self.expression(i) for i in node.args]
+
+        return node
+
+    def constant_condition(self, expr):
+        # True or False for a literal bool condition, None otherwise.  Conditions of other
+        # types are left alone so they still fail when executed.
+        if self.branches and type(expr) == Literal and expr.type == 'bool':
+            return bool(expr.value)
+        return None
+
+    def expression(self, node):
+        t = type(node)
+
+        if t == BinOp:
+            node.left = self.expression(node.left)
+            node.right = self.expression(node.right)
+            if self.fold and not node.op in ASSIGNMENT_OPERATORS:
+                return self.fold_binop(node)
+        elif t == UniOp:
+            node.left = self.expression(node.left)
+            if self.fold and type(node.left) == Literal:
+                if node.op == '!':
+                    return Literal(node.left.type, not node.left.value)
+                elif type(node.left.value) in [int, float]:
+                    return Literal(node.left.type, -node.left.value)
+        elif t == Store:
+            node.obj = self.expression(node.obj)
+            node.expr = self.expression(node.expr)
+        elif t == FunctionCall:
+            node.args = [self.expression(i) for i in node.args]
+            if type(node.func) != Variable:
+                node.func = self.expression(node.func)
+        elif t == NewObject:
+            node.args = [self.expression(i) for i in node.args]
+        elif t == Subscript:
+            node.src = self.expression(node.src)
+            node.idx = self.expression(node.idx)
+        elif t == Member:
+            node.src = self.expression(node.src)
+        elif t == PreIncDec or t == PostIncDec:
+            node.obj = self.expression(node.obj)
+        elif t == ArrayInitializer:
+            node.items = [self.expression(i) for i in node.items]
+        elif t == NewArray:
+            node.size = self.expression(node.size)
+
+        return node
+
+    def fold_binop(self, node):
+        if type(node.left) != Literal or type(node.right) != Literal:
+            return node
+
+        # Operations that fail are kept, they have to fail when executed
+        try:
+            t, v = binary_operation(node.op, node.left.type, node.left.value, node.right.type, node.right.value)
+        except (KyazukenError, ArithmeticError, TypeError):
+            return node
+
+        return Literal(t, v)
+
+class DeadStores:
+    # A local is dead when no expression of the function reads it.  Its declaration and the
+    # statements storing to it go away, as long as none of the stored values can have an
+    # effect (or an error) of its own and the variable is not written from inside another
+    # expression.
+    def __init__(self):
+        self.read = set()
+        self.kept = set()
+        self.writes = {}
+
+    def function(self, f):
+        for i in f.params:
+            self.kept.add(i.slot)
+
+        for i in f.statements:
+            self.statement(i)
+
+        dead = set(self.writes) - self.read - self.kept
+        if len(dead) > 0:
+            f.statements = self.remove(f.statements, dead)
+
+    def write(self, node, slot, value):
+        if slot is None:
+            return
+
+        self.writes.setdefault(slot, []).append(node)
+        if value != None and not self.pure(value):
+            self.kept.add(slot)
+
+    def pure(self, node):
+        t = type(node)
+
+        if t == Literal:
+            return True
+        elif t == Variable:
+            return node.slot != None
+        elif t == UniOp:
+            return self.pure(node.left)
+        elif t == BinOp:
+            return not node.op in ASSIGNMENT_OPERATORS and not node.op in ['/', '%'] and self.pure(node.left) and self.pure(node.right)
+        return False
+
+    def statement(self, node):
+        t = type(node)
+
+        if t == VariableDeclaration:
+            self.write(node, node.slot, None)
+        elif t == VariableDefinition:
+            self.expression(node.expr)
+            self.write(node, node.slot, node.expr)
+        elif t == Store and type(node.obj) == Variable:
+            self.expression(node.expr)
+            self.write(node, node.obj.slot, node.expr)
+        elif t == StatementList:
+            for i in node.statements:
+                self.statement(i)
+        elif t == IfBlock or t == WhileBlock:
+            self.expression(node.condition)
+            self.statement(node.statement)
+        elif t == IfElseBlock:
+            self.expression(node.condition)
+            self.statement(node.statement)
+            self.statement(node.else_statement)
+        elif t == CForBlock:
+            self.statement(node.loop_init)
+            self.expression(node.loop_condition)
+            self.statement(node.loop_code)
+            self.expression(node.loop_end)
+        elif t == IterForBlock:
+            self.expression(node.iterable)
+            self.kept.add(node.vardec.slot)
+            self.statement(node.statement)
+        elif t == Return:
+            if node.val != None:
+                self.expression(node.val)
+        elif t == SuperConstructor:
+            for i in node.args:
+                self.expression(i)
+        elif isinstance(node, Expression):
+            self.expression(node)
+
+    def expression(self, node):
+        t = type(node)
+
+        if t == Variable:
+            self.read.add(node.slot)
+        elif t == Store:
+            # A store nested in an expression is never removed
+            if type(node.obj) == Variable:
+                self.kept.add(node.obj.slot)
+            else:
+                self.expression(node.obj)
+            self.expression(node.expr)
+        elif t == BinOp:
+            self.expression(node.left)
+            self.expression(node.right)
+        elif t == UniOp:
+            self.expression(node.left)
+        elif t == FunctionCall:
+            for i in node.args:
+                self.expression(i)
+            if type(node.func) != Variable:
+                self.expression(node.func)
+        elif t == NewObject:
+            for i in node.args:
+                self.expression(i)
+        elif t == Subscript:
+            self.expression(node.src)
+            self.expression(node.idx)
+        elif t == Member:
+            self.expression(node.src)
+        elif t == PreIncDec or t == PostIncDec:
+            self.expression(node.obj)
+        elif t == ArrayInitializer:
+            for i in node.items:
+                self.expression(i)
+        elif t == NewArray:
+            self.expression(node.size)
+
+    def removed(self, node, dead):
+        t = type(node)
+        if t == VariableDeclaration or t == VariableDefinition:
+            return node.slot in dead
+        return t == Store and type(node.obj) == Variable and node.obj.slot in dead
+
+    def remove(self, statements, dead):
+        return [self.remove_in(i, dead) for i in statements if not self.removed(i, dead)]
+
+    def remove_in(self, node, dead):
+        t = type(node)
+
+        if t == StatementList:
+            node.statements = self.remove(node.statements, dead)
+        elif t == IfBlock or t == WhileBlock or t == IterForBlock:
+            node.statement = self.remove_single(node.statement, dead)
+        elif t == IfElseBlock:
+            node.statement = self.remove_single(node.statement, dead)
+            node.else_statement = self.remove_single(node.else_statement, dead)
+        elif t == CForBlock:
+            node.loop_init = self.remove_single(node.loop_init, dead)
+            node.loop_code = self.remove_single(node.loop_code, dead)
+
+        return node
+
+    def remove_single(self, node, dead):
+        if self.removed(node, dead):
+            return NoOperation()
+        return self.remove_in(node, dead)
+
+class StringAppends:
+    # s += e repeated on a String local copies s every time.  When the only uses of s in a
+    # loop are statements s += e, the loop appends to a StringBuilder made from s instead
+    # and s gets the result once the loop is done.  Nothing can see s meanwhile: e does not
+    # read it and other functions cannot.
+    def __init__(self):
+        self.strings = {}
+
+    def function(self, f):
+        self.f = f
+        for i in f.params:
+            self.strings[i.slot] = False
+        self.declarations(f.statements)
+
+        f.statements = [self.statement(i) for i in f.statements]
+
+    def declarations(self, statements):
+        # Slots only ever declared as Strings
+        for i in statements:
+            t = type(i)
+            if t == VariableDeclaration or t == VariableDefinition:
+                self.strings[i.slot] = i.type == 'String' and self.strings.get(i.slot, True)
+            elif t == StatementList:
+                self.declarations(i.statements)
+            elif t == IfBlock or t == WhileBlock:
+                self.declarations([i.statement])
+            elif t == IfElseBlock:
+                self.declarations([i.statement, i.else_statement])
+            elif t == CForBlock:
+                self.declarations([i.loop_init, i.loop_code])
+            elif t == IterForBlock:
+                self.strings[i.vardec.slot] = False
+                self.declarations([i.statement])
+
+    def statement(self, node):
+        t = type(node)
+
+        if t == WhileBlock or t == CForBlock or t == IterForBlock:
+            uses = AppendUses()
+            uses.statement(node)
+            slots = [i for i in uses.appends if self.strings.get(i) and uses.uses.get(i, 0) == 0]
+            if len(slots) > 0:
+                # Rewritten first, loops inside it then see the appends to the builders
+                result = self.rewrite(node, slots, uses.appends)
+                self.inner(node)
+                return result
+
+        return self.inner(node)
+
+    def inner(self, node):
+        t = type(node)
+
+        if t == StatementList:
+            node.statements = [self.statement(i) for i in node.statements]
+        elif t == IfBlock or t == WhileBlock or t == IterForBlock:
+            node.statement = self.statement(node.statement)
+        elif t == IfElseBlock:
+            node.statement = self.statement(node.statement)
+            node.else_statement = self.statement(node.else_statement)
+        elif t == CForBlock:
+            node.loop_code = self.statement(node.loop_code)
+        return node
+
+    def rewrite(self, loop, slots, appends):
+        before = []
+        after = []
+        calls = {}
+
+        for slot in slots:
+            name = appends[slot][0].left.name
+            builder = VariableDefinition(name + '.builder', 'StringBuilder', FunctionCall(Variable('StringBuilder'), [self.variable(name, slot, 'String')]))
+            builder.slot = self.f.nslots
+            self.f.nslots += 1
+            self.strings[builder.slot] = False
+
+            for i in appends[slot]:
+                # Concatenating to "" converts the value the way += does
+                value = i.right
+                if not self.string(value):
+                    value = BinOp(Literal('String', ''), '+', value)
+                calls[id(i)] = FunctionCall(Member(self.variable(builder.name, builder.slot, builder.type), 'append'), [value])
+
+            before.append(builder)
+            after.append(Store(self.variable(name, slot, 'String'), FunctionCall(Member(self.variable(builder.name, builder.slot, builder.type), 'toString'), [])))
+
+        self.replace(loop, calls)
+        return StatementList(before + [loop] + after)
+
+    def replace(self, node, calls):
+        t = type(node)
+
+        if id(node) in calls:
+            return calls[id(node)]
+        elif t == StatementList:
+            node.statements = [self.replace(i, calls) for i in node.statements]
+        elif t == IfBlock or t == WhileBlock or t == IterForBlock:
+            node.statement = self.replace(node.statement, calls)
+        elif t == IfElseBlock:
+            node.statement = self.replace(node.statement, calls)
+            node.else_statement = self.replace(node.else_statement, calls)
+        elif t == CForBlock:
+            node.loop_init = self.replace(node.loop_init, calls)
+            node.loop_code = self.replace(node.loop_code, calls)
+        return node
+
+    def string(self, node):
+        # Whether node evaluates to a String whatever the types of its operands
+        if type(node) == Literal:
+            return node.type == 'String'
+        elif type(node) == BinOp and node.op == '+':
+            return self.string(node.left) or self.string(node.right)
+        return False
+
+    def variable(self, name, slot, _type):
+        # Variable as the resolver leaves it
+        v = Variable(name)
+        v.slot = slot
+        v.static_type = _type
+        return v
+
+class AppendUses:
+    # The statements s += e of a loop by slot of s, and how many times each slot is used
+    # otherwise
+    def __init__(self):
+        self.appends = {}
+        self.uses = {}
+
+    def use(self, slot):
+        self.uses[slot] = self.uses.get(slot, 0) + 1
+
+    def statement(self, node):
+        t = type(node)
+
+        if t == BinOp and node.op == '+=' and type(node.left) == Variable and node.left.slot != None:
+            self.appends.setdefault(node.left.slot, []).append(node)
+            self.expression(node.right)
+        elif t == VariableDeclaration:
+            self.use(node.slot)
+        elif t == VariableDefinition:
+            self.use(node.slot)
+            self.expression(node.expr)
+        elif t == StatementList:
+            for i in node.statements:
+                self.statement(i)
+        elif t == IfBlock or t == WhileBlock:
+            self.expression(node.condition)
+            self.statement(node.statement)
+        elif t == IfElseBlock:
+            self.expression(node.condition)
+            self.statement(node.statement)
+            self.statement(node.else_statement)
+        elif t == CForBlock:
+            self.statement(node.loop_init)
+            self.expression(node.loop_condition)
+            self.statement(node.loop_code)
+            self.expression(node.loop_end)
+        elif t == IterForBlock:
+            self.use(node.vardec.slot)
+            self.expression(node.iterable)
+            self.statement(node.statement)
+        elif t == Return:
+            if node.val != None:
+                self.expression(node.val)
+        elif t == SuperConstructor:
+            for i in node.args:
+                self.expression(i)
+        elif isinstance(node, Expression):
+            self.expression(node)
+
+    def expression(self, node):
+        t = type(node)
+
+        if t == Variable:
+            self.use(node.slot)
+        elif t == Store:
+            self.expression(node.obj)
+            self.expression(node.expr)
+        elif t == BinOp:
+            self.expression(node.left)
+            self.expression(node.right)
+        elif t == UniOp:
+            self.expression(node.left)
+        elif t == FunctionCall:
+            for i in node.args:
+                self.expression(i)
+            if type(node.func) != Variable:
+                self.expression(node.func)
+        elif t == NewObject:
+            for i in node.args:
+                self.expression(i)
+        elif t == Subscript:
+            self.expression(node.src)
+            self.expression(node.idx)
+        elif t == Member:
+            self.expression(node.src)
+        elif t == PreIncDec or t == PostIncDec:
+            self.expression(node.obj)
+        elif t == ArrayInitializer:
+            for i in node.items:
+                self.expression(i)
+        elif t == NewArray:
+            self.expression(node.size)
+
+def optimize(functions, passes = None):
+    if passes is None:
+        passes = enabled_passes()
+
+    for f in functions:
+        if getattr(f, 'optimized', False):
+            continue
+        f.optimized = True
+
+        if DUMP:
+            sys.stderr.write('Before optimizing:\n' + format_function(f) + '\n')
+
+        Optimizer(passes).function(f)
+        if 'dead-stores' in passes:
+            DeadStores().function(f)
+        if 'appends' in passes:
+            StringAppends().function(f)
+
+        if DUMP:
+            sys.stderr.write('After optimizing:\n' + format_function(f) + '\n')
+
+def format_function(f):
+    if isinstance(f, Function):
+        head = str(f.rettype) + ' ' + str(f.name)
+    else:
+        head = str(f.name)
+
+    lines = [head + '(' + ', '.join(str(i) for i in f.args) + ') {']
+    for i in f.statements:
+        format_statement(i, 1, lines)
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+def format_statement(node, depth, lines):
+    t = type(node)
+    pad = '    ' * depth
+
+    if isinstance(node, Expression):
+        lines.append(pad + format_expression(node) + ';')
+    elif t == VariableDeclaration:
+        lines.append(pad + str(node) + ';')
+    elif t == VariableDefinition:
+        lines.append(pad + str(node.type) + ' ' + node.name + ' = ' + format_expression(node.expr) + ';')
+    elif t == StatementList:
+        lines.append(pad + '{')
+        for i in node.statements:
+            format_statement(i, depth + 1, lines)
+        lines.append(pad + '}')
+    elif t == IfBlock or t == IfElseBlock:
+        lines.append(pad + 'if (' + format_expression(node.condition) + ')')
+        format_statement(node.statement, depth + 1, lines)
+        if t == IfElseBlock:
+            lines.append(pad + 'else')
+            format_statement(node.else_statement, depth + 1, lines)
+    elif t == WhileBlock:
+        lines.append(pad + 'while (' + format_expression(node.condition) + ')')
+        format_statement(node.statement, depth + 1, lines)
+    elif t == CForBlock:
+        init = []
+        format_statement(node.loop_init, 0, init)
+        lines.append(pad + 'for (' + ' '.join(init) + ' ' + format_expression(node.loop_condition) + '; ' + format_expression(node.loop_end) + ')')
+        format_statement(node.loop_code, depth + 1, lines)
+    elif t == IterForBlock:
+        lines.append(pad + 'for (' + str(node.vardec) + ': ' + format_expression(node.iterable) + ')')
+        format_statement(node.statement, depth + 1, lines)
+    elif t == Return:
+        if node.val == None:
+            lines.append(pad + 'return;')
+        else:
+            lines.append(pad + 'return ' + format_expression(node.val) + ';')
+    elif t == NoOperation:
+        lines.append(pad + ';')
+    elif t == SuperConstructor:
+        lines.append(pad + ':(' + ', '.join(format_expression(i) for i in node.args) + ');')
+    else:
+        lines.append(pad + '<' + t.__name__ + '>')
+
+def format_expression(node):
+    t = type(node)
+
+    if t == Literal:
+        if type(node.value) == str:
+            return '"' + node.value.encode('unicode_escape').decode('ascii').replace('"', '\\"') + '"'
+        elif type(node.value) == bool:
+            return str(node.value).lower()
+        return str(node.value)
+    elif t == Variable:
+        return node.name
+    elif t == BinOp:
+        return '(' + format_expression(node.left) + ' ' + node.op + ' ' + format_expression(node.right) + ')'
+    elif t == UniOp:
+        return node.op + format_expression(node.left)
+    elif t == Store:
+        return format_expression(node.obj) + ' = ' + format_expression(node.expr)
+    elif t == FunctionCall:
+        return format_expression(node.func) + '(' + ', '.join(format_expression(i) for i in node.args) + ')'
+    elif t == NewObject:
+        return 'new ' + str(node.name) + '(' + ', '.join(format_expression(i) for i in node.args) + ')'
+    elif t == Subscript:
+        return format_expression(node.src) + '[' + format_expression(node.idx) + ']'
+    elif t == Member:
+        return format_expression(node.src) + '.' + str(node.sub)
+    elif t == PreIncDec:
+        return node.op + format_expression(node.obj)
+    elif t == PostIncDec:
+        return format_expression(node.obj) + node.op
+    elif t == ArrayInitializer:
+        return '[' + ', '.join(format_expression(i) for i in node.items) + ']'
+    elif t == NewArray:
+        return 'new ' + str(node.basetype) + '[' + format_expression(node.size) + ']'
+
+    return '<' + t.__name__ + '>'
@@ -1,106 +1,25 @@
 from klang import *
 from kenvironment import KyazukenDocument
+import kcache
+import klex
+import kmetrics
+import kprof
+import kresolve
 
-from rply import LexerGenerator
 from rply import ParserGenerator
 from rply.errors import LexingError
 
+from concurrent.futures import ProcessPoolExecutor
 import os
 import sys
-
-class Lexer():
-    def __init__(self):
-        self.lexer = LexerGenerator()
-
-    def _add_tokens(self):
-        # Various types
-        self.lexer.add('INTTYPE', r'\b[u]{0,1}int(8|16|32|64|)\b')
-        self.lexer.add('FLOATTYPE', r'\bfloat(32|64|)\b')
-        self.lexer.add('VOID', r'\bvoid\b')
-        self.lexer.add('STRINGTYPE', r'\bString\b')
-        self.lexer.add('BOOL', r'\bbool\b')
-
-        # Other reserved words
-        self.lexer.add('IF', r'\bif\b')
-        self.lexer.add('ELSE', r'\belse\b')
-        self.lexer.add('WHILE', r'\bwhile\b')
-        self.lexer.add('FOR', r'\bfor\b')
-        self.lexer.add('CLASS', r'\bclass\b')
-        self.lexer.add('OPERATOR', r'\boperator\b')
-        self.lexer.add('MUTABLE', r'\bmutable\b')
-        self.lexer.add('PUBLIC', r'\bpublic\b')
-        self.lexer.add('PRIVATE', r'\bprivate\b')
-        self.lexer.add('IMPORT', r'\bimport\b')
-
-        self.lexer.add('RETURN', r'\breturn\b')
-        self.lexer.add('EXTENDS', r'\bextends\b')
-
-        self.lexer.add('NEW', r'\bnew\b')
-
-        # Name of function or variable
-        self.lexer.add('NAME', r'[a-zA-Z_$][a-zA-Z_$0-9]*')
-        # Number
-        self.lexer.add('DOUBLE', r'\d+[.]\d+')
-        self.lexer.add('INTEGER', r'\d+')
-        # Parenthesis, Curly Braces, and Brackets
-        self.lexer.add('OPEN_PAREN', r'\(')
-        self.lexer.add('CLOSE_PAREN', r'\)')
-        self.lexer.add('OPEN_CURLY', r'\{')
-        self.lexer.add('CLOSE_CURLY', r'\}')
-        self.lexer.add('OPEN_BRACKET', r'\[')
-        self.lexer.add('CLOSE_BRACKET', r'\]')
-        # Syntax Helper Bytes
-        self.lexer.add('SEMICOLON', r'\;')
-        self.lexer.add('COMMA', r'\,')
-        self.lexer.add('CHAR', r"\'([^\\\n\r]|\\[rnft\'])\'")
-        self.lexer.add('STRING', r'\"[^"]*\"')
-        # Operators
-        self.lexer.add('!=', '!=')
-        self.lexer.add('==', '==')
-        self.lexer.add('>=', '>=')
-        self.lexer.add('<=', '<=')
-        self.lexer.add('++', '[+][+]')
-        self.lexer.add('--', '[-][-]')
-        self.lexer.add('+=', '[+]=')
-        self.lexer.add('-=', '[-]=')
-        self.lexer.add('*=', '[*]=')
-        self.lexer.add('/=', '[/]=')
-        self.lexer.add('>', '[>]')
-        self.lexer.add('<', '[<]')
-        self.lexer.add('>>', '[>][>]')
-        self.lexer.add('<<', '[<][<]')
-        self.lexer.add('>>=', '>>=')
-        self.lexer.add('<<=', '<<=')
-        self.lexer.add('^^', r'\^\^')
-        self.lexer.add('&&', r'\&\&')
-        self.lexer.add('||', r'\|\|')
-        self.lexer.add('SUM', r'\+')
-        self.lexer.add('SUB', r'\-')
-        self.lexer.add('MUL', r'\*')
-        self.lexer.add('DIV', r'\/')
-        self.lexer.add('XOR', r'\^')
-        self.lexer.add('AND', r'\&')
-        self.lexer.add('OR', r'\|')
-        self.lexer.add('EQ', r'\=')
-        self.lexer.add('MOD', r'\%')
-        self.lexer.add('MEMBER', r'\.')
-        self.lexer.add('NOT', r'\!')
-        # the rest
-        self.lexer.add('COLON', r'\:')
-        # Ignore comments
-        self.lexer.ignore(r'\/\*.*\*\/')
-        self.lexer.ignore(r'\/\/.*(\n|\r)')
-        # Ignore spaces
-        self.lexer.ignore('\s+')
-
-    def get_lexer(self):
-        self._add_tokens()
-        return self.lexer.build()
+import time
 
 OP_NAMES = ['SUM', 'SUB', 'MUL', 'DIV', 'OR', 'AND', 'XOR', 'MOD',
-            '==', '!=', '<=', '>=', '<', '>', '||', '&&', '^^',
+            '==', '!=', '<=', '>=', '<', '>', 'LOGIC_OR', '&&', '^^',
             '+=', '-=', '*=', '/=', '<<', '>>', '<<=', '>>=', '++', '--']
 
+GRAMMAR_CACHE_ID = 'kyazuken'
+
 class KSyntaxError(Exception):
     def __init__(self, token):
         super().__init__(token)
@@ -109,7 +28,7 @@ class KSyntaxError(Exception):
         return "Unexpected '" + self.token.getstr() + "' on line " + str(self.token.getsourcepos().lineno)
 
 class KyazukenParser:
-    def __init__(self, file):
+    def __init__(self):
         self.pg = ParserGenerator(
             # A list of all token names accepted by the parser.
             ['INTEGER', 'NAME', 'OPEN_PAREN', 'CLOSE_PAREN', 'INTTYPE', 'MEMBER', 'FLOATTYPE',
@@ -121,8 +40,10 @@ class KyazukenParser:
                 ('right', ['ELSE']),
                 ('left', ['IF', 'COLON', 'END', 'WHILE', 'NEW']),
                 ('left', ['EQ']),
-                ('left', ['&&', '||', '^^']),
+                ('right', ['+=', '-=', '*=', '/=', '<<=', '>>=']),
+                ('left', ['&&', 'LOGIC_OR', '^^']),
                 ('left', ['==', '!=', '>=','>', '<', '<=',]),
+                ('left', ['<<', '>>']),
                 ('left', ['SUM', 'SUB',]),
                 ('left', ['MUL', 'DIV', 'MOD']),
                 ('left', ['AND', 'OR', 'XOR']),
@@ -131,11 +52,11 @@ class KyazukenParser:
                 ('left', ['OPEN_BRACKET','CLOSE_BRACKET', 'COMMA']),
                 ('left', ['MEMBER']),
                 ('left', ['NAME', 'INTEGER', 'DOUBLE', 'STRINGTYPE', 'BOOL']),
-            ]
+            ],
+            # rply keeps the LALR tables on disk under this id, keyed by a hash of the grammar
+            cache_id = GRAMMAR_CACHE_ID
         )
 
-        self.path = file
-
     def parse(self):
         @self.pg.production('program : toplevel')
         def pgm_1(p):
@@ -161,11 +82,11 @@ class KyazukenParser:
 
         @self.pg.production('class : MUTABLE CLASS NAME OPEN_CURLY class_li CLOSE_CURLY')
         def class_def_mutable(p):
-            return ClassDefinition(p[1].getstr(), p[3])
+            return ClassDefinition(p[2].getstr(), p[4])
 
         @self.pg.production('class : MUTABLE CLASS NAME EXTENDS NAME OPEN_CURLY class_li CLOSE_CURLY')
         def class_inherit_mutable(p):
-            return ClassInheriting(p[1].getstr(), p[5], p[3].getstr())
+            return ClassInheriting(p[2].getstr(), p[6], p[4].getstr())
 
         @self.pg.production('import : IMPORT import_path SEMICOLON')
         def import_statement(p):
@@ -243,6 +164,10 @@ class KyazukenParser:
         def new_object(p):
             return NewObject(p[1].getstr(), p[3])
 
+        @self.pg.production('expression : NEW type OPEN_BRACKET expression CLOSE_BRACKET')
+        def new_sized_array(p):
+            return NewArray(p[1], p[3])
+
         @self.pg.production('statement_li : statement')
         def statement_list_1(p):
             return [p[0]]
@@ -351,7 +276,33 @@ class KyazukenParser:
         def subscript(p):
             return Subscript(p[0], p[2])
 
-        @self.pg.production('expression : expression dualop expression')
+        # One production per operator (rather than 'expression dualop expression') so
+        # that rply can apply the operator precedence table
+        @self.pg.production('expression : expression SUM expression')
+        @self.pg.production('expression : expression SUB expression')
+        @self.pg.production('expression : expression MUL expression')
+        @self.pg.production('expression : expression DIV expression')
+        @self.pg.production('expression : expression MOD expression')
+        @self.pg.production('expression : expression AND expression')
+        @self.pg.production('expression : expression OR expression')
+        @self.pg.production('expression : expression XOR expression')
+        @self.pg.production('expression : expression >= expression')
+        @self.pg.production('expression : expression == expression')
+        @self.pg.production('expression : expression != expression')
+        @self.pg.production('expression : expression <= expression')
+        @self.pg.production('expression : expression > expression')
+        @self.pg.production('expression : expression < expression')
+        @self.pg.production('expression : expression LOGIC_OR expression')
+        @self.pg.production('expression : expression && expression')
+        @self.pg.production('expression : expression ^^ expression')
+        @self.pg.production('expression : expression << expression')
+        @self.pg.production('expression : expression >> expression')
+        @self.pg.production('expression : expression <<= expression')
+        @self.pg.production('expression : expression >>= expression')
+        @self.pg.production('expression : expression += expression')
+        @self.pg.production('expression : expression -= expression')
+        @self.pg.production('expression : expression *= expression')
+        @self.pg.production('expression : expression /= expression')
         def expression(p):
             left = p[0]
             right = p[2]
@@ -376,7 +327,7 @@ class KyazukenParser:
         @self.pg.production('dualop : <=')
         @self.pg.production('dualop : >')
         @self.pg.production('dualop : <')
-        @self.pg.production('dualop : ||')
+        @self.pg.production('dualop : LOGIC_OR')
         @self.pg.production('dualop : &&')
         @self.pg.production('dualop : ^^')
         @self.pg.production('dualop : <<')
@@ -437,15 +388,15 @@ class KyazukenParser:
 
         @self.pg.production('expression : INTEGER')
         def number(p):
-            return Literal('int', int(p[0].getstr()))
+            return Literal('int32', int(p[0].getstr()))
 
         @self.pg.production('expression : DOUBLE')
         def number(p):
-            return Literal('float', float([0].getstr()))
+            return Literal('float32', float(p[0].getstr()))
 
         @self.pg.production('expression : CHAR')
         def number(p):
-            return Literal('int', ord(eval(p[0].getstr())))
+            return Literal('int32', ord(eval(p[0].getstr())))
 
         @self.pg.production('type : type OPEN_BRACKET CLOSE_BRACKET')
         def array_type(p):
@@ -464,96 +415,197 @@ class KyazukenParser:
                 s = 'int32'
             elif s == 'float':
                 s = 'float32'
+            elif s == 'char':
+                # Character literals and String indexing give int32 codes
+                s = 'int32'
 
             return s
 
         @self.pg.error
         def error_handle(token):
-            src = token.getsourcepos()
-            print("Syntax error at " + self.path + ':' + str(src.lineno))
             raise KSyntaxError(token)
 
     def get_parser(self):
         return self.pg.build()
 
+# The lexer and parser only depend on the grammar, so they are built once per process
+# and shared by every file that gets parsed.
+_lexer = None
+_parser = None
+
+def get_lexer():
+    global _lexer
+    if _lexer is None:
+        _lexer = klex.Scanner()
+    return _lexer
+
+def get_parser():
+    global _parser
+    if _parser is None:
+        pg = KyazukenParser()
+        pg.parse()
+        _parser = pg.get_parser()
+    return _parser
+
+def read_source(filename):
+    with open(filename) as f:
+        return f.read().replace('\r', '\n')
+
+def report_syntax_error(filename, text, srcpos, message):
+    lines = [''] + text.split('\n')
+
+    print("Syntax error at " + filename + ':' + str(srcpos.lineno))
+    print(message)
+    print(lines[srcpos.lineno].replace('\t', ' '))
+    print(' '*(srcpos.colno - 1) + '^ here')
+    print()
+
 def parse_ast(filename):
-    print("Parsing " + filename)
+    with kmetrics.phase('parse_ast'):
+        print("Parsing " + filename)
 
-    f = open(filename)
-    text = f.read().replace('\r', '\n')
-    f.close()
+        text = read_source(filename)
 
-    lines = [''] + text.split('\n')
+        try:
+            tokens = get_lexer().lex(text)
+        except LexingError as e:
+            report_syntax_error(filename, text, e.source_pos, e.message)
+            return None
 
-    try:
-        lexer = Lexer().get_lexer()
-        tokens = lexer.lex(text)
-    except LexingError as e:
-        srcpos = e.source_pos
-        print(e)
-        if srcpos.lineno > 0:
-            print(lines[srcpos.lineno].replace('\t', ' '))
-            print(' '*(srcpos.colno - 1) + '^ here')
-        else:
-            i = text[:srcpos.idx].rfind('\n') + 1
-            print(text[i:].split('\n')[0].replace('\t', ' '))
-            print(' '*(srcpos.idx - i) + '^ here')
-        print()
-        return None
+        try:
+            return get_parser().parse(tokens)
+        except KSyntaxError as e:
+            report_syntax_error(filename, text, e.token.getsourcepos(), str(e))
+            return None
 
-    pg = KyazukenParser(filename)
-    pg.parse()
-    parser = pg.get_parser()
+def load_ast(filename):
+    ast = kcache.load_ast(filename)
 
-    try:
-        return parser.parse(tokens)
-    except KSyntaxError as e:
-        srcpos = e.token.getsourcepos()
-        print(e)
-        print(lines[srcpos.lineno].replace('\t', ' '))
-        print(' '*(srcpos.colno - 1) + '^ here')
-        print()
-        return None
+    if ast is None:
+        ast = parse_ast(filename)
+        if ast is not None:
+            kcache.store_ast(filename, ast)
+
+    return ast
 
 FILE_EXTENTIONS = ['.kya', '.k']
 
-def elaborate_ast(ast, filename, docs = None):
-    doc = KyazukenDocument()
+def resolve_import(statement, filename):
+    root_path = os.path.dirname(filename) or '.'
+    path = statement.path.replace('.', root_path)
 
-    root_path = os.path.dirname(filename)
+    for j in FILE_EXTENTIONS:
+        if os.path.exists(path + j):
+            path += j
+            break
 
-    if docs == None:
-        docs = {filename: doc}
+    if not '.' in path.split('/')[-1]:
+        return None
 
-    all_statements = ast.copy()
+    return os.path.normpath(path)
+
+def _parse_many(paths, jobs):
+    # Files that are already in the AST cache are cheap to load here, only the rest is
+    # worth shipping to worker processes.
+    asts = {}
+    to_parse = []
+    for path in paths:
+        ast = kcache.load_ast(path)
+        if ast is None:
+            to_parse.append(path)
+        else:
+            asts[path] = ast
+
+    if len(to_parse) > 1 and jobs != 1:
+        with ProcessPoolExecutor(max_workers = jobs) as pool:
+            asts.update(zip(to_parse, pool.map(load_ast, to_parse)))
+    else:
+        for path in to_parse:
+            asts[path] = load_ast(path)
+
+    return asts
 
+def build_import_graph(ast, filename, known = (), jobs = None):
+    # Parse filename and everything it imports, each file exactly once.  Imports are
+    # discovered breadth first and every wave of new files is parsed in parallel.
+    # Files in known (already elaborated) are not parsed again.
+
+    asts = {filename: ast}
+    imports = {}
     errors = 0
 
-    for i in ast:
-        if type(i) == ImportStatement:
-            path = i.path.replace('.', root_path)
+    wave = [filename]
+    while len(wave) > 0:
+        discovered = []
+
+        for path in wave:
+            imports[path] = []
 
-            for j in FILE_EXTENTIONS:
-                if os.path.exists(path + j):
-                    path += j
-                    break
+            for i in asts[path]:
+                if type(i) != ImportStatement:
+                    continue
 
-            if not '.' in path.split('/')[-1]:
-                print("Error: Could not import " + i.commonname + ' from file ' + filename)
+                dep = resolve_import(i, path)
+                if dep is None:
+                    print("Error: Could not import " + i.commonname + ' from file ' + path)
+                    errors += 1
+                    continue
+
+                if not dep in imports[path]:
+                    imports[path].append(dep)
+                if not dep in asts and not dep in known and not dep in discovered:
+                    discovered.append(dep)
+
+        wave = []
+        for path, new_ast in _parse_many(discovered, jobs).items():
+            if new_ast is None:
+                print("Skipping " + path + " due to syntax error(s), will continue elaboration without it")
+                print()
                 errors += 1
             else:
-                new_ast = parse_ast(path)
-                if new_ast is None:
-                    print("Skipping " + path + " due to syntax error(s), will continue elaboration without it")
-                    print()
-                    errors += 1
-                else:
-                    imported_doc, docs, new_errors = elaborate_ast(new_ast, path, docs)
-                    doc.add_imported_document(imported_doc)
-                    errors += new_errors
+                asts[path] = new_ast
+                wave.append(path)
+
+    return asts, imports, errors
+
+def dependency_order(filename, imports):
+    # Depth first post-order, so every file comes after the files it imports
+    order = []
+    errors = 0
+    state = {}
+    stack = []
+
+    def visit(path):
+        nonlocal errors
+
+        state[path] = 'visiting'
+        stack.append(path)
+
+        for dep in imports.get(path, []):
+            if state.get(dep) == 'visiting':
+                cycle = stack[stack.index(dep):] + [dep]
+                print("Error: Circular import " + ' -> '.join(cycle))
+                errors += 1
+            elif not dep in state:
+                visit(dep)
+
+        stack.pop()
+        state[path] = 'done'
+        order.append(path)
+
+    visit(filename)
+
+    return order, errors
+
+def make_document(ast, imported = (), resolved = ()):
+    # Returns the document and the errors linking its classes.  Toplevels whose id() is in
+    # resolved were resolved by an earlier elaboration and are used as they are.
+    doc = KyazukenDocument()
 
     for i in ast:
         if type(i) == Function:
+            if not id(i) in resolved:
+                kresolve.resolve_function(i)
             if i.signature() in ['_Z4mainEPp6String', '_Z4mainEPp6String', '_Z4mainEP']:
                 # main function
                 doc.entry = i
@@ -562,24 +614,180 @@ def elaborate_ast(ast, filename, docs = None):
         elif type(i) in [ClassDefinition, ClassInheriting]:
             doc.classes[i.name] = i
 
-    return doc, docs, errors
+    # Parents may be defined in imported documents
+    visible = {}
+    for i in imported:
+        visible.update(i.classes)
+    visible.update(doc.classes)
 
-filename = 'kyac/main.k'
+    return doc, kresolve.resolve_classes(doc.classes, visible, resolved)
 
-ast = parse_ast(filename)
+def elaborate_ast(ast, filename, docs = None, jobs = None):
+    with kmetrics.phase('elaborate_ast'):
+        filename = os.path.normpath(filename)
 
-print('Elaborate...')
-document, documents, errors = elaborate_ast(ast, filename)
+        if docs == None:
+            docs = {}
 
-if errors == 0:
-    print('Execute:')
+        if filename in docs:
+            return docs[filename], docs, 0
+
+        asts, imports, errors = build_import_graph(ast, filename, docs, jobs)
+
+        order, cycle_errors = dependency_order(filename, imports)
+        errors += cycle_errors
+
+        for path in order:
+            if path in docs or not path in asts:
+                continue
+
+            # Dependencies that failed to parse or close a cycle have no document
+            imported = [docs[dep] for dep in imports[path] if dep in docs]
+
+            doc, class_errors = make_document(asts[path], imported)
+            for i in class_errors:
+                print("Error: " + i)
+            errors += len(class_errors)
+
+            for i in imported:
+                doc.add_imported_document(i)
+            docs[path] = doc
 
-    env = document.make_default_env()
+        return docs[filename], docs, errors
+
+def check_document(document, env):
+    # Checks, optimizes and links the program; returns the number of errors, which are
+    # printed.  The checker sees the code before the optimizer can remove any of it, and
+    # again after to bind the code the optimizer made.
+    if document.entry is None:
+        print("Error: no main function")
+        return 1
+
+    check_errors = document.check(env)
+    if len(check_errors) == 0:
+        document.optimize(env)
+        check_errors = document.check(env)
+    for i in check_errors:
+        print("Error: " + i)
+    return len(check_errors)
+
+def run_document(document, env, argv, engine, profiler = None):
+    # Returns the number of errors, 1 if the program failed
+    print('Execute:')
 
     try:
-        document.execute(env, ['kyac', 'kyac/main.k'])
+        document.execute(env, argv, engine, profiler)
     except KyazukenError as e:
         sys.stderr.write("Error: " + str(e) + '\n')
-else:
-    print("There were errors.  Will not execute.")
-
+        return 1
+    return 0
+
+def write_profile(profiler, path):
+    # The report goes to stderr, the collapsed stacks to path if one is given
+    sys.stderr.write(profiler.report())
+    if path != None:
+        with open(path, 'w') as f:
+            f.write(profiler.collapsed())
+
+USAGE = """usage: kparse.py [options] [script [arguments...]]
+
+Runs script (kyac/main.k compiling itself by default) with arguments as its argv,
+script first.  Options:
+  --time                   print the time of every phase to stderr
+  --watch                  run again whenever a source file changes
+  --profile[=MODE]         profile the program, MODE being deterministic or sample
+  --profile-out=FILE       write the collapsed stacks of the profile to FILE
+  --serve=SOCKET           serve compile requests on a Unix socket (see kserver.py)
+"""
+
+def write_times(times):
+    for name, seconds in times:
+        sys.stderr.write(name.ljust(12) + f'{seconds * 1000:10.2f} ms\n')
+
+def main(argv):
+    filename = 'kyac/main.k'
+    program_argv = ['kyac', 'kyac/main.k']
+    engine = os.environ.get('KYAZUKEN_ENGINE', 'tree')
+
+    profiler = None
+    profile_out = None
+    show_times = False
+    watch = False
+
+    # Options come before the script, anything after it belongs to the program
+    n = 1
+    while n < len(argv) and argv[n].startswith('--'):
+        i = argv[n]
+        n += 1
+
+        if i == '--time':
+            show_times = True
+        elif i == '--watch':
+            watch = True
+        elif i == '--profile':
+            profiler = kprof.DeterministicProfiler()
+        elif i.startswith('--profile='):
+            mode = i.split('=', 1)[1]
+            if not mode in kprof.PROFILERS:
+                print("Unknown profiler " + mode + ", use one of " + ', '.join(kprof.PROFILERS))
+                return 2
+            profiler = kprof.PROFILERS[mode]()
+        elif i.startswith('--profile-out='):
+            profile_out = i.split('=', 1)[1]
+        elif i.startswith('--serve='):
+            import kserver
+            return kserver.serve(i.split('=', 1)[1])
+        elif i == '--help':
+            sys.stdout.write(USAGE)
+            return 0
+        else:
+            sys.stderr.write("Unknown option " + i + '\n' + USAGE)
+            return 2
+
+    if n < len(argv):
+        filename = argv[n]
+        program_argv = argv[n:]
+
+    if watch:
+        import kwatch
+        kwatch.watch(filename, program_argv, engine)
+        return 0
+
+    if not os.path.isfile(filename):
+        print("Error: no such file " + filename)
+        return 1
+
+    times = []
+    start = time.perf_counter()
+    ast = load_ast(filename)
+    times.append(('parse', time.perf_counter() - start))
+
+    errors = 1 if ast is None else 0
+    if errors == 0:
+        print('Elaborate...')
+        start = time.perf_counter()
+        document, documents, errors = elaborate_ast(ast, filename)
+        times.append(('elaborate', time.perf_counter() - start))
+
+    if errors == 0:
+        start = time.perf_counter()
+        env = document.make_default_env()
+        errors += check_document(document, env)
+        times.append(('link', time.perf_counter() - start))
+
+    if errors == 0:
+        start = time.perf_counter()
+        errors = run_document(document, env, program_argv, engine, profiler)
+        times.append(('execute', time.perf_counter() - start))
+        if profiler != None:
+            write_profile(profiler, profile_out)
+    else:
+        print("There were errors.  Will not execute.")
+
+    if show_times:
+        write_times(times)
+
+    return 0 if errors == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,250 @@
+from klang import *
+
+import sys
+import threading
+import time
+
+# Profilers for Kyazuken programs, installed over the functions of a program once the
+# execution engine is.  Both aggregate self and total time per function and per source
+# line (line numbers come from the lineinfo the parser attaches to statements) and keep
+# the time of every call stack, written out in the collapsed format flamegraph tools read.
+#
+# DeterministicProfiler wraps the call of every function and the execution of every
+# statement that has a line, and times each of them.  Lines are only seen on code the
+# tree-walker runs, the other engines do not go through statements.
+#
+# SamplingProfiler only maintains a stack of the functions being called and lets a thread
+# snapshot it every interval seconds.  The line a sample is attributed to is read from the
+# Python frames of the statement being executed.
+
+# Statement classes whose instances may carry a lineinfo
+STATEMENTS = [Expression, IfBlock, IfElseBlock, WhileBlock, IterForBlock, CForBlock,
+              VariableDeclaration, VariableDefinition, Return, SuperConstructor]
+
+class Stats:
+    def __init__(self):
+        self.count = 0
+        self.self_time = 0.0
+        self.total_time = 0.0
+
+class Profiler:
+    # 'count' is the number of calls, or of samples for the sampling profiler
+    count_name = 'calls'
+
+    def __init__(self):
+        self.functions = {}
+        self.lines = {}
+        self.stacks = {}
+        self.saved = {}
+
+    def install(self, functions):
+        for f in functions:
+            if f is None or id(f) in self.saved:
+                continue
+            self.saved[id(f)] = (f, f.__dict__.get('call'))
+            f.call = self.wrap(f, label(f), f.call)
+
+    def uninstall(self):
+        for f, call in self.saved.values():
+            if call is None:
+                del f.call
+            else:
+                f.call = call
+        self.saved = {}
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stats(self, table, key):
+        if not key in table:
+            table[key] = Stats()
+        return table[key]
+
+    def collapsed(self):
+        # One 'caller;callee count' line per stack, in microseconds of self time
+        return '\n'.join(';'.join(stack) + ' ' + str(round(t * 1e6)) for stack, t in sorted(self.stacks.items())) + '\n'
+
+    def report(self, limit = 20):
+        lines = []
+        header = 'self(s)'.rjust(10) + 'total(s)'.rjust(10) + self.count_name.rjust(10) + '  '
+
+        lines.append('Functions by self time')
+        lines.append(header + 'function')
+        for name, s in sorted(self.functions.items(), key = lambda i: -i[1].self_time)[:limit]:
+            lines.append(f'{s.self_time:10.4f}{s.total_time:10.4f}{s.count:10d}  {name}')
+
+        lines.append('')
+        lines.append('Lines by self time')
+        lines.append(header + 'line')
+        for (name, line), s in sorted(self.lines.items(), key = lambda i: -i[1].self_time)[:limit]:
+            lines.append(f'{s.self_time:10.4f}{s.total_time:10.4f}{s.count:10d}  {name}:{line}')
+
+        return '\n'.join(lines) + '\n'
+
+class DeterministicProfiler(Profiler):
+    def __init__(self):
+        super().__init__()
+
+        # Open calls and lines: [function label, line or None, start, time of children]
+        self.frames = []
+        self.active = {}
+        self.patched = []
+
+    def enter(self, name, line):
+        key = (name, line)
+        self.active[key] = self.active.get(key, 0) + 1
+        self.frames.append([name, line, time.perf_counter(), 0.0])
+
+    def leave(self):
+        name, line, start, children = self.frames.pop()
+        elapsed = time.perf_counter() - start
+        if len(self.frames) > 0:
+            self.frames[-1][3] += elapsed
+
+        if line is None:
+            s = self.stats(self.functions, name)
+            stack = tuple(i[0] for i in self.frames if i[1] is None) + (name,)
+            self.stacks[stack] = self.stacks.get(stack, 0.0) + elapsed - children
+        else:
+            s = self.stats(self.lines, (name, line))
+
+        # Time of recursive calls is only counted once in the total
+        key = (name, line)
+        self.active[key] -= 1
+        if self.active[key] == 0:
+            s.total_time += elapsed
+        s.count += 1
+        s.self_time += elapsed - children
+
+    def wrap(self, f, name, call):
+        def profiled(environment, arguments):
+            self.enter(name, None)
+            try:
+                return call(environment, arguments)
+            finally:
+                self.leave()
+        return profiled
+
+    def hook(self, method):
+        def hooked(node, context):
+            if not hasattr(node, 'lineinfo') or len(self.frames) == 0:
+                return method(node, context)
+
+            # Lines belong to the innermost function being called
+            for i in reversed(self.frames):
+                if i[1] is None:
+                    name = i[0]
+                    break
+
+            self.enter(name, node.lineinfo.lineno)
+            try:
+                return method(node, context)
+            finally:
+                self.leave()
+        return hooked
+
+    def start(self):
+        for cls in STATEMENTS:
+            for m in ['execute', 'run']:
+                if m in cls.__dict__:
+                    self.patched.append((cls, m, cls.__dict__[m]))
+                    setattr(cls, m, self.hook(cls.__dict__[m]))
+
+    def stop(self):
+        for cls, m, method in self.patched:
+            setattr(cls, m, method)
+        self.patched = []
+
+class SamplingProfiler(Profiler):
+    count_name = 'samples'
+
+    def __init__(self, interval = 0.001):
+        super().__init__()
+        self.interval = interval
+        self.calls = []
+        self.thread = None
+        self.running = False
+        self.target = None
+
+        self.statement_code = set()
+        for cls in STATEMENTS:
+            for m in ['execute', 'run']:
+                if m in cls.__dict__:
+                    self.statement_code.add(cls.__dict__[m].__code__)
+
+    def wrap(self, f, name, call):
+        calls = self.calls
+
+        def sampled(environment, arguments):
+            calls.append(name)
+            try:
+                return call(environment, arguments)
+            finally:
+                calls.pop()
+
+        self.wrapper_code = sampled.__code__
+        return sampled
+
+    def current_line(self):
+        # Line of the innermost statement, if it runs in the innermost function
+        frame = sys._current_frames().get(self.target)
+        while frame != None:
+            if frame.f_code is self.wrapper_code:
+                return None
+            if frame.f_code in self.statement_code:
+                node = frame.f_locals.get('self')
+                if hasattr(node, 'lineinfo'):
+                    return node.lineinfo.lineno
+            frame = frame.f_back
+        return None
+
+    def sample(self, elapsed):
+        stack = tuple(self.calls)
+        if len(stack) == 0:
+            return
+        line = self.current_line()
+
+        self.stacks[stack] = self.stacks.get(stack, 0.0) + elapsed
+
+        for name in set(stack):
+            s = self.stats(self.functions, name)
+            s.count += 1
+            s.total_time += elapsed
+        self.functions[stack[-1]].self_time += elapsed
+
+        if line != None:
+            s = self.stats(self.lines, (stack[-1], line))
+            s.count += 1
+            s.self_time += elapsed
+            s.total_time += elapsed
+
+    def loop(self):
+        last = time.perf_counter()
+        while self.running:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            self.sample(now - last)
+            last = now
+
+    def start(self):
+        # The sampling thread only gets to run when the interpreter switches threads
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self.switch_interval, self.interval / 2))
+
+        self.target = threading.get_ident()
+        self.running = True
+        self.thread = threading.Thread(target = self.loop, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        sys.setswitchinterval(self.switch_interval)
+
+PROFILERS = {
+    'deterministic': DeterministicProfiler,
+    'sample': SamplingProfiler
+    }
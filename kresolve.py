@@ -0,0 +1,183 @@
+from klang import *
+
+# Resolver pass, run at elaboration time.  Every local variable of a function gets a
+# fixed slot in the function's frame: arguments take the first slots, and each
+# declaration gets a new slot unless it redeclares a name of the same scope.  Loops open
+# a nested scope whose variables live in the same frame, so no frame is ever created for
+# a block.  Variables that do not resolve keep slot None and fail when executed.
+# Resolved variables also get the declared type of their variable as static_type.
+# In class members 'this' takes the first slot, and bare names of fields and methods of
+# the class are rewritten to members of 'this'.  A subclass is resolved after its parent,
+# whose fields and methods it inherits.
+
+class Resolver:
+    def __init__(self, _class = None):
+        self.scopes = [{}]
+        self.nslots = 0
+        self._class = _class
+
+    def declare(self, node):
+        scope = self.scopes[-1]
+        if node.name in scope:
+            node.slot = scope[node.name].slot
+        else:
+            node.slot = self.nslots
+            self.nslots += 1
+        scope[node.name] = node
+
+    def lookup(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        return None
+
+    def function(self, f):
+        for i in f.params:
+            self.declare(i)
+
+        f.statements = [self.statement(i) for i in f.statements]
+
+        f.nslots = self.nslots
+
+    def statement(self, node):
+        t = type(node)
+
+        if t == VariableDeclaration:
+            self.declare(node)
+        elif t == VariableDefinition:
+            node.expr = self.expression(node.expr)
+            self.declare(node)
+        elif t == StatementList:
+            node.statements = [self.statement(i) for i in node.statements]
+        elif t == IfBlock or t == WhileBlock:
+            node.condition = self.expression(node.condition)
+            node.statement = self.statement(node.statement)
+        elif t == IfElseBlock:
+            node.condition = self.expression(node.condition)
+            node.statement = self.statement(node.statement)
+            node.else_statement = self.statement(node.else_statement)
+        elif t == CForBlock:
+            self.scopes.append({})
+            node.loop_init = self.statement(node.loop_init)
+            node.loop_condition = self.expression(node.loop_condition)
+            node.loop_code = self.statement(node.loop_code)
+            node.loop_end = self.expression(node.loop_end)
+            self.scopes.pop()
+        elif t == IterForBlock:
+            node.iterable = self.expression(node.iterable)
+            self.scopes.append({})
+            self.declare(node.vardec)
+            node.statement = self.statement(node.statement)
+            self.scopes.pop()
+        elif t == Return:
+            if node.val != None:
+                node.val = self.expression(node.val)
+        elif t == SuperConstructor:
+            node.args = [self.expression(i) for i in node.args]
+            if self._class != None:
+                node.parent = self._class.parent
+        elif isinstance(node, Expression):
+            return self.expression(node)
+
+        return node
+
+    def this_member(self, name):
+        return self.expression(Member(Variable('this'), name))
+
+    def expression(self, node):
+        t = type(node)
+
+        if t == Variable:
+            declaration = self.lookup(node.name)
+            if declaration is None:
+                if self._class != None and node.name in self._class.offsets:
+                    return self.this_member(node.name)
+                node.slot = None
+                node.static_type = None
+            else:
+                node.slot = declaration.slot
+                node.static_type = declaration.type
+        elif t == BinOp:
+            node.left = self.expression(node.left)
+            node.right = self.expression(node.right)
+        elif t == Store:
+            node.expr = self.expression(node.expr)
+            node.obj = self.expression(node.obj)
+        elif t == FunctionCall:
+            node.args = [self.expression(i) for i in node.args]
+            # A plain name being called is a function, or a method of this class
+            if type(node.func) != Variable:
+                node.func = self.expression(node.func)
+            elif self._class != None and node.func.name in self.method_names():
+                node.func = self.this_member(node.func.name)
+        elif t == NewObject:
+            node.args = [self.expression(i) for i in node.args]
+        elif t == Subscript:
+            node.src = self.expression(node.src)
+            node.idx = self.expression(node.idx)
+        elif t == Member:
+            node.src = self.expression(node.src)
+        elif t == UniOp:
+            node.left = self.expression(node.left)
+        elif t == PreIncDec or t == PostIncDec:
+            node.obj = self.expression(node.obj)
+        elif t == ArrayInitializer:
+            node.items = [self.expression(i) for i in node.items]
+        elif t == NewArray:
+            node.size = self.expression(node.size)
+
+        return node
+
+    def method_names(self):
+        return [i.name for i in self._class.vtable]
+
+def resolve_function(f):
+    Resolver().function(f)
+
+def resolve_class(_class, parent = None):
+    _class.parent = parent
+    _class.make_layout()
+
+    # Field initializers run without a frame
+    for i in _class.vars.values():
+        if type(i) == VariableDefinition:
+            i.expr = Resolver().expression(i.expr)
+
+    for i in list(_class.con.values()) + list(_class.func.values()):
+        Resolver(_class).function(i)
+
+def resolve_classes(classes, visible, resolved = ()):
+    # Links the classes of a document to their parents, which may come from an imported
+    # document (visible maps every class name in reach to its ClassDefinition), and
+    # resolves each one after its parent.  Classes whose id() is in resolved already are.
+    # Returns the error messages.
+    errors = []
+    state = {}
+
+    def visit(_class):
+        if id(_class) in resolved:
+            state[_class.name] = 'done'
+            return
+
+        state[_class.name] = 'visiting'
+
+        parent = None
+        if _class.inherited != None:
+            parent = visible.get(_class.inherited)
+            if parent is None:
+                errors.append('Class ' + _class.name + ' extends unknown class ' + _class.inherited)
+                parent = None
+            elif state.get(parent.name) == 'visiting':
+                errors.append('Class ' + _class.name + ' inherits from itself')
+                parent = None
+            elif parent.name in classes and not parent.name in state:
+                visit(parent)
+
+        resolve_class(_class, parent)
+        state[_class.name] = 'done'
+
+    for i in classes.values():
+        if not i.name in state:
+            visit(i)
+
+    return errors
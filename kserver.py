@@ -0,0 +1,185 @@
+import contextlib
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import traceback
+
+# Compile server.  A long-lived process listening on a Unix socket, with the grammar
+# tables built, klib loaded and the parsed trees of every file it has seen kept in memory
+# (see kcache.memory).  Each request is the command line of kparse.py along with the
+# client's working directory, environment, and stdin/stdout/stderr passed as file
+# descriptors.  The server makes sure the script and its imports are parsed, then forks:
+# the child runs kparse.main with the client's descriptors and sends back its exit
+# status, so every run starts from the preloaded state and runs leave nothing behind.
+#
+#   python kparse.py --serve=SOCKET
+#   python kserver.py --connect=SOCKET [kparse options] script [arguments...]
+#
+# The client side only needs the standard library.  When no server listens on the socket
+# the client runs the script itself.  Settings read from the environment when modules
+# are loaded (buffer sizes, stack limit, metrics) are those of the server.
+
+HEADER = struct.Struct('!I')
+STATUS = struct.Struct('!i')
+
+def recv_exactly(conn, n):
+    data = b''
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def send_request(path, argv):
+    # Returns the exit status of the run, None if no server listens on path
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        body = json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ)}).encode()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        socket.send_fds(sock, [HEADER.pack(len(body))], [0, 1, 2])
+        sock.sendall(body)
+
+        reply = recv_exactly(sock, STATUS.size)
+
+    if reply is None:
+        sys.stderr.write('Error: the compile server closed the connection\n')
+        return 1
+    return STATUS.unpack(reply)[0]
+
+def script_of(argv):
+    for i in argv:
+        if not i.startswith('--'):
+            return i
+    return 'kyac/main.k'
+
+def warm(kparse, argv):
+    # Parses the script and its imports into the memory cache.  Errors are left for the
+    # run to report.
+    filename = script_of(argv)
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        try:
+            ast = kparse.load_ast(filename)
+            if ast is not None:
+                kparse.build_import_graph(ast, os.path.normpath(filename), jobs = 1)
+        except Exception:
+            pass
+
+def run_child(kparse, klib, conn, fds, request):
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    os.environ.clear()
+    os.environ.update(request['env'])
+    klib.stdout.size = klib.stdout_buffer_size()
+
+    try:
+        status = kparse.main(['kparse.py'] + request['argv'])
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+
+    try:
+        klib.stdout.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        conn.sendall(STATUS.pack(status or 0))
+    except OSError:
+        pass
+    os._exit(0)
+
+def handle(kparse, klib, listener, conn):
+    msg, fds, flags, addr = socket.recv_fds(conn, HEADER.size, 3)
+    try:
+        if len(msg) != HEADER.size or len(fds) != 3:
+            return
+
+        body = recv_exactly(conn, HEADER.unpack(msg)[0])
+        if body is None:
+            return
+        request = json.loads(body)
+
+        os.chdir(request['cwd'])
+        warm(kparse, request['argv'])
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork() == 0:
+            listener.close()
+            run_child(kparse, klib, conn, fds, request)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+def serve(path):
+    # Imported here so clients do not pay for them
+    import kcache
+    import klib
+    import kparse
+
+    kparse.get_lexer()
+    kparse.get_parser()
+    kcache.memory = {}
+
+    # A socket left over by a server that died can be replaced, anything else cannot
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            sys.stderr.write('Error: ' + path + ' exists and is not a socket\n')
+            return 1
+        os.unlink(path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(64)
+
+    # Children are reaped by the system
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    print('Serving on ' + path)
+    sys.stdout.flush()
+
+    try:
+        while True:
+            conn, addr = listener.accept()
+            with conn:
+                try:
+                    handle(kparse, klib, listener, conn)
+                except (OSError, ValueError, KeyError) as e:
+                    sys.stderr.write('Error: bad request: ' + str(e) + '\n')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.unlink(path)
+
+    return 0
+
+def main(argv):
+    if len(argv) < 2 or not argv[1].startswith('--connect='):
+        sys.stderr.write('usage: kserver.py --connect=SOCKET [kparse options] script [arguments...]\n')
+        return 2
+
+    status = send_request(argv[1].split('=', 1)[1], argv[2:])
+    if status is None:
+        import kparse
+        status = kparse.main(['kparse.py'] + argv[2:])
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,333 @@
+from kvm import *
+
+import os
+
+# Stackless engine.  Bodies are compiled to the bytecode of kvm, but a call from one
+# compiled function to another does not go through Python: the caller's frame (code,
+# slots, pc and the base of its operand stack) is saved on an explicit list of frames and
+# the interpreter loop carries on in the callee.  Kyazuken recursion is thus bounded by
+# KYAZUKEN_STACK_LIMIT frames instead of the Python recursion limit.  A call directly
+# followed by RETURN (return f(...);) reuses the frame of the caller.
+#
+# Targets running on anything else than this loop (builtins, functions the compiler does
+# not know, functions wrapped by a profiler) are called through their call attribute.
+
+STACK_LIMIT = int(os.environ.get('KYAZUKEN_STACK_LIMIT', 1 << 20))
+
+# Every call and NEW is rewritten to INVOKE, its argument being (original opcode,
+# original argument, whether the call is a tail call)
+INVOKE = 40
+
+CALLS = [CALL, CALL_BOUND, CALL_METHOD, CALL_VIRTUAL, NEW]
+
+def pop_values(stack, n):
+    if n > 0:
+        values = stack[-n:]
+        del stack[-n:]
+        return values
+    return []
+
+def method_target(environment, receiver, name, argtypes, values):
+    # Same resolution as call_method, returning the function and its arguments
+    return get_method(environment, receiver, name, argtypes), [receiver] + values
+
+def run(entry, environment, arguments):
+    code = entry
+    ops = code.ops
+    args = code.args
+    consts = code.consts
+
+    frame = list(zip(code.argtypes, arguments)) + code.padding
+
+    # Saved callers: (code, frame, pc, base, result), result replacing the value the
+    # callee returns (the new object, for constructors)
+    frames = []
+    base = 0
+    result = None
+
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    pc = 0
+
+    while True:
+        op = ops[pc]
+        arg = args[pc]
+        pc += 1
+
+        if op == LOAD:
+            value = frame[arg]
+            if value is None:
+                raise code.undeclared(arg)
+            push(value)
+        elif op == COMPARE_CONST:
+            compare, b, target = arg
+            if not compare(pop()[1], b):
+                pc = target
+        elif op == JUMP:
+            pc = arg
+        elif op == BINARY_CONST:
+            operation, b = arg
+            a = stack[-1]
+            stack[-1] = operation(a[0], a[1], b[0], b[1])
+        elif op == TEST_CONST:
+            operation, b, target, msg = arg
+            a = pop()
+            t, v = operation(a[0], a[1], b[0], b[1])
+            if t != 'bool':
+                raise KyazukenError(msg)
+            if not v:
+                pc = target
+        elif op == BINARY_LOAD:
+            operation, slot = arg
+            a = stack[-1]
+            b = frame[slot]
+            if b is None:
+                raise code.undeclared(slot)
+            stack[-1] = operation(a[0], a[1], b[0], b[1])
+        elif op == STORE_POP:
+            value = pop()
+            old = frame[arg]
+            if old is None:
+                raise code.undeclared(arg)
+            if old[0] != value[0]:
+                if not is_subclass_instance(old[0], value[1]):
+                    msg = f'Attempted to assign value of type {value[0]} to variable of type {old[0]}'
+                    raise KyazukenError(msg)
+                value = (old[0], value[1])
+            frame[arg] = value
+        elif op == INCREMENT_LOCAL:
+            slot, delta = arg
+            old = frame[slot]
+            if old is None:
+                raise code.undeclared(slot)
+            frame[slot] = (old[0], old[1] + delta)
+        elif op == CONST:
+            push(consts[arg])
+        elif op == COMPARE:
+            compare, target = arg
+            b = pop()
+            if not compare(pop()[1], b[1]):
+                pc = target
+        elif op == TEST:
+            operation, target, msg = arg
+            b = pop()
+            a = pop()
+            t, v = operation(a[0], a[1], b[0], b[1])
+            if t != 'bool':
+                raise KyazukenError(msg)
+            if not v:
+                pc = target
+        elif op == BINARY:
+            b = pop()
+            a = stack[-1]
+            stack[-1] = arg(a[0], a[1], b[0], b[1])
+        elif op == STORE:
+            value = stack[-1]
+            old = frame[arg]
+            if old is None:
+                raise code.undeclared(arg)
+            if old[0] != value[0]:
+                if not is_subclass_instance(old[0], value[1]):
+                    msg = f'Attempted to assign value of type {value[0]} to variable of type {old[0]}'
+                    raise KyazukenError(msg)
+                value = (old[0], value[1])
+            frame[arg] = value
+        elif op == JUMP_IF_FALSE:
+            t, v = pop()
+            if t != 'bool':
+                raise KyazukenError(arg[1])
+            if not v:
+                pc = arg[0]
+        elif op == POP:
+            pop()
+        elif op == INVOKE:
+            kind, arg, tail = arg
+            callee_result = None
+
+            if kind == CALL_BOUND:
+                f, n = arg
+                if n > 0:
+                    values = [i[1] for i in stack[-n:]]
+                    del stack[-n:]
+                else:
+                    values = []
+            elif kind == CALL:
+                name, n = arg
+                values = pop_values(stack, n)
+                f = environment.get_function(name, [i[0] for i in values])
+                values = [i[1] for i in values]
+            elif kind == CALL_VIRTUAL:
+                node, n = arg
+                et, ev = pop()
+                values = [i[1] for i in pop_values(stack, n)]
+                if isinstance(ev, node.vguard):
+                    f = ev._class.vtable[node.vslot]
+                    values = [ev] + values
+                else:
+                    f, values = method_target(environment, ev, node.func.sub, node.argtypes, values)
+            elif kind == CALL_METHOD:
+                name, n = arg
+                et, ev = pop()
+                values = pop_values(stack, n)
+                f, values = method_target(environment, ev, name, [i[0] for i in values], [i[1] for i in values])
+            else:
+                values = pop_values(stack, arg)
+                _class = pop()
+                f = _class.get_constructor([i[0] for i in values])
+                obj = _class.instantiate(environment)
+                callee_result = (_class.name, obj)
+                if f is None:
+                    push(callee_result)
+                    continue
+                values = [obj] + [i[1] for i in values]
+
+            callee = f.__dict__.get('stack_code')
+            if callee is None or f.call is not callee.entry:
+                value = f.call(environment, values)
+                push(value if callee_result is None else callee_result)
+                continue
+
+            if tail:
+                # The caller returns whatever the callee does, its frame can go
+                del stack[base:]
+            else:
+                if len(frames) >= STACK_LIMIT:
+                    raise KyazukenError('Stack overflow: more than ' + str(STACK_LIMIT) + ' nested calls')
+                frames.append((code, frame, pc, base, result))
+                base = len(stack)
+                result = callee_result
+
+            code = callee
+            ops = code.ops
+            args = code.args
+            consts = code.consts
+
+            frame = list(zip(code.argtypes, values)) + code.padding
+            pc = 0
+        elif op == RETURN:
+            value = pop()
+            if result != None:
+                value = result
+            if len(frames) == 0:
+                return value
+
+            # Iterators of the loops being left are still on the stack
+            del stack[base:]
+            code, frame, pc, base, result = frames.pop()
+            ops = code.ops
+            args = code.args
+            consts = code.consts
+            push(value)
+        elif op == DECLARE:
+            frame[arg] = pop()
+        elif op == DEFINE:
+            slot, _type = arg
+            value = pop()
+            if value[0] != _type:
+                if not is_subclass_instance(_type, value[1]):
+                    raise KyazukenError('Attempted to assign a ' + str(value[0]) + ' to new variable of type ' + str(_type))
+                value = (_type, value[1])
+            frame[slot] = value
+        elif op == SUBSCRIPT:
+            it, iv = pop()
+            st, sv = pop()
+            if not it.startswith('int'):
+                raise KyazukenError("Failed: attempted subscript of " + arg + ' using type ' + str(it))
+            if type(sv) == str:
+                push(('int32', char_code(sv, iv)))
+            else:
+                push(sv.getitem(iv))
+        elif op == STORE_SUBSCRIPT:
+            it, iv = pop()
+            st, sv = pop()
+            if not it.startswith('int'):
+                raise KyazukenError("Failed: attempted subscript of " + arg + ' using type ' + str(it))
+            t, v = stack[-1]
+            sv.setitem(iv, t, v)
+        elif op == MEMBER:
+            et, ev = pop()
+            if ev is None:
+                raise null_member(arg)
+            push(ev.sub(arg))
+        elif op == STORE_MEMBER:
+            et, ev = pop()
+            if ev is None:
+                raise null_member(arg)
+            t, v = stack[-1]
+            ev.assign_sub(environment, arg, t, v)
+        elif op == NOT:
+            t, v = stack[-1]
+            stack[-1] = (t, not v)
+        elif op == NEGATE:
+            t, v = stack[-1]
+            stack[-1] = (t, -v)
+        elif op == INCREMENT:
+            t, v = stack[-1]
+            stack[-1] = (t, v + arg)
+        elif op == DUP:
+            push(stack[-1])
+        elif op == SWAP:
+            stack[-1], stack[-2] = stack[-2], stack[-1]
+        elif op == LOAD_CLASS:
+            push(environment.get_class(arg))
+        elif op == MAKE_ARRAY:
+            push(make_array(pop_values(stack, arg)))
+        elif op == NEW_ARRAY:
+            st, sv = pop()
+            if type(st) != str or not st.startswith(('int', 'uint')):
+                raise KyazukenError("Array size must be an integer, not " + str(st))
+            push((ArrayType(arg), new_array(arg, sv)))
+        elif op == FOR_ITER:
+            slot, _type, target = arg
+            val = stack[-1][1].iter()
+            if val == None:
+                pop()
+                pc = target
+            else:
+                frame[slot] = (_type, val)
+        elif op == JUMP_IF_FALSE_OR_POP:
+            if stack[-1][1]:
+                pop()
+            else:
+                pc = arg
+        elif op == JUMP_IF_TRUE_OR_POP:
+            if stack[-1][1]:
+                pc = arg
+            else:
+                pop()
+        elif op == BOOL:
+            stack[-1] = ('bool', stack[-1][1])
+        elif op == RAISE:
+            raise KyazukenError(arg)
+
+def compile_function(f):
+    code = Compiler(f).compile()
+
+    # Calls whose value is returned right away are tail calls, unless they construct
+    for pc, op in enumerate(code.ops):
+        if op in CALLS:
+            tail = op != NEW and pc + 1 < len(code.ops) and code.ops[pc + 1] == RETURN
+            code.ops[pc] = INVOKE
+            code.args[pc] = (op, code.args[pc], tail)
+
+    # Slots after the arguments, empty until their variable is declared (using one before
+    # that raises the error of an undeclared variable)
+    code.padding = [None] * (code.nslots - len(code.argtypes))
+
+    # The call attribute of the functions running on this loop, so callers can tell
+    code.entry = lambda environment, arguments: run(code, environment, arguments)
+    return code
+
+def install(functions):
+    for f in functions:
+        if hasattr(f, 'stack_code'):
+            continue
+
+        try:
+            f.stack_code = compile_function(f)
+        except Unsupported:
+            f.stack_code = None
+            continue
+
+        f.call = f.stack_code.entry
@@ -0,0 +1,342 @@
+from klang import *
+
+import os
+import sys
+
+# Tier-up engine.  Functions start on the tree-walker with a call counter; once a function
+# has been called THRESHOLD times its body is translated to Python source, compiled with
+# compile() and the resulting function replaces Function.call, or runs behind whatever
+# wraps the call (metrics, profilers).  Locals become Python locals, loops become while
+# loops and calls whose target can be resolved from the static argument types call that
+# target directly.  Anything the translator does not know makes the function stay on the
+# tree-walker.
+
+THRESHOLD = int(os.environ.get('KYAZUKEN_TIER_UP_THRESHOLD', '50'))
+
+# Print the generated source (and the reason a function was not translated) to stderr
+DUMP = bool(os.environ.get('KYAZUKEN_DUMP_TRANSPILED'))
+
+class Unsupported(Exception):
+    pass
+
+def _store_item(array, index, _type, value):
+    array.setitem(index, _type, value)
+    return value
+
+def _checked_return(result, rettype, name):
+    # A Kyazuken function may return something other than its declared type, the
+    # generated code relies on the declared type so it has to be verified.  Instances of a
+    # subclass can be returned where an ancestor is declared.
+    if result[0] != rettype and not is_subclass_instance(rettype, result[1]):
+        raise KyazukenError('Function ' + name + ' returned ' + str(result[0]) + ' instead of ' + str(rettype))
+    return result[1]
+
+COMPARISONS = ['==', '!=', '<', '>', '<=', '>=']
+
+ARITHMETIC = ['+', '-', '*', '/', '%']
+
+INTEGER_ONLY = ['&', '|', '^', '<<', '>>']
+
+class Translator:
+    def __init__(self, function, environment):
+        self.function = function
+        self.environment = environment
+        self.lines = []
+        self.indent = 1
+        self.scopes = [{}]
+        self.names = set()
+        self.globals = {
+            'KyazukenError': KyazukenError,
+            '_store_item': _store_item,
+            '_checked_return': _checked_return,
+            '_new_array': new_array,
+            'char_code': char_code
+            }
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def declare(self, name, _type):
+        # Kyazuken names can hold a $, and those the optimizer makes a .
+        base = 'v_' + ''.join(c if c.isalnum() else '_' for c in name)
+        pyname = base
+        n = 1
+        while pyname in self.names:
+            pyname = base + '_' + str(n)
+            n += 1
+        self.names.add(pyname)
+        self.scopes[-1][name] = (pyname, _type)
+        return pyname
+
+    def lookup(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        raise Unsupported('unknown variable ' + name)
+
+    def constant(self, value):
+        name = '_c' + str(len(self.globals))
+        self.globals[name] = value
+        return name
+
+    def translate(self):
+        f = self.function
+
+        argnames = [self.declare(i.name, i.type) for i in f.params]
+
+        header = 'def ' + self.pyname() + '(environment, arguments):'
+        if len(argnames) > 0:
+            self.emit(', '.join(argnames) + ', = arguments')
+
+        for i in f.statements:
+            self.statement(i)
+        self.emit("return 'void', None")
+
+        return '\n'.join([header] + self.lines) + '\n'
+
+    def pyname(self):
+        name = self.function.name
+        if name is None:
+            name = 'operator'
+        return '_k_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+    def block(self, node):
+        start = len(self.lines)
+        self.statement(node)
+        if len(self.lines) == start:
+            self.emit('pass')
+
+    def statement(self, node):
+        t = type(node)
+
+        if isinstance(node, Expression):
+            src, _type = self.expression(node)
+            self.emit(src)
+        elif t == VariableDeclaration:
+            self.declare(node.name, node.type)
+            self.emit(self.lookup(node.name)[0] + ' = ' + repr(default_value(node.type)))
+        elif t == VariableDefinition:
+            src, _type = self.expression(node.expr)
+            if _type != node.type:
+                raise Unsupported('definition of ' + node.name + ' with a ' + str(_type))
+            self.emit(self.declare(node.name, node.type) + ' = ' + src)
+        elif t == StatementList:
+            for i in node.statements:
+                self.statement(i)
+        elif t == IfBlock or t == IfElseBlock:
+            self.emit('if ' + self.condition(node.condition) + ':')
+            self.indent += 1
+            self.block(node.statement)
+            self.indent -= 1
+            if t == IfElseBlock:
+                self.emit('else:')
+                self.indent += 1
+                self.block(node.else_statement)
+                self.indent -= 1
+        elif t == WhileBlock:
+            self.emit('while ' + self.condition(node.condition) + ':')
+            self.indent += 1
+            self.block(node.statement)
+            self.indent -= 1
+        elif t == CForBlock:
+            self.scopes.append({})
+            self.statement(node.loop_init)
+            self.emit('while ' + self.condition(node.loop_condition) + ':')
+            self.indent += 1
+            self.statement(node.loop_code)
+            self.emit(self.expression(node.loop_end)[0])
+            self.indent -= 1
+            self.scopes.pop()
+        elif t == Return:
+            if node.val == None:
+                self.emit("return 'void', None")
+            else:
+                src, _type = self.expression(node.val)
+                self.emit('return ' + self.constant(_type) + ', ' + src)
+        elif t == NoOperation:
+            pass
+        else:
+            raise Unsupported(t.__name__)
+
+    def condition(self, expr):
+        src, _type = self.expression(expr)
+        if _type != 'bool':
+            raise Unsupported('condition of type ' + str(_type))
+        return src
+
+    def expression(self, node):
+        t = type(node)
+
+        if t == Literal:
+            if not type(node.value) in [int, float, str, bool]:
+                raise Unsupported('literal ' + repr(node.value))
+            return repr(node.value), node.type
+        elif t == Variable:
+            return self.lookup(node.name)
+        elif t == BinOp:
+            if node.op in ASSIGNMENT_OPERATORS:
+                return self.assignment(node.left, self.binop(ASSIGNMENT_OPERATORS[node.op], node.left, node.right))
+            return self.binop(node.op, node.left, node.right)
+        elif t == Store:
+            return self.assignment(node.obj, self.expression(node.expr))
+        elif t == UniOp:
+            src, _type = self.expression(node.left)
+            if node.op == '!':
+                return '(not ' + src + ')', _type
+            return '(-' + src + ')', _type
+        elif t == PreIncDec or t == PostIncDec:
+            return self.incdec(node)
+        elif t == Subscript:
+            return self.subscript(node)
+        elif t == FunctionCall:
+            return self.call(node)
+        elif t == NewArray:
+            size, st = self.expression(node.size)
+            if type(st) != str or not st.startswith(('int', 'uint')):
+                raise Unsupported('array size of type ' + str(st))
+            return '_new_array(' + self.constant(node.basetype) + ', ' + size + ')', ArrayType(node.basetype)
+
+        raise Unsupported(t.__name__)
+
+    def binop(self, op, left, right):
+        a, ta = self.expression(left)
+        b, tb = self.expression(right)
+
+        if op in COMPARISONS:
+            return '(' + a + ' ' + op + ' ' + b + ')', 'bool'
+        elif op == '&&':
+            return '(' + a + ' and ' + b + ')', 'bool'
+        elif op == '||':
+            return '(' + a + ' or ' + b + ')', 'bool'
+        elif op == '^^':
+            return '(bool(' + a + ') != bool(' + b + '))', 'bool'
+        elif op == '+' and (ta == 'String' or tb == 'String'):
+            return '(str(' + a + ') + str(' + b + '))', 'String'
+        elif op in ARITHMETIC or op in INTEGER_ONLY:
+            integers = type(ta) == str and type(tb) == str and ta.startswith(('int', 'uint')) and tb.startswith(('int', 'uint'))
+            if op in INTEGER_ONLY and not integers:
+                raise Unsupported('operator ' + op + ' on ' + str(ta) + ' and ' + str(tb))
+            if op == '/' and integers:
+                op = '//'
+            return '(' + a + ' ' + op + ' ' + b + ')', ta
+
+        raise Unsupported('operator ' + op)
+
+    def assignment(self, target, value):
+        src, _type = value
+
+        if type(target) == Variable:
+            pyname, vartype = self.lookup(target.name)
+            if vartype != _type:
+                raise Unsupported('assignment of a ' + str(_type) + ' to ' + target.name)
+            return '(' + pyname + ' := ' + src + ')', _type
+        elif type(target) == Subscript:
+            array, index, basetype = self.subscript_parts(target)
+            return '_store_item(' + array + ', ' + index + ', ' + self.constant(_type) + ', ' + src + ')', _type
+
+        raise Unsupported('assignment to ' + type(target).__name__)
+
+    def incdec(self, node):
+        if type(node.obj) != Variable:
+            raise Unsupported('increment of ' + type(node.obj).__name__)
+
+        pyname, _type = self.lookup(node.obj.name)
+        op = '+' if node.op == '++' else '-'
+        undo = '-' if node.op == '++' else '+'
+
+        if type(node) == PreIncDec:
+            return '(' + pyname + ' := ' + pyname + ' ' + op + ' 1)', _type
+        return '((' + pyname + ' := ' + pyname + ' ' + op + ' 1) ' + undo + ' 1)', _type
+
+    def subscript_parts(self, node):
+        array, st = self.expression(node.src)
+        index, it = self.expression(node.idx)
+
+        if type(st) != ArrayType or type(it) != str or not it.startswith('int'):
+            raise Unsupported('subscript of ' + str(st) + ' with ' + str(it))
+
+        return array, index, st.basetype
+
+    def subscript(self, node):
+        if node.src.static_type == 'String':
+            src, st = self.expression(node.src)
+            index, it = self.expression(node.idx)
+            if st != 'String' or type(it) != str or not it.startswith('int'):
+                raise Unsupported('subscript of ' + str(st) + ' with ' + str(it))
+            return 'char_code(' + src + ', ' + index + ')', 'int32'
+
+        array, index, basetype = self.subscript_parts(node)
+        return array + '.getitem(' + index + ')[1]', basetype
+
+    def call(self, node):
+        if node.method != None:
+            receiver = self.expression(node.func.src)[0]
+            values = ', '.join([receiver] + [self.expression(i)[0] for i in node.args])
+            return self.constant(node.method) + '.call(environment, [' + values + '])[1]', node.method.rettype
+
+        if type(node.func) != Variable:
+            raise Unsupported('call of ' + type(node.func).__name__)
+
+        args = [self.expression(i) for i in node.args]
+
+        target = node.target
+        if target is None:
+            try:
+                target = self.environment.get_function(node.func.name, [i[1] for i in args])
+            except KyazukenError:
+                raise Unsupported('unresolved call of ' + node.func.name)
+
+        ref = self.constant(target)
+        values = ', '.join(i[0] for i in args)
+
+        if isinstance(target, PyFunctionWrapper):
+            return ref + '.f(' + values + ')', target.rettype
+
+        call = ref + '.call(environment, [' + values + '])'
+        return '_checked_return(' + call + ', ' + self.constant(target.rettype) + ', ' + repr(target.name) + ')', target.rettype
+
+def transpile(f, environment):
+    translator = Translator(f, environment)
+    src = translator.translate()
+
+    if DUMP:
+        sys.stderr.write(src + '\n')
+
+    namespace = translator.globals
+    exec(compile(src, '<kyazuken ' + str(f.name) + '>', 'exec'), namespace)
+    return namespace[translator.pyname()]
+
+def _tier_up(f):
+    calls = 0
+    target = None
+
+    def call(environment, arguments):
+        nonlocal calls, target
+
+        if target != None:
+            return target(environment, arguments)
+
+        calls += 1
+        if calls < THRESHOLD:
+            return f.tree_call(environment, arguments)
+
+        target = f.tree_call
+        try:
+            target = transpile(f, environment)
+        except Unsupported as e:
+            if DUMP:
+                sys.stderr.write('Not transpiling ' + str(f.name) + ': ' + str(e) + '\n\n')
+
+        # Metrics and profilers wrap the call of the function, their wrapper has to stay
+        # in front of the translated code
+        if f.call is call:
+            f.call = target
+        return target(environment, arguments)
+
+    return call
+
+def install(functions):
+    for f in functions:
+        if not hasattr(f, 'tree_call'):
+            f.tree_call = f.call
+            f.call = _tier_up(f)
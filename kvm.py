@@ -0,0 +1,621 @@
+from klang import *
+
+from functools import partial
+
+# Bytecode engine.  Each Function/Constructor body is compiled once into a flat list of
+# instructions (an opcode and one argument, kept in two parallel lists) with a constant
+# pool, locals being accessed through the frame slots assigned by the resolver.  Expressions push a single
+# (type, value) pair on the stack, statements leave the stack as they found it.  The slot
+# of a variable declared in a branch that did not run is still None when it is used.
+
+CONST = 0
+LOAD = 1
+STORE = 2
+BINARY = 3
+JUMP_IF_FALSE = 4
+JUMP = 5
+POP = 6
+CALL = 7
+RETURN = 8
+DECLARE = 9
+DEFINE = 10
+CALL_METHOD = 11
+SUBSCRIPT = 12
+STORE_SUBSCRIPT = 13
+MEMBER = 14
+STORE_MEMBER = 15
+NOT = 16
+NEGATE = 17
+INCREMENT = 18
+DUP = 19
+SWAP = 20
+LOAD_CLASS = 21
+NEW = 22
+MAKE_ARRAY = 23
+FOR_ITER = 24
+RAISE = 25
+
+# Superinstructions for the most common sequences in loops and conditions
+BINARY_CONST = 26
+BINARY_LOAD = 27
+STORE_POP = 28
+INCREMENT_LOCAL = 29
+TEST = 30
+TEST_CONST = 31
+COMPARE = 32
+COMPARE_CONST = 33
+CALL_BOUND = 34
+NEW_ARRAY = 35
+CALL_VIRTUAL = 36
+
+# && and ||: the left operand stays as the result when it decides it, BOOL makes either
+# operand the bool result
+JUMP_IF_FALSE_OR_POP = 37
+JUMP_IF_TRUE_OR_POP = 38
+BOOL = 39
+
+OPCODE_NAMES = ['CONST', 'LOAD', 'STORE', 'BINARY', 'JUMP_IF_FALSE', 'JUMP', 'POP', 'CALL',
+                'RETURN', 'DECLARE', 'DEFINE', 'CALL_METHOD', 'SUBSCRIPT', 'STORE_SUBSCRIPT',
+                'MEMBER', 'STORE_MEMBER', 'NOT', 'NEGATE', 'INCREMENT', 'DUP', 'SWAP',
+                'LOAD_CLASS', 'NEW', 'MAKE_ARRAY', 'FOR_ITER', 'RAISE', 'BINARY_CONST',
+                'BINARY_LOAD', 'STORE_POP', 'INCREMENT_LOCAL', 'TEST', 'TEST_CONST', 'COMPARE',
+                'COMPARE_CONST', 'CALL_BOUND', 'NEW_ARRAY', 'CALL_VIRTUAL',
+                'JUMP_IF_FALSE_OR_POP', 'JUMP_IF_TRUE_OR_POP', 'BOOL']
+
+class Unsupported(Exception):
+    pass
+
+class CodeObject:
+    def __init__(self, name, argtypes, nslots, ops, args, consts, names):
+        self.name = name
+        self.argtypes = argtypes
+        self.nslots = nslots
+        self.ops = ops
+        self.args = args
+        self.consts = consts
+        self.names = names
+
+    def undeclared(self, slot):
+        return KyazukenError('Variable \'' + self.names[slot] + '\' does not exist.')
+
+    def run(self, environment, arguments):
+        ops = self.ops
+        args = self.args
+        consts = self.consts
+
+        frame = [None] * self.nslots
+        for i, t in enumerate(self.argtypes):
+            frame[i] = (t, arguments[i])
+
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        pc = 0
+
+        while True:
+            op = ops[pc]
+            arg = args[pc]
+            pc += 1
+
+            if op == LOAD:
+                value = frame[arg]
+                if value is None:
+                    raise self.undeclared(arg)
+                push(value)
+            elif op == COMPARE_CONST:
+                compare, b, target = arg
+                if not compare(pop()[1], b):
+                    pc = target
+            elif op == JUMP:
+                pc = arg
+            elif op == BINARY_CONST:
+                operation, b = arg
+                a = stack[-1]
+                stack[-1] = operation(a[0], a[1], b[0], b[1])
+            elif op == TEST_CONST:
+                operation, b, target, msg = arg
+                a = pop()
+                t, v = operation(a[0], a[1], b[0], b[1])
+                if t != 'bool':
+                    raise KyazukenError(msg)
+                if not v:
+                    pc = target
+            elif op == BINARY_LOAD:
+                operation, slot = arg
+                a = stack[-1]
+                b = frame[slot]
+                if b is None:
+                    raise self.undeclared(slot)
+                stack[-1] = operation(a[0], a[1], b[0], b[1])
+            elif op == STORE_POP:
+                value = pop()
+                old = frame[arg]
+                if old is None:
+                    raise self.undeclared(arg)
+                if old[0] != value[0]:
+                    if not is_subclass_instance(old[0], value[1]):
+                        msg = f'Attempted to assign value of type {value[0]} to variable of type {old[0]}'
+                        raise KyazukenError(msg)
+                    value = (old[0], value[1])
+                frame[arg] = value
+            elif op == INCREMENT_LOCAL:
+                slot, delta = arg
+                old = frame[slot]
+                if old is None:
+                    raise self.undeclared(slot)
+                frame[slot] = (old[0], old[1] + delta)
+            elif op == CONST:
+                push(consts[arg])
+            elif op == COMPARE:
+                compare, target = arg
+                b = pop()
+                if not compare(pop()[1], b[1]):
+                    pc = target
+            elif op == TEST:
+                operation, target, msg = arg
+                b = pop()
+                a = pop()
+                t, v = operation(a[0], a[1], b[0], b[1])
+                if t != 'bool':
+                    raise KyazukenError(msg)
+                if not v:
+                    pc = target
+            elif op == BINARY:
+                b = pop()
+                a = stack[-1]
+                stack[-1] = arg(a[0], a[1], b[0], b[1])
+            elif op == STORE:
+                value = stack[-1]
+                old = frame[arg]
+                if old is None:
+                    raise self.undeclared(arg)
+                if old[0] != value[0]:
+                    if not is_subclass_instance(old[0], value[1]):
+                        msg = f'Attempted to assign value of type {value[0]} to variable of type {old[0]}'
+                        raise KyazukenError(msg)
+                    value = (old[0], value[1])
+                frame[arg] = value
+            elif op == JUMP_IF_FALSE:
+                t, v = pop()
+                if t != 'bool':
+                    raise KyazukenError(arg[1])
+                if not v:
+                    pc = arg[0]
+            elif op == POP:
+                pop()
+            elif op == CALL_BOUND:
+                target, n = arg
+                if n > 0:
+                    values = stack[-n:]
+                    del stack[-n:]
+                else:
+                    values = []
+                push(target.call(environment, [i[1] for i in values]))
+            elif op == CALL:
+                name, n = arg
+                if n > 0:
+                    values = stack[-n:]
+                    del stack[-n:]
+                else:
+                    values = []
+                f = environment.get_function(name, [i[0] for i in values])
+                push(f.call(environment, [i[1] for i in values]))
+            elif op == RETURN:
+                return pop()
+            elif op == DECLARE:
+                frame[arg] = pop()
+            elif op == DEFINE:
+                slot, _type = arg
+                value = pop()
+                if value[0] != _type:
+                    if not is_subclass_instance(_type, value[1]):
+                        raise KyazukenError('Attempted to assign a ' + str(value[0]) + ' to new variable of type ' + str(_type))
+                    value = (_type, value[1])
+                frame[slot] = value
+            elif op == CALL_METHOD:
+                name, n = arg
+                et, ev = pop()
+                if n > 0:
+                    values = stack[-n:]
+                    del stack[-n:]
+                else:
+                    values = []
+                push(call_method(environment, ev, name, [i[0] for i in values], [i[1] for i in values]))
+            elif op == CALL_VIRTUAL:
+                node, n = arg
+                et, ev = pop()
+                if n > 0:
+                    values = stack[-n:]
+                    del stack[-n:]
+                else:
+                    values = []
+                push(call_virtual(environment, node, ev, [i[1] for i in values]))
+            elif op == SUBSCRIPT:
+                it, iv = pop()
+                st, sv = pop()
+                if not it.startswith('int'):
+                    raise KyazukenError("Failed: attempted subscript of " + arg + ' using type ' + str(it))
+                if type(sv) == str:
+                    push(('int32', char_code(sv, iv)))
+                else:
+                    push(sv.getitem(iv))
+            elif op == STORE_SUBSCRIPT:
+                it, iv = pop()
+                st, sv = pop()
+                if not it.startswith('int'):
+                    raise KyazukenError("Failed: attempted subscript of " + arg + ' using type ' + str(it))
+                t, v = stack[-1]
+                sv.setitem(iv, t, v)
+            elif op == MEMBER:
+                et, ev = pop()
+                if ev is None:
+                    raise null_member(arg)
+                push(ev.sub(arg))
+            elif op == STORE_MEMBER:
+                et, ev = pop()
+                if ev is None:
+                    raise null_member(arg)
+                t, v = stack[-1]
+                ev.assign_sub(environment, arg, t, v)
+            elif op == NOT:
+                t, v = stack[-1]
+                stack[-1] = (t, not v)
+            elif op == NEGATE:
+                t, v = stack[-1]
+                stack[-1] = (t, -v)
+            elif op == INCREMENT:
+                t, v = stack[-1]
+                stack[-1] = (t, v + arg)
+            elif op == DUP:
+                push(stack[-1])
+            elif op == SWAP:
+                stack[-1], stack[-2] = stack[-2], stack[-1]
+            elif op == LOAD_CLASS:
+                push(environment.get_class(arg))
+            elif op == NEW:
+                if arg > 0:
+                    values = stack[-arg:]
+                    del stack[-arg:]
+                else:
+                    values = []
+                _class = pop()
+                push(construct(environment, _class, [i[0] for i in values], [i[1] for i in values]))
+            elif op == MAKE_ARRAY:
+                if arg > 0:
+                    values = stack[-arg:]
+                    del stack[-arg:]
+                else:
+                    values = []
+                push(make_array(values))
+            elif op == NEW_ARRAY:
+                st, sv = pop()
+                if type(st) != str or not st.startswith(('int', 'uint')):
+                    raise KyazukenError("Array size must be an integer, not " + str(st))
+                push((ArrayType(arg), new_array(arg, sv)))
+            elif op == FOR_ITER:
+                slot, _type, target = arg
+                val = stack[-1][1].iter()
+                if val == None:
+                    pop()
+                    pc = target
+                else:
+                    frame[slot] = (_type, val)
+            elif op == JUMP_IF_FALSE_OR_POP:
+                if stack[-1][1]:
+                    pop()
+                else:
+                    pc = arg
+            elif op == JUMP_IF_TRUE_OR_POP:
+                if stack[-1][1]:
+                    pc = arg
+                else:
+                    pop()
+            elif op == BOOL:
+                stack[-1] = ('bool', stack[-1][1])
+            elif op == RAISE:
+                raise KyazukenError(arg)
+
+class Compiler:
+    def __init__(self, function):
+        self.function = function
+        self.ops = []
+        self.args = []
+        self.consts = []
+        self.const_index = {}
+        # Name of the variable of each slot, for the errors of undeclared ones
+        self.names = {}
+
+    def emit(self, op, arg = None):
+        self.ops.append(op)
+        self.args.append(arg)
+        return len(self.ops) - 1
+
+    def here(self):
+        return len(self.ops)
+
+    def local(self, node):
+        self.names[node.slot] = node.name
+        return node.slot
+
+    def const(self, _type, value):
+        key = (_type, type(value), value)
+        if not key in self.const_index:
+            self.const_index[key] = len(self.consts)
+            self.consts.append((_type, value))
+        return self.const_index[key]
+
+    def compile(self):
+        f = self.function
+
+        for i in f.statements:
+            self.statement(i)
+
+        self.emit(CONST, self.const('void', None))
+        self.emit(RETURN)
+
+        return CodeObject(f.name, [i.type for i in f.params], f.nslots, self.ops, self.args, self.consts, self.names)
+
+    def boolean(self, expr):
+        # Whether expr always gives a bool, so a condition can jump on it without a check
+        if type(expr) != BinOp or expr.op in ASSIGNMENT_OPERATORS:
+            return False
+        elif expr.op in LOGICAL_OPERATORS:
+            return self.boolean(expr.left) and self.boolean(expr.right)
+        return hasattr(self.operation(expr.op), 'compare')
+
+    def condition(self, node, expr):
+        # Returns the jumps to patch with the target taken when the condition is false
+        msg = CONDITION_ERRORS[type(node)]
+
+        if type(expr) == BinOp and expr.op == '&&' and self.boolean(expr):
+            return self.condition(node, expr.left) + self.condition(node, expr.right)
+
+        if type(expr) == BinOp and not expr.op in ASSIGNMENT_OPERATORS and not expr.op in LOGICAL_OPERATORS:
+            operation = self.operation(expr.op)
+            self.expression(expr.left)
+            if hasattr(operation, 'compare'):
+                # A comparison is always a bool, so the type check cannot fail
+                if type(expr.right) == Literal:
+                    return [self.emit(COMPARE_CONST, (operation.compare, expr.right.value, None))]
+                self.expression(expr.right)
+                return [self.emit(COMPARE, (operation.compare, None))]
+            if type(expr.right) == Literal:
+                return [self.emit(TEST_CONST, (self.operation(expr.op), (expr.right.type, expr.right.value), None, msg))]
+            self.expression(expr.right)
+            return [self.emit(TEST, (self.operation(expr.op), None, msg))]
+
+        self.expression(expr)
+        return [self.emit(JUMP_IF_FALSE, (None, msg))]
+
+    def patch(self, at, target = None):
+        if target is None:
+            target = self.here()
+
+        if type(at) == list:
+            for i in at:
+                self.patch(i, target)
+        elif self.ops[at] == JUMP_IF_FALSE:
+            self.args[at] = (target, self.args[at][1])
+        elif self.ops[at] == TEST:
+            operation, old, msg = self.args[at]
+            self.args[at] = (operation, target, msg)
+        elif self.ops[at] == COMPARE:
+            self.args[at] = (self.args[at][0], target)
+        elif self.ops[at] == COMPARE_CONST:
+            compare, b, old = self.args[at]
+            self.args[at] = (compare, b, target)
+        elif self.ops[at] == TEST_CONST:
+            operation, b, old, msg = self.args[at]
+            self.args[at] = (operation, b, target, msg)
+        elif self.ops[at] == FOR_ITER:
+            slot, _type, old = self.args[at]
+            self.args[at] = (slot, _type, target)
+        else:
+            self.args[at] = target
+
+    def statement(self, node):
+        t = type(node)
+
+        if (t == PreIncDec or t == PostIncDec) and type(node.obj) == Variable and node.obj.slot != None:
+            # The result is unused, only the store matters
+            self.emit(INCREMENT_LOCAL, (self.local(node.obj), 1 if node.op == '++' else -1))
+        elif isinstance(node, Expression):
+            self.expression(node)
+            if self.ops[-1] == STORE:
+                self.ops[-1] = STORE_POP
+            else:
+                self.emit(POP)
+        elif t == VariableDeclaration:
+            self.emit(CONST, self.const(node.type, default_value(node.type)))
+            self.emit(DECLARE, node.slot)
+        elif t == VariableDefinition:
+            self.expression(node.expr)
+            self.emit(DEFINE, (node.slot, node.type))
+        elif t == StatementList:
+            for i in node.statements:
+                self.statement(i)
+        elif t == IfBlock:
+            skip = self.condition(node, node.condition)
+            self.statement(node.statement)
+            self.patch(skip)
+        elif t == IfElseBlock:
+            skip = self.condition(node, node.condition)
+            self.statement(node.statement)
+            end = self.emit(JUMP)
+            self.patch(skip)
+            self.statement(node.else_statement)
+            self.patch(end)
+        elif t == WhileBlock:
+            top = self.here()
+            done = self.condition(node, node.condition)
+            self.statement(node.statement)
+            self.emit(JUMP, top)
+            self.patch(done)
+        elif t == CForBlock:
+            self.statement(node.loop_init)
+            top = self.here()
+            done = self.condition(node, node.loop_condition)
+            self.statement(node.loop_code)
+            self.expression(node.loop_end)
+            self.emit(POP)
+            self.emit(JUMP, top)
+            self.patch(done)
+        elif t == IterForBlock:
+            self.expression(node.iterable)
+            top = self.here()
+            loop = self.emit(FOR_ITER, (node.vardec.slot, node.vardec.type, None))
+            self.statement(node.statement)
+            self.emit(JUMP, top)
+            self.patch(loop)
+        elif t == Return:
+            if node.val != None:
+                self.expression(node.val)
+            else:
+                self.emit(CONST, self.const('void', None))
+            self.emit(RETURN)
+        elif t == NoOperation:
+            pass
+        else:
+            raise Unsupported(t.__name__)
+
+    def expression(self, node):
+        t = type(node)
+
+        if t == Literal:
+            self.emit(CONST, self.const(node.type, node.value))
+        elif t == Variable:
+            if node.slot is None:
+                self.emit(RAISE, 'Variable \'' + node.name + '\' does not exist.')
+            else:
+                self.emit(LOAD, self.local(node))
+        elif t == BinOp and node.op in LOGICAL_OPERATORS:
+            self.expression(node.left)
+            decided = self.emit(JUMP_IF_FALSE_OR_POP if node.op == '&&' else JUMP_IF_TRUE_OR_POP)
+            self.expression(node.right)
+            self.patch(decided)
+            self.emit(BOOL)
+        elif t == BinOp:
+            op = ASSIGNMENT_OPERATORS.get(node.op, node.op)
+            self.expression(node.left)
+            self.binary(self.operation(op), node.right)
+            if node.op in ASSIGNMENT_OPERATORS:
+                self.assign(node.left)
+        elif t == Store:
+            self.expression(node.expr)
+            self.assign(node.obj)
+        elif t == FunctionCall and node.method != None:
+            # The receiver is the first argument of the method
+            self.expression(node.func.src)
+            for i in node.args:
+                self.expression(i)
+            self.emit(CALL_BOUND, (node.method, len(node.args) + 1))
+        elif t == FunctionCall:
+            for i in node.args:
+                self.expression(i)
+            if node.target != None:
+                self.emit(CALL_BOUND, (node.target, len(node.args)))
+            elif type(node.func) == Variable:
+                self.emit(CALL, (node.func.name, len(node.args)))
+            elif type(node.func) == Member:
+                self.expression(node.func.src)
+                if node.vslot != None:
+                    self.emit(CALL_VIRTUAL, (node, len(node.args)))
+                else:
+                    self.emit(CALL_METHOD, (node.func.sub, len(node.args)))
+            else:
+                raise Unsupported('call of ' + type(node.func).__name__)
+        elif t == UniOp:
+            self.expression(node.left)
+            self.emit(NOT if node.op == '!' else NEGATE)
+        elif t == PreIncDec or t == PostIncDec:
+            self.expression(node.obj)
+            self.emit(DUP)
+            self.emit(INCREMENT, 1 if node.op == '++' else -1)
+            self.assign(node.obj)
+            if t == PreIncDec:
+                self.emit(SWAP)
+            self.emit(POP)
+        elif t == Subscript:
+            self.expression(node.src)
+            self.expression(node.idx)
+            self.emit(SUBSCRIPT, str(node.src))
+        elif t == Member:
+            self.expression(node.src)
+            self.emit(MEMBER, node.sub)
+        elif t == NewObject:
+            self.emit(LOAD_CLASS, node.name)
+            for i in node.args:
+                self.expression(i)
+            self.emit(NEW, len(node.args))
+        elif t == ArrayInitializer:
+            for i in node.items:
+                self.expression(i)
+            self.emit(MAKE_ARRAY, len(node.items))
+        elif t == NewArray:
+            self.expression(node.size)
+            self.emit(NEW_ARRAY, node.basetype)
+        else:
+            raise Unsupported(t.__name__)
+
+    def binary(self, operation, right):
+        # The left operand is already on the stack
+        if type(right) == Literal:
+            self.emit(BINARY_CONST, (operation, (right.type, right.value)))
+        elif type(right) == Variable and right.slot != None:
+            self.emit(BINARY_LOAD, (operation, self.local(right)))
+        else:
+            self.expression(right)
+            self.emit(BINARY, operation)
+
+    def operation(self, op):
+        if op in BINARY_OPERATIONS:
+            return BINARY_OPERATIONS[op]
+        return partial(binary_operation, op)
+
+    def assign(self, node):
+        # The value to store is on top of the stack and stays there
+        t = type(node)
+
+        if t == Variable:
+            if node.slot is None:
+                self.emit(RAISE, 'Variable \'' + node.name + '\' does not exist.')
+            else:
+                self.emit(STORE, self.local(node))
+        elif t == Subscript:
+            self.expression(node.src)
+            self.expression(node.idx)
+            self.emit(STORE_SUBSCRIPT, str(node.src))
+        elif t == Member:
+            self.expression(node.src)
+            self.emit(STORE_MEMBER, node.sub)
+        else:
+            raise Unsupported('assignment to ' + t.__name__)
+
+def compile_function(f):
+    return Compiler(f).compile()
+
+def install(functions):
+    # Functions using constructs the compiler does not know keep running on the tree-walker
+    for f in functions:
+        if hasattr(f, 'code'):
+            continue
+
+        try:
+            f.code = compile_function(f)
+        except Unsupported:
+            f.code = None
+            continue
+
+        f.call = f.code.run
+
+def disassemble(code):
+    lines = []
+    for pc, (op, arg) in enumerate(zip(code.ops, code.args)):
+        if op == CONST:
+            arg = code.consts[arg]
+        elif op == BINARY:
+            arg = getattr(arg, 'symbol', arg)
+        elif op in [BINARY_CONST, BINARY_LOAD, TEST, TEST_CONST, COMPARE, COMPARE_CONST]:
+            arg = (getattr(arg[0], 'symbol', arg[0]),) + arg[1:]
+        lines.append(str(pc).rjust(4) + ' ' + OPCODE_NAMES[op].ljust(16) + ('' if arg is None else repr(arg)))
+    return '\n'.join(lines)
@@ -0,0 +1,264 @@
+from klang import *
+from kenvironment import reset_engines
+from kparse import get_lexer, get_parser, read_source, report_syntax_error, resolve_import
+from kparse import make_document, dependency_order, check_document, run_document
+from kparse import KSyntaxError, LexingError
+
+import os
+import time
+
+# Watch mode.  The parsed toplevels and elaborated documents of a program stay in memory
+# and the sources are polled for changes.  A changed file is lexed again and split into
+# its toplevels; only the toplevels whose tokens (and positions) changed are parsed and
+# resolved again, the others are kept as they were.  The changed documents and every
+# document importing them, directly or not, are elaborated again, then the program is
+# linked and run.
+
+POLL_INTERVAL = float(os.environ.get('KYAZUKEN_WATCH_INTERVAL', 0.5))
+
+def split_toplevels(tokens):
+    # Toplevels end with the '}' closing their body, or the ';' of an import
+    segments = []
+    start = 0
+    depth = 0
+
+    for n, token in enumerate(tokens):
+        kind = token.gettokentype()
+        if kind == 'OPEN_CURLY':
+            depth += 1
+        elif kind == 'CLOSE_CURLY':
+            depth -= 1
+        elif kind != 'SEMICOLON' or depth != 0:
+            continue
+
+        if depth == 0:
+            segments.append(tokens[start:n + 1])
+            start = n + 1
+
+    if start < len(tokens):
+        segments.append(tokens[start:])
+    return segments
+
+def segment_key(tokens):
+    return tuple((i.gettokentype(), i.getstr(), i.getsourcepos().lineno, i.getsourcepos().colno) for i in tokens)
+
+class SourceFile:
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+
+        # Tokens and toplevel of every segment, by segment_key
+        self.segments = {}
+        self.ast = []
+        self.imports = []
+
+        # ids of the toplevels parsed since the file was last elaborated
+        self.fresh = set()
+
+    def parse_segment(self, key):
+        node = get_parser().parse(iter(self.segments[key][0]))[0]
+        self.fresh.add(id(node))
+        self.replace(self.segments[key][1], node)
+        self.segments[key] = (self.segments[key][0], node)
+        return node
+
+    def replace(self, old, new):
+        self.ast = [new if i is old else i for i in self.ast]
+
+class Workspace:
+    def __init__(self, filename):
+        self.root = os.path.normpath(filename)
+        self.files = {}
+        self.docs = {}
+
+    def load(self, path):
+        # Reads path again, keeping the toplevels that did not change.  Returns the number
+        # of errors; the previous state of the file is kept when there are some, until
+        # the file changes again.
+        old = self.files.get(path)
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            text = read_source(path)
+        except OSError as e:
+            print("Error: " + str(e))
+            if old != None:
+                old.mtime = None
+            return 1
+
+        if old != None:
+            old.mtime = mtime
+
+        try:
+            tokens = get_lexer().tokens(text)
+        except LexingError as e:
+            report_syntax_error(path, text, e.source_pos, e.message)
+            return 1
+
+        state = SourceFile(path, mtime)
+
+        for part in split_toplevels(tokens):
+            key = segment_key(part)
+            if old != None and key in old.segments:
+                state.segments[key] = old.segments[key]
+                state.ast.append(old.segments[key][1])
+                continue
+
+            state.segments[key] = (part, None)
+            state.ast.append(None)
+            try:
+                state.parse_segment(key)
+            except KSyntaxError as e:
+                report_syntax_error(path, text, e.token.getsourcepos(), str(e))
+                return 1
+
+        self.files[path] = state
+        return 0
+
+    def scan_imports(self, path):
+        errors = 0
+        state = self.files[path]
+        state.imports = []
+
+        for i in state.ast:
+            if type(i) != ImportStatement:
+                continue
+
+            dep = resolve_import(i, path)
+            if dep is None:
+                print("Error: Could not import " + i.commonname + ' from file ' + path)
+                errors += 1
+            elif not dep in state.imports:
+                state.imports.append(dep)
+
+        return errors
+
+    def importers(self, paths):
+        # paths and every file importing one of them, directly or not
+        result = set(paths)
+        grown = True
+        while grown:
+            grown = False
+            for path, state in self.files.items():
+                if not path in result and any(i in result for i in state.imports):
+                    result.add(path)
+                    grown = True
+        return result
+
+    def relink_classes(self, state, visible):
+        # Kept classes whose parent got replaced, or failed to link, are parsed again so
+        # they get resolved against the new parent
+        replaced = True
+        while replaced:
+            replaced = False
+            for key, (tokens, node) in list(state.segments.items()):
+                if not isinstance(node, ClassDefinition) or id(node) in state.fresh:
+                    continue
+                if visible.get(node.inherited) is node.parent and (node.inherited is None or node.parent != None):
+                    continue
+
+                visible[node.name] = state.parse_segment(key)
+                replaced = True
+
+    def elaborate(self, path):
+        state = self.files[path]
+        imported = [self.docs[i] for i in state.imports if i in self.docs]
+
+        visible = {}
+        for i in imported:
+            visible.update(i.classes)
+        for i in state.ast:
+            if isinstance(i, ClassDefinition):
+                visible[i.name] = i
+        self.relink_classes(state, visible)
+
+        resolved = {id(i) for i in state.ast} - state.fresh
+        doc, class_errors = make_document(state.ast, imported, resolved)
+        for i in class_errors:
+            print("Error: " + i)
+
+        for i in imported:
+            doc.add_imported_document(i)
+        self.docs[path] = doc
+
+        state.fresh = set()
+        return len(class_errors)
+
+    def rebuild(self, changed):
+        # Returns the number of errors and the number of toplevels parsed
+        errors = 0
+        for path in changed:
+            errors += self.load(path)
+        parsed = sum(len(self.files[i].fresh) for i in changed if i in self.files)
+
+        # Changed files may import files that were not loaded yet
+        pending = [i for i in changed if i in self.files]
+        while len(pending) > 0:
+            path = pending.pop()
+            errors += self.scan_imports(path)
+
+            for dep in self.files[path].imports:
+                if not dep in self.files:
+                    errors += self.load(dep)
+                    if dep in self.files:
+                        parsed += len(self.files[dep].fresh)
+                        pending.append(dep)
+
+        order, cycle_errors = dependency_order(self.root, {i: j.imports for i, j in self.files.items()})
+        errors += cycle_errors
+
+        # Files no longer imported are not watched anymore
+        self.files = {i: self.files[i] for i in order if i in self.files}
+        self.docs = {i: self.docs[i] for i in order if i in self.docs}
+
+        dirty = self.importers(changed)
+        for path in order:
+            if path in self.files and (path in dirty or not path in self.docs):
+                errors += self.elaborate(path)
+
+        return errors, parsed
+
+    def changed_files(self):
+        changed = []
+        for path, state in self.files.items():
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != state.mtime:
+                changed.append(path)
+        return changed
+
+    def link_and_run(self, errors, argv, engine):
+        if errors == 0:
+            document = self.docs[self.root]
+            env = document.make_default_env()
+
+            # Bindings made by the last check may point to replaced toplevels
+            reset_engines(document.code_objects(env))
+            errors += check_document(document, env)
+
+        if errors == 0:
+            run_document(document, env, argv, engine)
+        else:
+            print("There were errors.  Will not execute.")
+
+def watch(filename, argv, engine):
+    workspace = Workspace(filename)
+    changed = [workspace.root]
+
+    try:
+        while True:
+            if len(changed) > 0:
+                start = time.perf_counter()
+                errors, parsed = workspace.rebuild(changed)
+                elapsed = time.perf_counter() - start
+
+                print('Rebuilt ' + ', '.join(changed) + ': ' + str(parsed) + ' toplevel(s) parsed in ' + str(round(elapsed * 1000, 1)) + ' ms')
+                workspace.link_and_run(errors, argv, engine)
+                print('Watching ' + str(len(workspace.files)) + ' file(s) for changes...')
+
+            time.sleep(POLL_INTERVAL)
+            changed = workspace.changed_files()
+    except KeyboardInterrupt:
+        pass
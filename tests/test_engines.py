@@ -0,0 +1,91 @@
+import contextlib
+import functools
+import io
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from klang import KyazukenError
+import kbatch
+import klib
+
+# Engine parity.  Every program runs on each engine and has to print the same thing as on
+# the tree-walker: the benchmark corpus, and the programs in tests/programs, which also
+# have to print what the .out file next to them holds.  Programs get their own path as
+# argument.  A Python exception escaping a run is a failure of its own, Kyazuken errors
+# are part of the output.
+
+ENGINES = ['tree', 'vm', 'stack', 'closure', 'transpile']
+
+BENCH_DIR = os.path.join(ROOT, 'bench')
+PROGRAMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'programs')
+
+def programs(directory):
+    return sorted(i for i in os.listdir(directory) if i.endswith('.k'))
+
+def run(filename, engine, profiler = None):
+    # A fresh document every time, engines install themselves on its functions
+    prepared = kbatch.prepare(filename)
+    if type(prepared) == str:
+        return prepared
+
+    document, env = prepared
+    klib.stdout.flush()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            document.execute(env, [filename, filename], engine, profiler)
+        except KyazukenError as e:
+            print('Error: ' + str(e))
+        finally:
+            klib.stdout.flush()
+    return out.getvalue()
+
+@functools.lru_cache(maxsize = None)
+def reference(filename):
+    return run(filename, 'tree')
+
+@pytest.mark.parametrize('engine', ENGINES[1:])
+@pytest.mark.parametrize('name', programs(BENCH_DIR))
+def test_bench(name, engine):
+    filename = os.path.join(BENCH_DIR, name)
+    assert run(filename, engine) == reference(filename)
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('name', programs(PROGRAMS_DIR))
+def test_program(name, engine):
+    filename = os.path.join(PROGRAMS_DIR, name)
+    with open(filename[:-2] + '.out') as f:
+        expected = f.read()
+    assert run(filename, engine) == expected
+
+def test_errors_before_optimizing(tmp_path):
+    # The optimizer drops the dead store, the checker must still see it
+    filename = str(tmp_path / 'dead_store.k')
+    with open(filename, 'w') as f:
+        f.write('void main() {\n    int x = "hello";\n    println("ran");\n}\n')
+    out = run(filename, 'tree')
+    assert 'Error: Attempted to assign a String to new variable of type int32 (in main())' in out
+    assert not 'ran' in out
+
+def test_no_main(tmp_path):
+    filename = str(tmp_path / 'library.k')
+    with open(filename, 'w') as f:
+        f.write('int twice(int x) {\n    return 2 * x;\n}\n')
+    assert 'Error: no main function' in run(filename, 'tree')
+
+# Every way of reaching the slot of a variable whose declaration did not run
+UNDECLARED = ['println("" + y);', 'y = 2; println("" + y);', 'int z = 1 + y; println("" + z);',
+              'int z = y = 2;', 'y++;', 'y += 1;']
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('statement', UNDECLARED)
+def test_undeclared(tmp_path, statement, engine):
+    filename = str(tmp_path / 'undeclared.k')
+    with open(filename, 'w') as f:
+        f.write('void main() {\n    if (1 == 2)\n        int y = 1;\n    ' + statement + '\n    println("ran");\n}\n')
+    assert run(filename, engine) == "Error: Variable 'y' does not exist.\n"
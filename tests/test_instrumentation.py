@@ -0,0 +1,45 @@
+import functools
+import os
+
+import pytest
+
+from test_engines import BENCH_DIR, ENGINES, PROGRAMS_DIR, run
+import kmetrics
+import kprof
+
+# Metrics and profilers have to see the same calls on every engine, including the calls
+# of functions made after they tiered up
+
+PROGRAM = os.path.join(PROGRAMS_DIR, 'short_circuit.k')
+
+def metrics(engine):
+    kmetrics.registry.reset()
+    kmetrics.enable()
+    try:
+        run(PROGRAM, engine)
+    finally:
+        kmetrics.disable()
+    return kmetrics.registry.calls
+
+@functools.lru_cache(maxsize = None)
+def reference():
+    return metrics('tree')
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_metrics_calls(engine):
+    calls = metrics(engine)
+    assert calls['probe(int32,int32[])'] == 60
+    assert calls == reference()
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_profile_calls(engine):
+    profiler = kprof.DeterministicProfiler()
+    run(PROGRAM, engine, profiler)
+    assert {i: j.count for i, j in profiler.functions.items()} == reference()
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_profile_samples(engine):
+    profiler = kprof.SamplingProfiler()
+    run(os.path.join(BENCH_DIR, 'fib.k'), engine, profiler)
+    # Nearly all the time goes to fib
+    assert profiler.functions['fib(int32)'].count >= profiler.functions['main()'].count // 2